@@ -0,0 +1,210 @@
+from sqlalchemy import event, select, or_, and_, func, exists
+from sqlalchemy.orm import aliased
+from datetime import datetime, timedelta
+from app import db
+from models import LogAlteracao, Registro, Pendencia, Plantao, NotificacaoSistema, Configuracao
+
+# Entidades acompanhadas pelo log de alterações
+ENTIDADES = {
+    Registro: 'registro',
+    Pendencia: 'pendencia',
+    Plantao: 'plantao',
+    NotificacaoSistema: 'notificacao'
+}
+
+# Segundos em que uma lacuna de sequência antes de uma entrada é tratada
+# como transação ainda aberta (ver marca_dagua)
+JANELA_CONFIRMACAO = 60
+
+def _posto_do_plantao(connection, plantao_id, cache_postos):
+    if plantao_id not in cache_postos:
+        cache_postos[plantao_id] = connection.execute(
+            select(Plantao.posto_id).where(Plantao.id == plantao_id)
+        ).scalar()
+    return cache_postos[plantao_id]
+
+def _escopo(connection, obj, cache_postos):
+    """Retorna (posto_id, usuario_id) que limitam quem pode ver a alteração"""
+    if isinstance(obj, Plantao):
+        return obj.posto_id, None
+    if isinstance(obj, Registro):
+        return _posto_do_plantao(connection, obj.plantao_id, cache_postos), None
+    if isinstance(obj, NotificacaoSistema):
+        return None, obj.usuario_id
+    # Pendências são visíveis a todos, como em /api/v1/pendencias
+    return None, None
+
+def _gravar_log(connection, linhas):
+    agora = datetime.utcnow()
+    connection.execute(LogAlteracao.__table__.insert(), [{**linha, 'criado_em': agora} for linha in linhas])
+
+def registrar_log_alteracoes(session):
+    """Escreve uma entrada no log de alterações para cada gravação das entidades acompanhadas
+
+    As entradas são inseridas no flush, pela conexão da própria alteração:
+    confirmam e desfazem junto com ela. Como as transações confirmam fora da
+    ordem das sequências, quem lê usa marca_dagua.
+    """
+
+    @event.listens_for(session, 'after_flush')
+    def after_flush(session, flush_context):
+        connection = session.connection()
+        cache_postos = {}
+        linhas = []
+
+        for operacao, objetos in (('criar', session.new),
+                                  ('atualizar', session.dirty),
+                                  ('deletar', session.deleted)):
+            for obj in objetos:
+                entidade = ENTIDADES.get(type(obj))
+                if not entidade:
+                    continue
+                if operacao == 'atualizar' and not session.is_modified(obj):
+                    continue
+                posto_id, usuario_id = _escopo(connection, obj, cache_postos)
+                linhas.append({
+                    'entidade': entidade,
+                    'entidade_id': obj.id,
+                    'operacao': operacao,
+                    'posto_id': posto_id,
+                    'usuario_id': usuario_id
+                })
+        if linhas:
+            _gravar_log(connection, linhas)
+
+    def registrar_em_massa(contexto):
+        # Alterações em massa não expõem os ids afetados: o cliente recarrega a entidade
+        entidade = ENTIDADES.get(contexto.mapper.class_)
+        if entidade:
+            _gravar_log(contexto.session.connection(), [{
+                'entidade': entidade,
+                'entidade_id': None,
+                'operacao': 'recarregar',
+                'posto_id': None,
+                'usuario_id': None
+            }])
+
+    event.listen(session, 'after_bulk_update', registrar_em_massa)
+    event.listen(session, 'after_bulk_delete', registrar_em_massa)
+
+def marca_dagua(apos):
+    """Sequência ausente que segura a entrega a quem já leu até `apos` (None: nenhuma)
+
+    Uma sequência ausente logo antes de uma entrada recente pode ser de uma
+    transação ainda aberta, que vai confirmar depois das sequências
+    maiores: só o que vem antes dela é entregue. Passados JANELA_CONFIRMACAO
+    segundos a lacuna é tratada como rollback (ou compactação) e deixa de
+    segurar a entrega; uma transação mais longa que isso pode ser pulada.
+    Só as entradas da janela são lidas.
+    """
+    limite = datetime.utcnow() - timedelta(seconds=JANELA_CONFIRMACAO)
+    recentes = db.session.execute(
+        select(LogAlteracao.id)
+        .where(LogAlteracao.id > apos, LogAlteracao.criado_em >= limite)
+        .order_by(LogAlteracao.id)
+    ).scalars().all()
+    presentes = set(recentes)
+    anteriores = [seq - 1 for seq in recentes if seq - 1 > apos and seq - 1 not in presentes]
+    if anteriores:
+        presentes.update(db.session.execute(
+            select(LogAlteracao.id).where(LogAlteracao.id.in_(anteriores))
+        ).scalars())
+    for seq in recentes:
+        if seq - 1 > apos and seq - 1 not in presentes:
+            return seq - 1
+    return None
+
+def buscar_alteracoes(usuario, posto_id, apos=0, limite=500):
+    """Busca as alterações visíveis ao usuário com sequência maior que `apos`
+
+    Só até a marca d'água (ver marca_dagua): uma sequência menor ainda não
+    confirmada não é pulada por quem continua de `after`.
+    """
+    query = LogAlteracao.query.filter(LogAlteracao.id > apos)
+    marca = marca_dagua(apos)
+    if marca is not None:
+        query = query.filter(LogAlteracao.id < marca)
+
+    notificacoes_visiveis = and_(
+        LogAlteracao.entidade == 'notificacao',
+        or_(LogAlteracao.usuario_id == usuario.id, LogAlteracao.usuario_id.is_(None))
+    )
+
+    if usuario.tem_perfil('gestor'):
+        query = query.filter(or_(LogAlteracao.entidade != 'notificacao', notificacoes_visiveis))
+    else:
+        query = query.filter(or_(
+            LogAlteracao.entidade == 'pendencia',
+            and_(
+                LogAlteracao.entidade.in_(['registro', 'plantao']),
+                or_(LogAlteracao.posto_id == posto_id, LogAlteracao.entidade_id.is_(None))
+            ),
+            notificacoes_visiveis
+        ))
+
+    return query.order_by(LogAlteracao.id.asc()).limit(limite).all()
+
+def compactar_log_alteracoes(dias_compactacao=1, dias_retencao=30, lote=1000):
+    """Compacta o log de alterações
+
+    1. Entradas com mais de `dias_compactacao` dias que já foram superadas por
+       uma entrada mais recente da mesma entidade são removidas (o cliente só
+       precisa da última).
+    2. Entradas com mais de `dias_retencao` dias são removidas e o maior id
+       removido vira o corte: clientes com `after` abaixo dele precisam
+       recarregar as listas completas.
+    """
+    limite_compactacao = datetime.utcnow() - timedelta(days=dias_compactacao)
+    fim = db.session.query(func.max(LogAlteracao.id)).filter(
+        LogAlteracao.criado_em < limite_compactacao
+    ).scalar()
+    inicio = (db.session.query(func.min(LogAlteracao.id)).scalar() or 1) - 1
+
+    # Faixas de `lote` ids; cada entrada é comparada só com as mais novas da mesma entidade
+    posterior = aliased(LogAlteracao)
+    compactadas = 0
+    while fim is not None and inicio < fim:
+        ids = db.session.execute(
+            select(LogAlteracao.id).where(
+                LogAlteracao.id > inicio,
+                LogAlteracao.id <= min(inicio + lote, fim),
+                LogAlteracao.criado_em < limite_compactacao,
+                LogAlteracao.entidade_id.isnot(None),
+                exists().where(
+                    posterior.entidade == LogAlteracao.entidade,
+                    posterior.entidade_id == LogAlteracao.entidade_id,
+                    posterior.id > LogAlteracao.id
+                )
+            )
+        ).scalars().all()
+        if ids:
+            compactadas += LogAlteracao.query.filter(
+                LogAlteracao.id.in_(ids)
+            ).delete(synchronize_session=False)
+            db.session.commit()
+        inicio += lote
+
+    limite_retencao = datetime.utcnow() - timedelta(days=dias_retencao)
+    corte = db.session.query(func.max(LogAlteracao.id)).filter(
+        LogAlteracao.criado_em < limite_retencao
+    ).scalar()
+
+    expiradas = 0
+    if corte:
+        while True:
+            ids = [i for (i,) in db.session.query(LogAlteracao.id).filter(
+                LogAlteracao.id <= corte
+            ).limit(lote)]
+            if not ids:
+                break
+            expiradas += LogAlteracao.query.filter(
+                LogAlteracao.id.in_(ids)
+            ).delete(synchronize_session=False)
+            db.session.commit()
+        Configuracao.set_valor('log_alteracoes_corte', corte, 'int', 'Menor sequência disponível no log de alterações')
+
+    return compactadas, expiradas
+
+def corte_log_alteracoes():
+    """Sequência abaixo da qual o log foi expirado"""
+    return Configuracao.get_valor('log_alteracoes_corte', 0)
@@ -1,11 +1,22 @@
-from flask import Blueprint, request, jsonify
+from flask import Blueprint, request, jsonify, Response, current_app, g, url_for
 from flask_restful import Api, Resource
 from marshmallow import Schema, fields, ValidationError
 from flask_login import login_required, current_user
 from app import db
 from models import *
-from routes import verificar_perfil
-from cache import cached, invalidate_cache_pattern
+from routes import (verificar_perfil, escopo_global, escopo_usuario,
+                    versao_pendencias, versao_notificacoes)
+from cache import cache, cached_response, micro_cache, conditional_get, namespace_version, ResponseCache, NotificationCache
+from sqlalchemy import func
+from sqlalchemy.exc import IntegrityError
+from alteracoes import buscar_alteracoes, corte_log_alteracoes
+from eventos import publicar, canal_usuario
+from notificacoes import caixa_entrada
+from idempotencia import chave_valida, respostas_registradas, registrar_resposta
+from tags import registros_com_tag
+from projecoes import (CampoInvalido, PROJECAO_USUARIOS, PROJECAO_REGISTROS, PROJECAO_PENDENCIAS,
+                       consulta_usuarios, consulta_registros, consulta_pendencias)
+from werkzeug.exceptions import HTTPException
 from datetime import datetime, timedelta
 import jwt
 import os
@@ -14,6 +25,18 @@ import os
 api_bp = Blueprint('api', __name__, url_prefix='/api/v1')
 api = Api(api_bp)
 
+@api.representation('application/json')
+def output_json(data, code, headers=None):
+    """Aceita tanto dados quanto respostas prontas (`jsonify(...), código`)"""
+    if isinstance(data, Response):
+        data.status_code = code
+        data.headers.extend(headers or {})
+        return data
+    response = jsonify(data)
+    response.status_code = code
+    response.headers.extend(headers or {})
+    return response
+
 # Schemas para serialização/deserialização
 class UsuarioSchema(Schema):
     id = fields.Int(dump_only=True)
@@ -53,6 +76,28 @@ class PlantaoSchema(Schema):
     observacoes = fields.Str()
     usuario = fields.Nested(UsuarioSchema, dump_only=True)
 
+# Instâncias reutilizadas (validação e resposta de escrita); listagens usam projecoes
+usuario_schema = UsuarioSchema()
+registro_schema = RegistroSchema()
+registros_schema = RegistroSchema(many=True)
+pendencia_schema = PendenciaSchema()
+
+def listar_projecao(projecao, consulta, ordem=None, filtros=()):
+    """Executa a listagem só com as colunas de ?fields= e serializa as linhas"""
+    try:
+        nomes = projecao.selecionar(request.args.get('fields'))
+    except CampoInvalido as e:
+        return jsonify({'message': f'Campos inválidos: {e}'}), 400
+    
+    query = consulta(nomes)
+    for filtro in filtros:
+        query = filtro(query)
+    if ordem is not None:
+        query = query.order_by(ordem)
+    
+    linhas = db.session.execute(query).all()
+    return jsonify(projecao.serializar(linhas, nomes))
+
 # Autenticação JWT
 def generate_token(user_id):
     """Gera token JWT para API"""
@@ -69,6 +114,11 @@ def token_required(f):
     
     @wraps(f)
     def decorated(*args, **kwargs):
+        # Sub-requisições de /batch reutilizam o principal já autenticado
+        usuario = g.get('api_usuario')
+        if usuario is not None:
+            return f(*args, current_user=usuario, **kwargs)
+        
         token = request.headers.get('Authorization')
         
         if not token:
@@ -87,10 +137,45 @@ def token_required(f):
         except jwt.InvalidTokenError:
             return jsonify({'message': 'Token inválido'}), 401
         
-        return f(current_user, *args, **kwargs)
+        g.api_usuario = current_user
+        return f(*args, current_user=current_user, **kwargs)
     
     return decorated
 
+# Escopos explícitos do cache de respostas
+def escopo_posto(current_user):
+    """Resposta compartilhada pelos usuários do mesmo posto (gestores veem tudo)"""
+    if current_user.tem_perfil('gestor'):
+        return 'gestor'
+    
+    def buscar_posto():
+        plantao_ativo = Plantao.query.filter_by(
+            usuario_id=current_user.id,
+            status='aberto'
+        ).first()
+        return f'posto:{plantao_ativo.posto_id}' if plantao_ativo else 'posto:nenhum'
+    
+    # O posto do usuário muda apenas quando um plantão é iniciado/encerrado
+    geracao = ResponseCache.generation('escopo')
+    return cache.get_or_set(f'api_escopo:{geracao}:{current_user.id}', buscar_posto, 300)
+
+# Versões baratas para GET condicional (gerações no Redis ou agregados no banco)
+def versao_usuarios(current_user):
+    return namespace_version('usuarios')
+
+def versao_registros(current_user):
+    versao = namespace_version('registros')
+    if versao is None:
+        total, ultima = db.session.query(
+            func.count(Registro.id), func.max(Registro.atualizado_em)
+        ).one()
+        versao = f'{total}:{ultima}'
+    return versao
+
+def versao_dashboard(current_user):
+    return namespace_version('dashboard')
+
+
 # Recursos da API
 class AuthResource(Resource):
     """Autenticação da API"""
@@ -123,14 +208,14 @@ class UsuariosResource(Resource):
     """API para gestão de usuários"""
     
     @token_required
+    @conditional_get(versao_usuarios, escopo_usuario)
     def get(self, current_user):
         """Lista usuários (apenas gestores)"""
         if not current_user.tem_perfil('gestor'):
             return jsonify({'message': 'Acesso negado'}), 403
         
-        usuarios = Usuario.query.filter_by(ativo=True).all()
-        schema = UsuarioSchema(many=True)
-        return jsonify(schema.dump(usuarios))
+        return listar_projecao(PROJECAO_USUARIOS, consulta_usuarios,
+                               filtros=[lambda q: q.where(Usuario.ativo == True)])
     
     @token_required
     def post(self, current_user):
@@ -139,7 +224,7 @@ class UsuariosResource(Resource):
             return jsonify({'message': 'Acesso negado'}), 403
         
         try:
-            schema = UsuarioSchema()
+            schema = usuario_schema
             data = schema.load(request.get_json())
             
             # Verificar se email já existe
@@ -162,34 +247,37 @@ class RegistrosResource(Resource):
     """API para gestão de registros"""
     
     @token_required
-    @cached(timeout=300, key_prefix='api_registros')
+    @conditional_get(versao_registros, escopo_posto)
+    @cached_response('registros', escopo_posto, timeout=300)
     def get(self, current_user):
         """Lista registros"""
         # Verificar se é gestor
         is_gestor = current_user.tem_perfil('gestor')
         
-        # Buscar plantão ativo para filtragem
-        plantao_ativo = Plantao.query.filter_by(
-            usuario_id=current_user.id,
-            status='aberto'
-        ).first()
+        filtros = []
+        if not is_gestor:
+            # Buscar plantão ativo para filtragem
+            plantao_ativo = Plantao.query.filter_by(
+                usuario_id=current_user.id,
+                status='aberto'
+            ).first()
+            
+            if not plantao_ativo:
+                return jsonify([])
+            
+            posto_id_usuario = plantao_ativo.posto_id
+            filtros.append(lambda q: q.join(Plantao, Registro.plantao_id == Plantao.id).where(
+                Plantao.posto_id == posto_id_usuario
+            ))
         
-        if is_gestor:
-            registros = Registro.query.order_by(Registro.criado_em.desc()).all()
-        else:
-            if plantao_ativo:
-                posto_id_usuario = plantao_ativo.posto_id
-                registros = Registro.query.join(Plantao).filter(
-                    Plantao.posto_id == posto_id_usuario
-                ).order_by(Registro.criado_em.desc()).all()
-            else:
-                registros = []
+        tag = request.args.get('tag')
+        if tag:
+            filtros.append(lambda q: q.where(registros_com_tag(tag)))
         
-        schema = RegistroSchema(many=True)
-        return jsonify(schema.dump(registros))
+        return listar_projecao(PROJECAO_REGISTROS, consulta_registros,
+                               ordem=Registro.criado_em.desc(), filtros=filtros)
     
     @token_required
-    @invalidate_cache_pattern('api_registros*')
     def post(self, current_user):
         """Cria novo registro"""
         try:
@@ -202,7 +290,7 @@ class RegistrosResource(Resource):
             if not plantao_ativo:
                 return jsonify({'message': 'Plantão ativo necessário'}), 400
             
-            schema = RegistroSchema()
+            schema = registro_schema
             data = schema.load(request.get_json())
             
             # Criar registro
@@ -220,6 +308,113 @@ class RegistrosResource(Resource):
         except ValidationError as e:
             return jsonify({'message': 'Dados inválidos', 'errors': e.messages}), 400
 
+def criar_registros_em_lote(current_user, plantao, itens):
+    """Valida e grava vários registros na transação corrente (sem commit)
+
+    Retorna (resultados por índice, quantidade criada, quantidade com erro).
+    A auditoria sai do flush único (ver auditoria.py) e a notificação dos
+    gestores é gravada uma única vez para o lote.
+    """
+    schema = registros_schema
+    try:
+        dados = schema.load(itens)
+        erros = {}
+    except ValidationError as e:
+        dados, erros = e.valid_data, e.messages
+    
+    validos = [(indice, item) for indice, item in enumerate(dados) if indice not in erros]
+    # Colunas adiadas não informadas começam nulas: a auditoria não precisa recarregá-las
+    vazias = {p.key: None for p in Registro.__mapper__.column_attrs if p.deferred}
+    registros = [
+        Registro(plantao_id=plantao.id, criado_por=current_user.id, **{**vazias, **item})
+        for _, item in validos
+    ]
+    
+    if registros:
+        # Um único flush pelo ORM, porque os hooks de auditoria, log de alterações,
+        # busca, tags, eventos e cache dependem dele. Onde o banco devolve as
+        # chaves (PostgreSQL, SQLite, MariaDB com RETURNING) o SQLAlchemy junta
+        # os INSERTs num multi-row. No MySQL, sem RETURNING, sai um INSERT por
+        # linha (no máximo MAX_ITENS, na mesma transação) para ler cada id do
+        # lastrowid. Um insert().values([...]) pelo Core teria de deduzir os ids
+        # de LAST_INSERT_ID(), e a faixa só é contígua se nenhuma inserção em
+        # massa correr ao mesmo tempo (innodb_autoinc_lock_mode=2, padrão do
+        # MySQL 8); além disso, todos esses hooks teriam de ser refeitos à mão.
+        db.session.add_all(registros)
+        db.session.flush()
+        
+        # Uma notificação por gestor para o lote inteiro
+        gestores = Usuario.query.filter(
+            Usuario.perfis.contains(['gestor']),
+            Usuario.id != current_user.id,
+            Usuario.ativo == True
+        ).all()
+        
+        titulos = ', '.join(f'"{r.titulo}"' for r in registros[:3])
+        if len(registros) > 3:
+            titulos += f' e mais {len(registros) - 3}'
+        
+        db.session.add_all([NotificacaoSistema(
+            usuario_id=gestor.id,
+            tipo='novo_registro',
+            titulo='Novos Registros Criados' if len(registros) > 1 else 'Novo Registro Criado',
+            mensagem=f'Registro(s) {titulos} criado(s) por {current_user.nome}',
+            link=url_for('registros') if len(registros) > 1 else url_for('visualizar_registro', registro_id=registros[0].id)
+        ) for gestor in gestores])
+        db.session.flush()
+    
+    resultados = [None] * len(itens)
+    for indice, mensagens in erros.items():
+        resultados[indice] = {'indice': indice, 'status': 400, 'errors': mensagens}
+    
+    schema_item = registro_schema
+    for (indice, _), registro in zip(validos, registros):
+        resultados[indice] = {'indice': indice, 'status': 201, 'registro': schema_item.dump(registro)}
+    
+    return resultados, len(registros), len(erros)
+
+class RegistrosBulkResource(Resource):
+    """API para ingestão de vários registros em uma única transação"""
+    
+    MAX_ITENS = 200
+    
+    @token_required
+    def post(self, current_user):
+        """Cria vários registros; itens inválidos não impedem a criação dos válidos"""
+        data = request.get_json(silent=True)
+        itens = data.get('registros') if isinstance(data, dict) else data
+        
+        if not isinstance(itens, list) or not itens:
+            return jsonify({'message': 'Informe uma lista de registros'}), 400
+        
+        if len(itens) > self.MAX_ITENS:
+            return jsonify({'message': f'Máximo de {self.MAX_ITENS} registros por chamada'}), 413
+        
+        plantao_ativo = Plantao.query.filter_by(
+            usuario_id=current_user.id,
+            status='aberto'
+        ).first()
+        
+        if not plantao_ativo:
+            return jsonify({'message': 'Plantão ativo necessário'}), 400
+        
+        resultados, criados, erros = criar_registros_em_lote(current_user, plantao_ativo, itens)
+        if criados:
+            db.session.commit()
+        
+        if not criados:
+            codigo = 400
+        elif erros:
+            codigo = 207
+        else:
+            codigo = 201
+        
+        return jsonify({
+            'criados': criados,
+            'erros': erros,
+            'resultados': resultados
+        }), codigo
+
 class RegistroResource(Resource):
     """API para registro específico"""
     
@@ -232,11 +427,10 @@ class RegistroResource(Resource):
         if not current_user.tem_perfil('gestor') and registro.criador.id != current_user.id:
             return jsonify({'message': 'Acesso negado'}), 403
         
-        schema = RegistroSchema()
+        schema = registro_schema
         return jsonify(schema.dump(registro))
     
     @token_required
-    @invalidate_cache_pattern('api_registros*')
     def put(self, registro_id, current_user):
         """Atualiza registro"""
         registro = Registro.query.get_or_404(registro_id)
@@ -246,7 +440,7 @@ class RegistroResource(Resource):
             return jsonify({'message': 'Acesso negado'}), 403
         
         try:
-            schema = RegistroSchema()
+            schema = registro_schema
             data = schema.load(request.get_json(), partial=True)
             
             # Atualizar registro
@@ -267,19 +461,17 @@ class PendenciasResource(Resource):
     """API para gestão de pendências"""
     
     @token_required
-    @cached(timeout=300, key_prefix='api_pendencias')
+    @conditional_get(versao_pendencias, escopo_global)
+    @cached_response('pendencias', escopo_global, timeout=300)
     def get(self, current_user):
         """Lista pendências"""
-        pendencias = Pendencia.query.order_by(Pendencia.prazo.asc()).all()
-        schema = PendenciaSchema(many=True)
-        return jsonify(schema.dump(pendencias))
+        return listar_projecao(PROJECAO_PENDENCIAS, consulta_pendencias, ordem=Pendencia.prazo.asc())
     
     @token_required
-    @invalidate_cache_pattern('api_pendencias*')
     def post(self, current_user):
         """Cria nova pendência"""
         try:
-            schema = PendenciaSchema()
+            schema = pendencia_schema
             data = schema.load(request.get_json())
             
             # Criar pendência
@@ -296,8 +488,12 @@ class PendenciasResource(Resource):
 class DashboardResource(Resource):
     """API para dados do dashboard"""
     
+    # Uma camada de cache além do ETag: o micro-cache versionado coalesce o
+    # polling das abas por poucos segundos, sem sobreviver à janela de 60s dos
+    # campos relativos ao horário
     @token_required
-    @cached(timeout=300, key_prefix='api_dashboard')
+    @conditional_get(versao_dashboard, escopo_usuario, bucket=60)
+    @micro_cache(escopo_usuario, version=versao_dashboard)
     def get(self, current_user):
         """Obtém dados do dashboard"""
         is_gestor = current_user.tem_perfil('gestor')
@@ -351,21 +547,11 @@ class NotificacoesResource(Resource):
     """API para notificações"""
     
     @token_required
+    @conditional_get(versao_notificacoes, escopo_usuario)
     def get(self, current_user):
         """Lista notificações do usuário"""
-        notificacoes = NotificacaoSistema.query.filter_by(
-            usuario_id=current_user.id,
-            lida=False
-        ).order_by(NotificacaoSistema.criada_em.desc()).limit(10).all()
-        
-        return jsonify([{
-            'id': n.id,
-            'tipo': n.tipo,
-            'titulo': n.titulo,
-            'mensagem': n.mensagem,
-            'link': n.link,
-            'criada_em': n.criada_em.isoformat()
-        } for n in notificacoes])
+        total, notificacoes = caixa_entrada(current_user.id, 10)
+        return jsonify(notificacoes)
     
     @token_required
     def post(self, current_user):
@@ -395,18 +581,297 @@ class NotificacoesResource(Resource):
                 'lida_em': datetime.utcnow()
             })
             db.session.commit()
+            NotificationCache.clear(current_user.id)
+            publicar(canal_usuario(current_user.id), 'notificacao', {'recarregar': True})
             return jsonify({'message': 'Todas as notificações marcadas como lidas'})
         
         return jsonify({'message': 'Notificação não encontrada'}), 404
 
+class AlteracoesResource(Resource):
+    """API de sincronização incremental para clientes móveis/PWA"""
+    
+    @token_required
+    def get(self, current_user):
+        """Lista as alterações posteriores à sequência `after`"""
+        apos = request.args.get('after', 0, type=int)
+        limite = max(1, min(request.args.get('limit', 500, type=int), 1000))
+        
+        # Cliente atrasado além do log retido: recarregar listas completas
+        corte = corte_log_alteracoes()
+        if apos < corte:
+            ultimo = max(db.session.query(func.max(LogAlteracao.id)).scalar() or 0, corte)
+            return jsonify({
+                'reset': True,
+                'alteracoes': [],
+                'ultimo': ultimo,
+                'tem_mais': False
+            })
+        
+        posto_id = None
+        if not current_user.tem_perfil('gestor'):
+            plantao_ativo = Plantao.query.filter_by(
+                usuario_id=current_user.id,
+                status='aberto'
+            ).first()
+            posto_id = plantao_ativo.posto_id if plantao_ativo else None
+        
+        alteracoes = buscar_alteracoes(current_user, posto_id, apos, limite)
+        
+        return jsonify({
+            'reset': False,
+            'alteracoes': [{
+                'seq': a.id,
+                'entidade': a.entidade,
+                'id': a.entidade_id,
+                'operacao': a.operacao,
+                'em': a.criado_em.isoformat()
+            } for a in alteracoes],
+            'ultimo': alteracoes[-1].id if alteracoes else apos,
+            'tem_mais': len(alteracoes) == limite
+        })
+
+# Sincronização da fila offline do PWA (sessão do navegador, não JWT)
+SYNC_MAX = 100
+
+def sincronizar_status_pendencia(current_user, dados):
+    """Atualiza o status de uma pendência com as mesmas regras de atualizar_pendencia"""
+    pendencia = db.session.get(Pendencia, dados.get('id') or 0)
+    if not pendencia:
+        return 404, {'message': 'Pendência não encontrada'}
+    
+    if pendencia.responsavel_id != current_user.id and 'supervisor' not in current_user.perfis:
+        return 403, {'message': 'Sem permissão para atualizar esta pendência'}
+    
+    status = dados.get('status')
+    if status not in ['aberta', 'em_andamento', 'bloqueada', 'concluida']:
+        return 400, {'message': 'Status inválido'}
+    
+    pendencia.status = status
+    pendencia.motivo_bloqueio = dados.get('motivo_bloqueio') if status == 'bloqueada' else None
+    pendencia.atualizado_em = datetime.utcnow()
+    db.session.flush()
+    return 200, {'id': pendencia.id, 'status': pendencia.status}
+
+def sincronizar_notificacao_lida(current_user, dados):
+    """Marca uma notificação do usuário como lida"""
+    notificacao = NotificacaoSistema.query.filter_by(
+        id=dados.get('id'),
+        usuario_id=current_user.id
+    ).first()
+    if not notificacao:
+        return 404, {'message': 'Notificação não encontrada'}
+    
+    if not notificacao.lida:
+        notificacao.lida = True
+        notificacao.lida_em = datetime.utcnow()
+    return 200, {'id': notificacao.id, 'lida': True}
+
+OPERACOES_SINCRONIZACAO = {
+    'pendencia_status': sincronizar_status_pendencia,
+    'notificacao_lida': sincronizar_notificacao_lida
+}
+
+@api_bp.route('/sync', methods=['POST'])
+@login_required
+def sincronizar():
+    """Aplica em uma transação as operações enfileiradas offline pelo service worker
+
+    Cada operação traz uma chave de idempotência gerada no cliente. Chaves já
+    aplicadas devolvem a resposta gravada sem executar nada, então repetir o
+    envio após um timeout não duplica registros.
+    """
+    data = request.get_json(silent=True)
+    operacoes = data.get('operacoes') if isinstance(data, dict) else None
+    
+    if not isinstance(operacoes, list) or not operacoes:
+        return jsonify({'message': 'Informe uma lista de operações'}), 400
+    
+    if len(operacoes) > SYNC_MAX:
+        return jsonify({'message': f'Máximo de {SYNC_MAX} operações por sincronização'}), 413
+    
+    resultados = [None] * len(operacoes)
+    validas = []
+    for indice, operacao in enumerate(operacoes):
+        if (not isinstance(operacao, dict) or not chave_valida(operacao.get('chave'))
+                or operacao.get('tipo') not in ('registro', *OPERACOES_SINCRONIZACAO)):
+            resultados[indice] = {
+                'chave': operacao.get('chave') if isinstance(operacao, dict) else None,
+                'status': 400,
+                'corpo': {'message': 'Operação inválida'}
+            }
+        else:
+            validas.append(indice)
+    
+    registradas = respostas_registradas(current_user.id, {operacoes[i]['chave'] for i in validas})
+    primeira_ocorrencia = {}
+    novas_registro = []
+    novas = []
+    
+    for indice in validas:
+        operacao = operacoes[indice]
+        chave = operacao['chave']
+        
+        if chave in registradas:
+            status, corpo = registradas[chave]
+            resultados[indice] = {'chave': chave, 'status': status, 'corpo': corpo, 'repetida': True}
+            continue
+        
+        if chave in primeira_ocorrencia:
+            continue
+        primeira_ocorrencia[chave] = indice
+        novas.append(indice)
+        
+        if operacao['tipo'] == 'registro':
+            novas_registro.append(indice)
+        else:
+            status, corpo = OPERACOES_SINCRONIZACAO[operacao['tipo']](current_user, operacao.get('dados') or {})
+            resultados[indice] = {'chave': chave, 'status': status, 'corpo': corpo}
+    
+    if novas_registro:
+        plantao_ativo = Plantao.query.filter_by(
+            usuario_id=current_user.id,
+            status='aberto'
+        ).first()
+        
+        if not plantao_ativo:
+            for indice in novas_registro:
+                resultados[indice] = {
+                    'chave': operacoes[indice]['chave'],
+                    'status': 400,
+                    'corpo': {'message': 'Plantão ativo necessário'}
+                }
+        else:
+            itens = [operacoes[i].get('dados') for i in novas_registro]
+            lote, _, _ = criar_registros_em_lote(current_user, plantao_ativo, itens)
+            for indice, resultado in zip(novas_registro, lote):
+                resultados[indice] = {
+                    'chave': operacoes[indice]['chave'],
+                    'status': resultado['status'],
+                    'corpo': resultado.get('registro') or {'errors': resultado.get('errors')}
+                }
+    
+    for indice in novas:
+        resultado = resultados[indice]
+        registrar_resposta(current_user.id, resultado['chave'], f"sync:{operacoes[indice]['tipo']}",
+                           resultado['status'], resultado['corpo'])
+    
+    # Chaves repetidas dentro do mesmo envio recebem o resultado da primeira
+    for indice in validas:
+        if resultados[indice] is None:
+            resultado = resultados[primeira_ocorrencia[operacoes[indice]['chave']]]
+            resultados[indice] = dict(resultado, repetida=True)
+    
+    try:
+        db.session.commit()
+    except IntegrityError:
+        # Outro envio concorrente aplicou alguma das chaves: o cliente reenvia
+        # e recebe as respostas gravadas
+        db.session.rollback()
+        return jsonify({'message': 'Sincronização concorrente, tente novamente'}), 409
+    
+    return jsonify({'resultados': resultados})
+
+# Limite padrão de sub-requisições por chamada a /batch (app.config['API_BATCH_MAX'])
+BATCH_MAX = 20
+BATCH_METODOS = {'GET', 'POST', 'PUT', 'DELETE'}
+BATCH_EXCLUIDOS = {'api.batchresource', 'api.authresource'}
+
+def executar_subrequisicao(item):
+    """Executa uma sub-requisição do batch e devolve (status, headers, corpo)
+
+    Roda no mesmo contexto de aplicação da requisição externa, portanto com
+    a mesma sessão do banco e o mesmo usuário autenticado (g.api_usuario).
+    Os hooks before/after_request rodam como numa requisição comum: o modo
+    manutenção recusa escritas e o Idempotency-Key de cada item é honrado.
+    """
+    if not isinstance(item, dict) or not isinstance(item.get('path'), str):
+        return 400, {}, {'message': 'Sub-requisição inválida: "path" obrigatório'}
+    
+    metodo = str(item.get('method', 'GET')).upper()
+    if metodo not in BATCH_METODOS:
+        return 405, {}, {'message': f'Método {metodo} não suportado em batch'}
+    
+    caminho = item['path']
+    if not caminho.startswith(api_bp.url_prefix):
+        caminho = api_bp.url_prefix + '/' + caminho.lstrip('/')
+    
+    cabecalhos = {k: v for k, v in (item.get('headers') or {}).items() if k.lower() != 'authorization'}
+    
+    # `g` é compartilhado com a requisição externa: a chave de idempotência
+    # dela fica de lado enquanto os hooks tratam a da sub-requisição
+    idempotencia_externa = g.pop('idempotencia', None)
+    try:
+        with current_app.test_request_context(caminho, method=metodo, json=item.get('body'), headers=cabecalhos):
+            if request.routing_exception is not None:
+                erro = request.routing_exception
+                return getattr(erro, 'code', 404), {}, {'message': getattr(erro, 'description', str(erro))}
+            
+            endpoint = request.url_rule.endpoint
+            if not endpoint.startswith('api.') or endpoint in BATCH_EXCLUIDOS:
+                return 400, {}, {'message': 'Recurso não disponível em batch'}
+            
+            try:
+                resultado = current_app.preprocess_request()
+                if resultado is None:
+                    resultado = current_app.view_functions[endpoint](**request.view_args)
+                response = current_app.process_response(current_app.make_response(resultado))
+            except HTTPException as e:
+                return e.code, {}, {'message': e.description}
+            except Exception:
+                db.session.rollback()
+                current_app.logger.exception('Erro em sub-requisição de batch: %s %s', metodo, caminho)
+                return 500, {}, {'message': 'Erro interno'}
+    finally:
+        if idempotencia_externa is not None:
+            g.idempotencia = idempotencia_externa
+    
+    headers = {k: v for k, v in response.headers.items()
+               if k.lower() in ('etag', 'cache-control', 'x-cache', 'location', 'retry-after', 'idempotent-replayed')}
+    if response.is_json:
+        corpo = response.get_json(silent=True)
+    else:
+        corpo = response.get_data(as_text=True) or None
+    return response.status_code, headers, corpo
+
+class BatchResource(Resource):
+    """API para várias requisições em uma única troca HTTP"""
+    
+    @token_required
+    def post(self, current_user):
+        """Executa as sub-requisições em ordem e devolve status e corpo de cada uma"""
+        data = request.get_json(silent=True)
+        itens = data.get('requests') if isinstance(data, dict) else data
+        
+        if not isinstance(itens, list) or not itens:
+            return jsonify({'message': 'Informe uma lista de requisições'}), 400
+        
+        limite = current_app.config.get('API_BATCH_MAX', BATCH_MAX)
+        if len(itens) > limite:
+            return jsonify({'message': f'Máximo de {limite} requisições por batch'}), 413
+        
+        respostas = []
+        for indice, item in enumerate(itens):
+            status, headers, corpo = executar_subrequisicao(item)
+            respostas.append({
+                'id': item.get('id', indice) if isinstance(item, dict) else indice,
+                'status': status,
+                'headers': headers,
+                'body': corpo
+            })
+        
+        return jsonify({'responses': respostas})
+
 # Registrar recursos na API
 api.add_resource(AuthResource, '/auth/login')
 api.add_resource(UsuariosResource, '/usuarios')
 api.add_resource(RegistrosResource, '/registros')
+api.add_resource(RegistrosBulkResource, '/registros/bulk')
 api.add_resource(RegistroResource, '/registros/<int:registro_id>')
 api.add_resource(PendenciasResource, '/pendencias')
 api.add_resource(DashboardResource, '/dashboard')
 api.add_resource(NotificacoesResource, '/notificacoes')
+api.add_resource(AlteracoesResource, '/changes')
+api.add_resource(BatchResource, '/batch')
 
 # Endpoint de health check
 @api_bp.route('/health')
@@ -439,17 +904,18 @@ def api_docs():
                 'POST /api/v1/auth/login': 'Autenticação e geração de token'
             },
             'usuarios': {
-                'GET /api/v1/usuarios': 'Lista usuários (gestores)',
+                'GET /api/v1/usuarios?fields=<campos>': 'Lista usuários (gestores, campos opcionais)',
                 'POST /api/v1/usuarios': 'Cria usuário (gestores)'
             },
             'registros': {
-                'GET /api/v1/registros': 'Lista registros',
+                'GET /api/v1/registros?fields=<campos>': 'Lista registros (campos opcionais)',
                 'POST /api/v1/registros': 'Cria registro',
+                'POST /api/v1/registros/bulk': 'Cria vários registros em uma transação (resultado por item)',
                 'GET /api/v1/registros/<id>': 'Obtém registro específico',
                 'PUT /api/v1/registros/<id>': 'Atualiza registro'
             },
             'pendencias': {
-                'GET /api/v1/pendencias': 'Lista pendências',
+                'GET /api/v1/pendencias?fields=<campos>': 'Lista pendências (campos opcionais)',
                 'POST /api/v1/pendencias': 'Cria pendência'
             },
             'dashboard': {
@@ -458,6 +924,15 @@ def api_docs():
             'notificacoes': {
                 'GET /api/v1/notificacoes': 'Lista notificações',
                 'POST /api/v1/notificacoes': 'Marca notificações como lidas'
+            },
+            'sincronizacao': {
+                'GET /api/v1/changes?after=<seq>&limit=<n>': 'Alterações desde a última sincronização'
+            },
+            'sync': {
+                'POST /api/v1/sync': 'Aplica a fila offline do PWA (sessão; chave de idempotência por operação)'
+            },
+            'batch': {
+                'POST /api/v1/batch': 'Executa várias requisições (method, path, body, headers) em uma chamada'
             }
         },
         'authentication': 'Bearer token no header Authorization',
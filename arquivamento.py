@@ -0,0 +1,213 @@
+from sqlalchemy import select, func, insert, exists, or_
+from collections import namedtuple
+from datetime import datetime, timedelta
+import gzip
+import hashlib
+import json
+import os
+import time
+from app import app, db
+from models import Auditoria, CheckpointAuditoria, ArquivoAuditoria, ObjetoArquivoAuditoria
+from integridade import COLUNAS, hash_folha, raiz_merkle
+
+# Linha lida de um arquivo, com os mesmos atributos das linhas do banco
+LinhaArquivada = namedtuple('LinhaArquivada', [coluna.key for coluna in COLUNAS])
+
+def diretorio_arquivo():
+    return app.config['AUDITORIA_ARQUIVO_DIR']
+
+def _caminho_absoluto(caminho):
+    return os.path.join(diretorio_arquivo(), caminho)
+
+def _linha_json(linha):
+    dados = linha._asdict()
+    dados['timestamp'] = linha.timestamp.isoformat() if linha.timestamp else None
+    return json.dumps(dados, separators=(',', ':'), ensure_ascii=False)
+
+def linhas_arquivo(caminho):
+    """Linhas de um arquivo de auditoria, em streaming"""
+    with gzip.open(_caminho_absoluto(caminho), 'rt', encoding='utf-8') as arquivo:
+        for texto in arquivo:
+            dados = json.loads(texto)
+            if dados['timestamp']:
+                dados['timestamp'] = datetime.fromisoformat(dados['timestamp'])
+            yield LinhaArquivada(**dados)
+
+def _sha256(caminho):
+    digest = hashlib.sha256()
+    with open(caminho, 'rb') as arquivo:
+        for bloco in iter(lambda: arquivo.read(1024 * 1024), b''):
+            digest.update(bloco)
+    return digest.hexdigest()
+
+def _escrever_bloco(checkpoint, linhas):
+    """Grava o bloco em AAAA/MM/auditoria_<primeira>_<ultima posição>.jsonl.gz e devolve o manifesto"""
+    inicio = min(linha.timestamp for linha in linhas)
+    caminho = os.path.join(
+        inicio.strftime('%Y'), inicio.strftime('%m'),
+        f'auditoria_{checkpoint.primeira_posicao}_{checkpoint.ultima_posicao}.jsonl.gz'
+    )
+    destino = _caminho_absoluto(caminho)
+    os.makedirs(os.path.dirname(destino), exist_ok=True)
+    
+    # Escrita atômica: um arquivo parcial nunca fica com o nome final
+    temporario = destino + '.tmp'
+    with open(temporario, 'wb') as bruto, gzip.GzipFile(fileobj=bruto, mode='wb', mtime=0) as arquivo:
+        for linha in linhas:
+            arquivo.write(_linha_json(linha).encode('utf-8') + b'\n')
+    os.replace(temporario, destino)
+    
+    return ArquivoAuditoria(
+        checkpoint_id=checkpoint.id,
+        caminho=caminho,
+        primeiro_id=min(linha.id for linha in linhas),
+        ultimo_id=max(linha.id for linha in linhas),
+        quantidade=len(linhas),
+        inicio=inicio,
+        fim=max(linha.timestamp for linha in linhas),
+        sha256=_sha256(destino),
+        bytes=os.path.getsize(destino)
+    )
+
+def verificar_arquivo(arquivo, checkpoint):
+    """Relê o arquivo e confere checksum, quantidade, encadeamento final e raiz Merkle"""
+    destino = _caminho_absoluto(arquivo.caminho)
+    if not os.path.exists(destino) or _sha256(destino) != arquivo.sha256:
+        return False
+    
+    linhas = list(linhas_arquivo(arquivo.caminho))
+    return (
+        len(linhas) == checkpoint.quantidade
+        and linhas[-1].assinatura_digital == checkpoint.hash_final
+        and raiz_merkle(hash_folha(linha) for linha in linhas) == checkpoint.raiz_merkle
+    )
+
+def _objetos(linhas):
+    """{objeto: [ids]} presentes no bloco"""
+    objetos = {}
+    for linha in linhas:
+        objetos.setdefault(linha.objeto, set()).add(linha.objeto_id)
+    return {objeto: sorted(ids) for objeto, ids in objetos.items()}
+
+def _registrar_manifesto(arquivo, objetos):
+    """Acrescenta a entrada ao manifest.jsonl do diretório (recuperação sem o banco)"""
+    with open(_caminho_absoluto('manifest.jsonl'), 'a', encoding='utf-8') as manifesto:
+        manifesto.write(json.dumps({
+            'caminho': arquivo.caminho,
+            'checkpoint_id': arquivo.checkpoint_id,
+            'primeiro_id': arquivo.primeiro_id,
+            'ultimo_id': arquivo.ultimo_id,
+            'quantidade': arquivo.quantidade,
+            'inicio': arquivo.inicio.isoformat(),
+            'fim': arquivo.fim.isoformat(),
+            'sha256': arquivo.sha256,
+            'bytes': arquivo.bytes,
+            'objetos': objetos
+        }) + '\n')
+
+def arquivar_auditoria(dias=90, max_blocos=None, pausa=0.1):
+    """Move para arquivos a auditoria mais antiga que `dias`, um bloco por vez
+    
+    Só blocos inteiros com checkpoint (ver integridade.py) são arquivados, o
+    que mantém a cadeia verificável: o arquivo é conferido contra a raiz
+    Merkle do checkpoint antes de as linhas serem removidas. Cada bloco é
+    uma transação curta limitada pela faixa de posições da cadeia, com `pausa` segundos
+    entre blocos. Retorna (blocos arquivados, linhas removidas).
+    """
+    limite = datetime.utcnow() - timedelta(days=dias)
+    arquivados = select(ArquivoAuditoria.checkpoint_id)
+    blocos = removidas = 0
+    
+    while max_blocos is None or blocos < max_blocos:
+        checkpoint = CheckpointAuditoria.query.filter(
+            CheckpointAuditoria.id.notin_(arquivados)
+        ).order_by(CheckpointAuditoria.ultima_posicao).first()
+        if not checkpoint:
+            break
+        
+        faixa = (Auditoria.posicao.between(checkpoint.primeira_posicao, checkpoint.ultima_posicao),)
+        mais_recente = db.session.execute(select(func.max(Auditoria.timestamp)).where(*faixa)).scalar()
+        if mais_recente is None or mais_recente >= limite:
+            break
+        
+        linhas = [LinhaArquivada(*linha) for linha in db.session.execute(
+            select(*COLUNAS).where(*faixa).order_by(Auditoria.posicao)
+        )]
+        arquivo = _escrever_bloco(checkpoint, linhas)
+        if not verificar_arquivo(arquivo, checkpoint):
+            os.remove(_caminho_absoluto(arquivo.caminho))
+            raise RuntimeError(f'Arquivo do checkpoint {checkpoint.id} não confere; bloco mantido no banco')
+        
+        objetos = _objetos(linhas)
+        db.session.add(arquivo)
+        db.session.flush()
+        db.session.execute(insert(ObjetoArquivoAuditoria), [
+            {'arquivo_id': arquivo.id, 'objeto': objeto, 'objeto_id': objeto_id}
+            for objeto, ids in objetos.items() for objeto_id in ids
+        ])
+        removidas += Auditoria.query.filter(*faixa).delete(synchronize_session=False)
+        db.session.commit()
+        _registrar_manifesto(arquivo, objetos)
+        blocos += 1
+        time.sleep(pausa)
+    
+    return blocos, removidas
+
+def consultar_auditoria(objeto=None, objeto_id=None, de=None, ate=None, limite=500):
+    """Linhas de auditoria (mais recentes primeiro) do banco e dos períodos arquivados
+    
+    Os arquivos só são lidos quando o banco não completa o `limite` e o
+    período pedido alcança blocos arquivados; com `objeto`/`objeto_id`, só
+    os que o índice ObjetoArquivoAuditoria aponta (arquivos anteriores ao
+    índice, sem entradas nele, continuam sendo lidos). `limite=None` devolve tudo.
+    """
+    filtros = []
+    if objeto:
+        filtros.append(Auditoria.objeto == objeto)
+    if objeto_id is not None:
+        filtros.append(Auditoria.objeto_id == objeto_id)
+    if de:
+        filtros.append(Auditoria.timestamp >= de)
+    if ate:
+        filtros.append(Auditoria.timestamp < ate)
+    
+    consulta = select(*COLUNAS).where(*filtros).order_by(Auditoria.id.desc())
+    if limite is not None:
+        consulta = consulta.limit(limite)
+    resultado = [LinhaArquivada(*linha) for linha in db.session.execute(consulta)]
+    
+    arquivos = ArquivoAuditoria.query
+    if de:
+        arquivos = arquivos.filter(ArquivoAuditoria.fim >= de)
+    if ate:
+        arquivos = arquivos.filter(ArquivoAuditoria.inicio < ate)
+    if objeto or objeto_id is not None:
+        indice = []
+        if objeto:
+            indice.append(ObjetoArquivoAuditoria.objeto == objeto)
+        if objeto_id is not None:
+            indice.append(ObjetoArquivoAuditoria.objeto_id == objeto_id)
+        arquivos = arquivos.filter(or_(
+            ArquivoAuditoria.id.in_(select(ObjetoArquivoAuditoria.arquivo_id).where(*indice)),
+            ~exists().where(ObjetoArquivoAuditoria.arquivo_id == ArquivoAuditoria.id)
+        ))
+    
+    # A cadeia segue a ordem de confirmação, não o id: um arquivo pode ter ids
+    # maiores que linhas ainda no banco. Com os arquivos pelo maior id, a
+    # leitura para quando nenhum deles pode entrar entre os `limite` primeiros
+    for arquivo in arquivos.order_by(ArquivoAuditoria.ultimo_id.desc()):
+        if limite is not None and len(resultado) >= limite:
+            resultado.sort(key=lambda linha: linha.id, reverse=True)
+            if arquivo.ultimo_id < resultado[limite - 1].id:
+                break
+        encontradas = [
+            linha for linha in linhas_arquivo(arquivo.caminho)
+            if (not objeto or linha.objeto == objeto)
+            and (objeto_id is None or linha.objeto_id == objeto_id)
+            and (not de or linha.timestamp >= de)
+            and (not ate or linha.timestamp < ate)
+        ]
+        resultado.extend(encontradas)
+    
+    resultado.sort(key=lambda linha: linha.id, reverse=True)
+    return resultado[:limite] if limite is not None else resultado
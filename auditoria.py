@@ -0,0 +1,403 @@
+from sqlalchemy import event, select, func, and_, or_, inspect
+from sqlalchemy.orm.attributes import set_committed_value
+from flask import g, has_request_context
+from flask_login import current_user
+from datetime import datetime
+from difflib import SequenceMatcher
+from os.path import commonprefix
+import json
+from app import db
+from models import Registro, Pendencia, Plantao, Auditoria
+from routes import serializar_objeto
+
+# Entidades auditadas e o nome da ação registrada para criar/atualizar/deletar
+ACOES = {
+    Registro: ('registro', {'criar': 'criar', 'atualizar': 'editar', 'deletar': 'deletar'}),
+    Pendencia: ('pendencia', {'criar': 'criar', 'atualizar': 'atualizar', 'deletar': 'deletar'}),
+    Plantao: ('plantao', {'criar': 'iniciar', 'atualizar': 'atualizar', 'deletar': 'deletar'})
+}
+
+# A cada SNAPSHOT_INTERVALO versões o estado completo é gravado de novo,
+# limitando quantos deltas a reconstrução precisa aplicar
+SNAPSHOT_INTERVALO = 20
+# Textos a partir deste tamanho guardam só os trechos alterados
+LIMITE_TEXTO = 200
+PATCH = '$patch'
+
+def _valor_json(valor):
+    return valor.isoformat() if isinstance(valor, datetime) else valor
+
+def _tamanho(valor):
+    return len(json.dumps(valor, ensure_ascii=False))
+
+def diff_texto(antes, depois):
+    """Trechos alterados [[início, fim, novo trecho], ...] que levam `antes` a `depois`"""
+    # Prefixo e sufixo comuns são descartados antes do SequenceMatcher: edições
+    # pontuais viram um único trecho e o custo quadrático fica só no miolo
+    inicio = len(commonprefix([antes, depois]))
+    limite = min(len(antes), len(depois)) - inicio
+    fim = len(commonprefix([antes[::-1][:limite], depois[::-1][:limite]]))
+    miolo_antes = antes[inicio:len(antes) - fim]
+    miolo_depois = depois[inicio:len(depois) - fim]
+    return [
+        [inicio + i1, inicio + i2, miolo_depois[j1:j2]]
+        for operacao, i1, i2, j1, j2 in SequenceMatcher(None, miolo_antes, miolo_depois).get_opcodes()
+        if operacao != 'equal'
+    ]
+
+def aplicar_diff_texto(texto, trechos):
+    # De trás para frente, para que os índices dos trechos anteriores continuem válidos
+    for inicio, fim, novo in reversed(trechos):
+        texto = texto[:inicio] + novo + texto[fim:]
+    return texto
+
+def _delta(antes, depois):
+    """{campo: valor novo}, com textos longos substituídos por {'$patch': trechos}"""
+    delta = {}
+    for nome, valor in depois.items():
+        anterior = antes.get(nome)
+        if (isinstance(valor, str) and isinstance(anterior, str)
+                and len(valor) >= LIMITE_TEXTO and len(anterior) >= LIMITE_TEXTO):
+            trechos = diff_texto(anterior, valor)
+            if _tamanho(trechos) < _tamanho(valor):
+                valor = {PATCH: trechos}
+        delta[nome] = valor
+    return delta
+
+def aplicar_delta(estado, delta):
+    for nome, valor in delta.items():
+        if isinstance(valor, dict) and PATCH in valor:
+            valor = aplicar_diff_texto(estado.get(nome) or '', valor[PATCH])
+        if valor is None:
+            estado.pop(nome, None)
+        else:
+            estado[nome] = valor
+    return estado
+
+def _acao(obj, operacao, depois=None):
+    objeto, acoes = ACOES[type(obj)]
+    if isinstance(obj, Plantao) and operacao == 'atualizar' and (depois or {}).get('status') == 'encerrado':
+        return objeto, 'encerrar'
+    return objeto, acoes[operacao]
+
+def _autor(session, obj):
+    """Usuário responsável pela gravação
+    
+    Na ordem: autor explícito da sessão (tarefas em background), usuário do
+    token da API, usuário da sessão web e, por fim, o autor gravado no objeto.
+    """
+    autor = session.info.get('autor_auditoria')
+    if autor:
+        return autor
+    
+    if has_request_context():
+        usuario = g.get('api_usuario')
+        if usuario is not None:
+            return usuario.id
+        if current_user.is_authenticated:
+            return current_user.id
+    
+    for campo in ('atualizado_por', 'criado_por', 'usuario_id', 'responsavel_id'):
+        valor = getattr(obj, campo, None)
+        if valor:
+            return valor
+    return None
+
+def _diferencas(obj):
+    """(antes, depois) apenas com as colunas alteradas desde o carregamento"""
+    estado = inspect(obj)
+    tabela = estado.mapper.local_table
+    antes, depois, sem_valor_anterior = {}, {}, []
+    for coluna in tabela.columns:
+        historico = estado.attrs[estado.mapper.get_property_by_column(coluna).key].history
+        if not historico.added:
+            continue
+        
+        depois[coluna.name] = _valor_json(historico.added[0])
+        if historico.deleted:
+            antes[coluna.name] = _valor_json(historico.deleted[0])
+        else:
+            # Coluna alterada sem ter sido carregada (ex.: adiada): lê o valor ainda no banco
+            sem_valor_anterior.append(coluna)
+    
+    if sem_valor_anterior:
+        linha = estado.session.connection().execute(
+            select(*sem_valor_anterior).where(tabela.c.id == obj.id)
+        ).first()
+        if linha is not None:
+            for coluna, valor in zip(sem_valor_anterior, linha):
+                antes[coluna.name] = _valor_json(valor)
+    
+    # Atribuições que mantêm o valor não são alterações
+    for nome in [nome for nome in depois if nome in antes and antes[nome] == depois[nome]]:
+        del antes[nome], depois[nome]
+    return antes, depois
+
+def _valores_automaticos(obj):
+    """Colunas com onupdate, preenchidas só durante o flush (ex.: atualizado_em)"""
+    estado = inspect(obj)
+    return {
+        coluna.name: _valor_json(estado.dict[propriedade.key])
+        for coluna in estado.mapper.local_table.columns if coluna.onupdate is not None
+        for propriedade in (estado.mapper.get_property_by_column(coluna),)
+        if propriedade.key in estado.dict
+    }
+
+def _versoes_atuais(connection, objetos):
+    """{(objeto, objeto_id): última versão auditada} em uma única consulta
+    
+    As linhas das entidades são travadas antes da leitura, então alterações
+    concorrentes do mesmo objeto esperam o commit da anterior em vez de
+    repetir a versão; a restrição única uq_auditoria_versao barra o resto.
+    """
+    por_tipo = {}
+    for obj in objetos:
+        por_tipo.setdefault(type(obj), set()).add(obj.id)
+    if not por_tipo:
+        return {}
+    
+    for tipo, ids in por_tipo.items():
+        connection.execute(select(tipo.id).where(tipo.id.in_(ids)).with_for_update())
+    
+    consulta = (
+        select(Auditoria.objeto, Auditoria.objeto_id, func.max(Auditoria.versao))
+        .where(or_(*(
+            and_(Auditoria.objeto == ACOES[tipo][0], Auditoria.objeto_id.in_(ids))
+            for tipo, ids in por_tipo.items()
+        )))
+        .group_by(Auditoria.objeto, Auditoria.objeto_id)
+    )
+    # No REPEATABLE READ do MySQL uma leitura comum ainda veria o snapshot
+    # antigo; o PostgreSQL não aceita FOR UPDATE com agregação, mas no READ
+    # COMMITTED já enxerga o commit que liberou a trava
+    if connection.dialect.name == 'mysql':
+        consulta = consulta.with_for_update()
+    
+    return {
+        (objeto, objeto_id): versao
+        for objeto, objeto_id, versao in connection.execute(consulta)
+    }
+
+def _estado(obj):
+    """Estado completo do objeto, sem o contador de versões da própria auditoria"""
+    estado = serializar_objeto(obj)
+    estado.pop('versao_auditoria', None)
+    return estado
+
+def _ler_contadores(connection, objetos):
+    """Carrega o contador dos objetos cujo UPDATE não o devolveu (sem RETURNING)"""
+    por_tipo = {}
+    for obj in objetos:
+        if 'versao_auditoria' not in inspect(obj).dict:
+            por_tipo.setdefault(type(obj), {})[obj.id] = obj
+    for tipo, objs in por_tipo.items():
+        for obj_id, versao in connection.execute(
+            select(tipo.id, tipo.versao_auditoria).where(tipo.id.in_(objs))
+        ):
+            set_committed_value(objs[obj_id], 'versao_auditoria', versao)
+
+def _reaproveita_ids(connection):
+    """Bancos que podem reaproveitar o id de um objeto removido (SQLite, MySQL < 8 após reiniciar)"""
+    dialeto = connection.dialect
+    return dialeto.name == 'sqlite' or (dialeto.name == 'mysql' and (dialeto.server_version_info or (8,)) < (8,))
+
+def _continuar_sequencia(connection, objetos):
+    """Leva o contador de objetos com histórico anterior a ele até a versão seguinte
+    
+    Linhas gravadas antes do contador (versao_auditoria 0) e ids reaproveitados
+    chegam aqui com contador 1. Só estes casos pagam a leitura de MAX(versao).
+    """
+    versoes = _versoes_atuais(connection, objetos)
+    for obj in objetos:
+        ultima = versoes.get((ACOES[type(obj)][0], obj.id))
+        if ultima is None:
+            continue
+        tabela = type(obj).__table__
+        # Repete as colunas com onupdate para que não mudem de novo
+        connection.execute(
+            tabela.update().where(tabela.c.id == obj.id).values(
+                versao_auditoria=ultima + 1,
+                **{coluna.name: coluna for coluna in tabela.columns if coluna.onupdate is not None}
+            )
+        )
+        set_committed_value(obj, 'versao_auditoria', ultima + 1)
+
+def registrar_auditoria(session):
+    """Grava Auditoria na mesma transação de cada alteração das entidades auditadas
+    
+    Alterações e exclusões são capturadas no before_flush (o histórico dos
+    atributos e a linha antiga ainda estão disponíveis); criações no
+    after_flush, quando o id já existe. As linhas são inseridas pela conexão
+    do flush, então um rollback também descarta a auditoria. Updates e deletes
+    em massa não passam por aqui.
+    
+    Criações e uma a cada SNAPSHOT_INTERVALO alterações gravam o estado
+    completo (snapshot); as demais só o delta dos campos alterados.
+    
+    A versão vem do contador versao_auditoria da própria linha, incrementado
+    no UPDATE que o flush já emite; sem RETURNING o valor é relido pela chave
+    primária, em uma consulta por entidade.
+    """
+    info_key = 'auditoria_pendente'
+    
+    @event.listens_for(session, 'before_flush')
+    def before_flush(session, flush_context, instances):
+        pendentes = session.info.setdefault(info_key, [])
+        alterados = [
+            obj for obj in session.dirty
+            if type(obj) in ACOES and session.is_modified(obj)
+        ]
+        removidos = [obj for obj in session.deleted if type(obj) in ACOES]
+        
+        for obj in alterados:
+            antes, depois = _diferencas(obj)
+            if not depois:
+                continue
+            # O contador sobe no próprio UPDATE do flush: a trava da linha
+            # serializa alterações concorrentes e a versão é lida no after_flush
+            obj.versao_auditoria = type(obj).versao_auditoria + 1
+            pendentes.append((obj, 'atualizar', None, _delta(antes, depois), None, depois))
+        
+        # Exclusões não têm UPDATE onde subir o contador: travam a linha e leem a última versão
+        versoes = _versoes_atuais(session.connection(), removidos)
+        for obj in removidos:
+            versao = (versoes.get((ACOES[type(obj)][0], obj.id)) or 0) + 1
+            pendentes.append((obj, 'deletar', _estado(obj), None, versao, None))
+    
+    @event.listens_for(session, 'after_flush')
+    def after_flush(session, flush_context):
+        pendentes = session.info.pop(info_key, [])
+        connection = session.connection()
+        alterados = [obj for obj, operacao, *_ in pendentes if operacao == 'atualizar']
+        criados = [obj for obj in session.new if type(obj) in ACOES]
+        _ler_contadores(connection, alterados)
+        # Contador 1 depois de um UPDATE: linha anterior ao contador
+        _continuar_sequencia(connection, [obj for obj in alterados if obj.versao_auditoria == 1])
+        if _reaproveita_ids(connection):
+            _continuar_sequencia(connection, criados)
+        pendentes.extend((obj, 'criar', None, None, None, None) for obj in criados)
+        
+        agora = datetime.utcnow()
+        linhas = []
+        for obj, operacao, antes, depois, versao, alteracoes in pendentes:
+            autor_id = _autor(session, obj)
+            if autor_id is None:
+                # Nenhuma alteração fica sem auditoria: tarefas em background
+                # gravam em nome de Usuario.sistema() (ver celery_app.py)
+                raise RuntimeError(f'Alteração de {ACOES[type(obj)][0]} {obj.id} sem autor para a auditoria')
+            snapshot = False
+            if operacao != 'deletar':
+                versao = obj.versao_auditoria
+                # Criações, objetos sem histórico anterior ao contador e uma a
+                # cada SNAPSHOT_INTERVALO versões gravam o estado completo
+                if versao == 1 or versao % SNAPSHOT_INTERVALO == 0:
+                    depois, snapshot = _estado(obj), True
+                else:
+                    depois.update(_valores_automaticos(obj))
+            objeto, acao = _acao(obj, operacao, alteracoes)
+            linhas.append({
+                'objeto': objeto,
+                'objeto_id': obj.id,
+                'acao': acao,
+                'antes': antes,
+                'depois': depois,
+                'versao': versao,
+                'snapshot': snapshot,
+                'autor_id': autor_id,
+                'timestamp': agora
+            })
+        
+        if linhas:
+            connection.execute(Auditoria.__table__.insert(), linhas)
+    
+    @event.listens_for(session, 'after_rollback')
+    def after_rollback(session):
+        session.info.pop(info_key, None)
+
+def _reconstruir_com_arquivo(objeto, objeto_id, ate_id, ate_timestamp):
+    """Reconstrução quando o snapshot de partida já foi arquivado"""
+    from arquivamento import consultar_auditoria
+    
+    linhas = [
+        linha for linha in reversed(consultar_auditoria(objeto, objeto_id, limite=None))
+        if (ate_id is None or linha.id <= ate_id)
+        and (ate_timestamp is None or linha.timestamp <= ate_timestamp)
+    ]
+    inicio = next((i for i in range(len(linhas) - 1, -1, -1) if linhas[i].snapshot), None)
+    if inicio is None:
+        return None
+    
+    estado = dict(linhas[inicio].depois)
+    for linha in linhas[inicio + 1:]:
+        if linha.depois:
+            aplicar_delta(estado, linha.depois)
+    return estado
+
+def reconstruir_versao(objeto, objeto_id, ate_id=None, ate_timestamp=None):
+    """Estado de um objeto auditado após a entrada `ate_id` (ou no instante `ate_timestamp`)
+    
+    Parte do último snapshot anterior e aplica os deltas seguintes, na ordem
+    de gravação, recorrendo aos arquivos quando o snapshot já foi arquivado.
+    Retorna None se não houver snapshot até o ponto pedido.
+    """
+    limites = [Auditoria.objeto == objeto, Auditoria.objeto_id == objeto_id]
+    if ate_id is not None:
+        limites.append(Auditoria.id <= ate_id)
+    if ate_timestamp is not None:
+        limites.append(Auditoria.timestamp <= ate_timestamp)
+    
+    base = db.session.execute(
+        select(Auditoria.id, Auditoria.depois)
+        .where(*limites, Auditoria.snapshot.is_(True))
+        .order_by(Auditoria.id.desc()).limit(1)
+    ).first()
+    if base is None:
+        return _reconstruir_com_arquivo(objeto, objeto_id, ate_id, ate_timestamp)
+    
+    estado = dict(base.depois)
+    deltas = db.session.execute(
+        select(Auditoria.depois)
+        .where(*limites, Auditoria.id > base.id, Auditoria.depois.isnot(None))
+        .order_by(Auditoria.id)
+    ).scalars()
+    for delta in deltas:
+        # Linhas gravadas antes de none_as_null guardam o JSON 'null', que passa pelo IS NOT NULL
+        if delta:
+            aplicar_delta(estado, delta)
+    return estado
+
+def reconstruir_linhas(linhas):
+    """{id da linha: estado do objeto após ela} para linhas de consultar_auditoria
+    
+    Cada objeto é reconstruído uma vez, na linha mais antiga pedida (via
+    reconstruir_versao, que recorre aos arquivos); as seguintes aplicam os
+    deltas em ordem, inclusive os intermediários que o filtro deixou de fora.
+    Exclusões mantêm o último estado antes delas.
+    """
+    grupos = {}
+    for linha in linhas:
+        grupos.setdefault((linha.objeto, linha.objeto_id), []).append(linha)
+    
+    estados = {}
+    for (objeto, objeto_id), grupo in grupos.items():
+        grupo.sort(key=lambda linha: linha.id)
+        primeira, ultima = grupo[0], grupo[-1]
+        estado = reconstruir_versao(objeto, objeto_id, ate_id=primeira.id)
+        estados[primeira.id] = estado
+        
+        seguintes = {linha.id: linha for linha in grupo[1:]}
+        if len(grupo) > 1:
+            seguintes.update((linha.id, linha) for linha in db.session.execute(
+                select(Auditoria.id, Auditoria.depois, Auditoria.snapshot)
+                .where(Auditoria.objeto == objeto, Auditoria.objeto_id == objeto_id,
+                       Auditoria.id > primeira.id, Auditoria.id <= ultima.id)
+            ))
+        for id_linha in sorted(seguintes):
+            linha = seguintes[id_linha]
+            if linha.snapshot and linha.depois:
+                estado = dict(linha.depois)
+            elif linha.depois and estado is not None:
+                estado = aplicar_delta(dict(estado), linha.depois)
+            estados[id_linha] = estado
+    
+    return estados
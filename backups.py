@@ -0,0 +1,534 @@
+from sqlalchemy import create_engine, select, tuple_, func, text, literal, Table, MetaData, Column
+from sqlalchemy.sql import sqltypes
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
+from datetime import datetime, date, time as hora
+from decimal import Decimal
+import base64
+import gzip
+import hashlib
+import io
+import json
+import os
+import tarfile
+import time
+from app import app, db
+from cache import cache, ResponseCache
+from manutencao import em_manutencao, definir_manutencao
+from models import Backup, Restauracao
+
+FORMATO = 1
+LINHAS_POR_BLOCO = 5000
+INTERVALO_PROGRESSO = 2  # Segundos entre gravações do progresso
+MANIFESTO = 'manifest.json'
+PREFIXO_CARGA = 'restaurando_'
+
+def diretorio_backups():
+    return app.config['BACKUP_DIR']
+
+def caminho_backup(backup):
+    return os.path.join(diretorio_backups(), backup.arquivo)
+
+def dados_backup(backup):
+    """Metadados e progresso de um backup"""
+    return {
+        'id': backup.id,
+        'status': backup.status,
+        'automatico': backup.automatico,
+        'arquivo': os.path.basename(backup.arquivo) if backup.arquivo else None,
+        'compressao': backup.compressao,
+        'tabelas_total': backup.tabelas_total,
+        'tabelas_concluidas': backup.tabelas_concluidas,
+        'bytes_dump': backup.bytes_dump,
+        'bytes': backup.bytes,
+        'sha256': backup.sha256,
+        'erro': backup.erro,
+        'criado_em': backup.criado_em.isoformat() if backup.criado_em else None,
+        'iniciado_em': backup.iniciado_em.isoformat() if backup.iniciado_em else None,
+        'concluido_em': backup.concluido_em.isoformat() if backup.concluido_em else None
+    }
+
+def tabelas_backup():
+    """Tabelas dos modelos, pais antes dos filhos
+    
+    O histórico de backups e de restaurações fica de fora: descreve os
+    arquivos em disco e o próprio processo de restauração, que uma
+    restauração não traz de volta.
+    """
+    return [tabela for tabela in db.metadata.sorted_tables
+            if tabela not in (Backup.__table__, Restauracao.__table__)]
+
+def engine_origem():
+    """Banco lido pelo backup: BACKUP_DATABASE_URI (ex.: uma réplica) ou o banco da aplicação"""
+    url = app.config.get('BACKUP_DATABASE_URI')
+    return create_engine(url) if url else db.engine
+
+class _ArquivoComHash:
+    """Arquivo binário que calcula o sha256 do que é escrito"""
+    
+    def __init__(self, arquivo):
+        self.arquivo = arquivo
+        self.digest = hashlib.sha256()
+    
+    def write(self, dados):
+        self.digest.update(dados)
+        return self.arquivo.write(dados)
+    
+    def flush(self):
+        self.arquivo.flush()
+
+def _gravar_progresso(backup_id, **valores):
+    db.session.execute(Backup.__table__.update().where(Backup.id == backup_id).values(**valores))
+    db.session.commit()
+
+def _valor_json(valor):
+    if isinstance(valor, (datetime, date, hora)):
+        return valor.isoformat()
+    if isinstance(valor, Decimal):
+        return str(valor)
+    if isinstance(valor, bytes):
+        return base64.b64encode(valor).decode('ascii')
+    return valor
+
+def _conversor(tipo):
+    """Função que desfaz _valor_json para uma coluna do tipo `tipo`"""
+    if isinstance(tipo, sqltypes.DateTime):
+        return datetime.fromisoformat
+    if isinstance(tipo, sqltypes.Date):
+        return date.fromisoformat
+    if isinstance(tipo, sqltypes.Time):
+        return hora.fromisoformat
+    if isinstance(tipo, sqltypes.Numeric) and tipo.asdecimal:
+        return Decimal
+    if isinstance(tipo, sqltypes.LargeBinary):
+        return base64.b64decode
+    return None
+
+def _blocos_tabela(conexao, tabela, lote):
+    """Linhas de `tabela` em blocos de `lote`, paginadas pela chave primária (sem OFFSET)"""
+    pk = list(tabela.primary_key.columns)
+    consulta = select(tabela).order_by(*pk).limit(lote)
+    ultimo = None
+    while True:
+        if ultimo is None:
+            pagina = consulta
+        elif len(pk) == 1:
+            pagina = consulta.where(pk[0] > ultimo[0])
+        else:
+            pagina = consulta.where(tuple_(*pk) > tuple_(*ultimo))
+        linhas = conexao.execute(pagina).all()
+        if not linhas:
+            return
+        yield linhas
+        if len(linhas) < lote:
+            return
+        ultimo = [linhas[-1]._mapping[coluna] for coluna in pk]
+
+def _adicionar(tar, nome, dados):
+    info = tarfile.TarInfo(nome)
+    info.size = len(dados)
+    info.mtime = int(time.time())
+    tar.addfile(info, io.BytesIO(dados))
+
+def _esquema_tabela(tabela, dialeto):
+    return {
+        'nome': tabela.name,
+        'colunas': [{
+            'nome': coluna.name,
+            'tipo': str(coluna.type.compile(dialect=dialeto)),
+            'nulo': coluna.nullable,
+            'pk': coluna.primary_key
+        } for coluna in tabela.columns],
+        'indices': [{
+            'nome': indice.name,
+            'colunas': [coluna.name for coluna in indice.columns],
+            'unico': indice.unique
+        } for indice in sorted(tabela.indexes, key=lambda i: i.name)],
+        'linhas': 0,
+        'blocos': []
+    }
+
+def _iniciar_leitura(conexao):
+    # Uma transação só para todas as tabelas: o backup é uma foto consistente
+    if conexao.dialect.name != 'sqlite':
+        conexao = conexao.execution_options(isolation_level='REPEATABLE READ')
+    conexao.begin()
+    return conexao
+
+def executar_backup(backup_id, lote=LINHAS_POR_BLOCO):
+    """Gera o backup lógico: cada tabela em blocos colunares compactados dentro de um .tar
+    
+    As tabelas são lidas pela chave primária em blocos de `lote` linhas,
+    numa única transação, e cada bloco vira um membro
+    tabelas/<tabela>/<n>.json.gz ({'colunas': [...], 'valores': [[coluna], ...]}).
+    O manifest.json, no fim do tar, guarda o esquema, as contagens e o
+    sha256 de cada bloco. O tar é escrito em streaming, com o sha256 do
+    arquivo calculado durante a escrita; só recebe o nome final quando
+    termina. Funciona em qualquer banco suportado pelo SQLAlchemy.
+    """
+    backup = db.session.get(Backup, backup_id)
+    prefixo = 'backup_auto' if backup.automatico else 'backup_passometro'
+    backup.arquivo = f"{prefixo}_{datetime.utcnow().strftime('%Y%m%d_%H%M%S')}_{backup.id}.tar"
+    backup.status = 'executando'
+    backup.iniciado_em = datetime.utcnow()
+    backup.tabelas_total = len(tabelas_backup())
+    db.session.commit()
+    
+    destino = caminho_backup(backup)
+    temporario = destino + '.tmp'
+    os.makedirs(os.path.dirname(destino), exist_ok=True)
+    
+    origem = engine_origem()
+    manifesto = {
+        'formato': FORMATO,
+        'criado_em': datetime.utcnow().isoformat(),
+        'dialeto': origem.dialect.name,
+        'tabelas': []
+    }
+    tabelas = bytes_dump = 0
+    ultimo_progresso = time.monotonic()
+    try:
+        with open(temporario, 'wb') as bruto, origem.connect() as conexao:
+            saida = _ArquivoComHash(bruto)
+            conexao = _iniciar_leitura(conexao)
+            with tarfile.open(fileobj=saida, mode='w|') as tar:
+                for tabela in tabelas_backup():
+                    esquema = _esquema_tabela(tabela, origem.dialect)
+                    colunas = [coluna.name for coluna in tabela.columns]
+                    for numero, linhas in enumerate(_blocos_tabela(conexao, tabela, lote), 1):
+                        conteudo = json.dumps({
+                            'colunas': colunas,
+                            'valores': [[_valor_json(valor) for valor in coluna] for coluna in zip(*linhas)]
+                        }, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+                        compactado = gzip.compress(conteudo, compresslevel=6, mtime=0)
+                        nome = f'tabelas/{tabela.name}/{numero:06d}.json.gz'
+                        _adicionar(tar, nome, compactado)
+                        esquema['blocos'].append({
+                            'arquivo': nome,
+                            'linhas': len(linhas),
+                            'sha256': hashlib.sha256(compactado).hexdigest()
+                        })
+                        esquema['linhas'] += len(linhas)
+                        bytes_dump += len(conteudo)
+                        if time.monotonic() - ultimo_progresso >= INTERVALO_PROGRESSO:
+                            _gravar_progresso(backup_id, tabelas_concluidas=tabelas, bytes_dump=bytes_dump)
+                            ultimo_progresso = time.monotonic()
+                    manifesto['tabelas'].append(esquema)
+                    tabelas += 1
+                _adicionar(tar, MANIFESTO, json.dumps(manifesto, ensure_ascii=False, indent=1).encode('utf-8'))
+            conexao.rollback()
+        
+        os.replace(temporario, destino)
+        with open(destino + '.sha256', 'w') as soma:
+            soma.write(f'{saida.digest.hexdigest()}  {os.path.basename(destino)}\n')
+    except Exception as e:
+        if os.path.exists(temporario):
+            os.remove(temporario)
+        db.session.rollback()
+        _gravar_progresso(
+            backup_id, status='falha', erro=str(e)[:2000], concluido_em=datetime.utcnow(),
+            tabelas_concluidas=tabelas, bytes_dump=bytes_dump
+        )
+        raise
+    finally:
+        if origem is not db.engine:
+            origem.dispose()
+    
+    _gravar_progresso(
+        backup_id,
+        status='concluido',
+        tabelas_concluidas=tabelas,
+        bytes_dump=bytes_dump,
+        bytes=os.path.getsize(destino),
+        sha256=saida.digest.hexdigest(),
+        concluido_em=datetime.utcnow()
+    )
+    return db.session.get(Backup, backup_id)
+
+def verificar_backup(caminho):
+    """Lê o manifesto e confere o sha256 de todos os blocos; retorna o manifesto"""
+    with tarfile.open(caminho) as tar:
+        manifesto = json.load(tar.extractfile(MANIFESTO))
+        if manifesto.get('formato') != FORMATO:
+            raise ValueError(f"Formato de backup não suportado: {manifesto.get('formato')}")
+        esperados = {bloco['arquivo']: bloco['sha256'] for esquema in manifesto['tabelas'] for bloco in esquema['blocos']}
+        for membro in tar:
+            if membro.name in esperados:
+                if hashlib.sha256(tar.extractfile(membro).read()).hexdigest() != esperados.pop(membro.name):
+                    raise ValueError(f'Bloco corrompido: {membro.name}')
+    if esperados:
+        raise ValueError(f'Blocos ausentes: {len(esperados)}')
+    return manifesto
+
+def _desativar_fks(conexao):
+    """Desliga a verificação de chaves estrangeiras na conexão (tabelas carregadas em qualquer ordem)"""
+    dialeto = conexao.dialect.name
+    if dialeto == 'mysql':
+        conexao.execute(text('SET FOREIGN_KEY_CHECKS=0'))
+    elif dialeto == 'sqlite':
+        conexao.execute(text('PRAGMA foreign_keys=OFF'))
+    elif dialeto == 'postgresql':
+        conexao.execute(text("SET session_replication_role = 'replica'"))
+
+@contextmanager
+def _conexao_carga():
+    """Conexão com as chaves estrangeiras desligadas; é descartada no fim para não voltar assim ao pool"""
+    with db.engine.connect() as conexao:
+        _desativar_fks(conexao)
+        try:
+            yield conexao
+        finally:
+            conexao.invalidate()
+
+def _ajustar_sequencia(conexao, tabela):
+    # PostgreSQL: ids inseridos explicitamente não avançam a sequência
+    pk = list(tabela.primary_key.columns)
+    if conexao.dialect.name == 'postgresql' and len(pk) == 1 and pk[0].autoincrement is not False:
+        conexao.execute(text(
+            f"SELECT setval(pg_get_serial_sequence('{tabela.name}', '{pk[0].name}'), "
+            f"COALESCE((SELECT MAX({pk[0].name}) FROM {tabela.name}), 0) + 1, false)"
+        ))
+
+def _valores_coluna(coluna, valores, dialeto=None):
+    """Valores de uma coluna do bloco nos tipos do modelo; com `dialeto`, já no formato do driver"""
+    converter = _conversor(coluna.type)
+    if converter:
+        valores = [None if valor is None else converter(valor) for valor in valores]
+    processar = dialeto and coluna.type.dialect_impl(dialeto).bind_processor(dialeto)
+    if processar:
+        valores = [None if valor is None else processar(valor) for valor in valores]
+    return valores
+
+def _tabela_carga(tabela, esquema):
+    """Tabela de carga de `tabela`: só as colunas que o backup e o modelo têm em comum, sem chaves nem índices"""
+    nomes = {coluna['nome'] for coluna in esquema['colunas']}
+    return Table(
+        PREFIXO_CARGA + tabela.name, MetaData(),
+        *(Column(coluna.name, coluna.type) for coluna in tabela.columns if coluna.name in nomes)
+    )
+
+def restaurar_tabela(caminho, esquema, carga):
+    """Carrega os blocos de uma tabela do backup na tabela de carga `carga`
+    
+    O INSERT é compilado uma vez e cada bloco vai direto ao executemany do
+    driver, com os valores convertidos coluna a coluna. Colunas que o
+    modelo não tem mais são ignoradas. Retorna (tabela, linhas contadas na
+    tabela de carga).
+    """
+    dialeto = db.engine.dialect
+    por_nome = {coluna.name: coluna for coluna in carga.columns}
+    insercao = None
+    with tarfile.open(caminho) as tar, db.engine.connect() as conexao:
+        for bloco in esquema['blocos']:
+            conteudo = json.loads(gzip.decompress(tar.extractfile(bloco['arquivo']).read()))
+            colunas = [(por_nome[nome], valores) for nome, valores in zip(conteudo['colunas'], conteudo['valores'])
+                       if nome in por_nome]
+            chaves = [coluna.key for coluna, _ in colunas]
+            if insercao is None or insercao.column_keys != chaves:
+                insercao = carga.insert().compile(dialect=dialeto, column_keys=chaves)
+            valores = {coluna.key: _valores_coluna(coluna, v, dialeto) for coluna, v in colunas}
+            if insercao.positional:
+                parametros = list(zip(*(valores[chave] for chave in insercao.positiontup)))
+            else:
+                parametros = [dict(zip(chaves, linha)) for linha in zip(*valores.values())]
+            conexao.exec_driver_sql(insercao.string, parametros)
+            conexao.commit()
+        linhas = conexao.execute(select(func.count()).select_from(carga)).scalar()
+    return esquema['nome'], linhas
+        
+def _restaurar_tabela_thread(caminho, esquema, carga):
+    with app.app_context():
+        try:
+            return restaurar_tabela(caminho, esquema, carga)
+        finally:
+            db.session.remove()
+
+def _invalidar_caches():
+    """Descarta o que o Redis guarda do banco anterior à restauração"""
+    if not cache.redis_client:
+        return
+    # Gerações são incrementadas, não apagadas: voltar a 0 revalidaria ETags antigos
+    geracoes = {chave.split(':', 2)[2] for chave in cache.redis_client.scan_iter(f'{ResponseCache.PREFIX}:gen:*')}
+    ResponseCache.bump(*(geracoes | {'registros', 'pendencias', 'dashboard', 'tags', 'plantao'}))
+    for padrao in ('dashboard:*', 'notifications:*', 'report:*', 'user:*', 'cache:*', 'api_escopo:*'):
+        cache.clear_pattern(padrao)
+    
+    from sla import CHAVE_AGENDA, reconciliar_agenda_sla
+    cache.delete(CHAVE_AGENDA)
+    reconciliar_agenda_sla()
+
+def _padroes_ausentes(tabela, carga):
+    """(coluna, expressão) com o padrão do modelo para as colunas que o backup não tem"""
+    for coluna in tabela.columns:
+        padrao = coluna.default
+        if coluna.name in carga.c or padrao is None:
+            continue  # Sem padrão no modelo: fica o do banco (server_default) ou NULL
+        if padrao.is_clause_element:
+            yield coluna, padrao.arg
+        else:
+            valor = padrao.arg(None) if padrao.is_callable else padrao.arg
+            yield coluna, literal(valor, coluna.type)
+
+def _trocar_tabelas(tabelas, cargas, contagens, manutencao):
+    """Substitui o conteúdo das tabelas pelo das tabelas de carga, numa única transação"""
+    with _conexao_carga() as conexao:
+        try:
+            for tabela in reversed(tabelas):
+                conexao.execute(tabela.delete())
+            for tabela in tabelas:
+                carga = cargas.get(tabela.name)
+                if carga is None:
+                    continue
+                destino = [tabela.c[coluna.name] for coluna in carga.columns]
+                origem = list(carga.columns)
+                for coluna, padrao in _padroes_ausentes(tabela, carga):
+                    destino.append(coluna)
+                    origem.append(padrao)
+                inseridas = conexao.execute(tabela.insert().from_select(destino, select(*origem))).rowcount
+                if inseridas != contagens[tabela.name]:
+                    raise ValueError(
+                        f'{tabela.name}: {inseridas} linhas copiadas, {contagens[tabela.name]} carregadas'
+                    )
+                _ajustar_sequencia(conexao, tabela)
+            # As configurações vieram do backup: o modo manutenção atual é mantido
+            definir_manutencao(manutencao, conexao)
+            conexao.commit()
+        except Exception:
+            conexao.rollback()
+            raise
+
+def restaurar_dados(caminho, processos=4, progresso=None):
+    """Restaura um backup .tar de executar_backup sobre o banco da aplicação
+    
+    Confere o manifesto e os blocos antes de tocar no banco. As tabelas do
+    backup são carregadas em tabelas de carga (restaurando_<tabela>, sem
+    chaves nem índices), em paralelo, uma por thread; no SQLite, que tem
+    um único escritor, a carga é sequencial. Cada tabela de carga precisa
+    ter as linhas do manifesto. Só então o conteúdo das tabelas da
+    aplicação é trocado pelo das tabelas de carga numa única transação:
+    qualquer erro até o commit deixa os dados e os índices atuais intactos.
+    As tabelas de carga são removidas no fim, com ou sem erro, e caches e
+    agenda de SLA no Redis são refeitos. `progresso(carregadas, total)` é
+    chamado a cada tabela carregada. Retorna {'tabelas', 'linhas', 'segundos'}.
+    """
+    inicio = time.monotonic()
+    manifesto = verificar_backup(caminho)
+    tabelas = tabelas_backup()
+    por_nome = {tabela.name: tabela for tabela in tabelas}
+    esquemas = [esquema for esquema in manifesto['tabelas'] if esquema['nome'] in por_nome]
+    cargas = {esquema['nome']: _tabela_carga(por_nome[esquema['nome']], esquema) for esquema in esquemas}
+    
+    db.session.remove()
+    try:
+        with db.engine.begin() as conexao:
+            for carga in cargas.values():
+                carga.drop(conexao, checkfirst=True)
+                carga.create(conexao)
+        # Conexões do pool podem guardar o esquema antigo (SQLite só o relê ao executar)
+        db.engine.dispose()
+    
+        if db.engine.dialect.name == 'sqlite':
+            processos = 1
+        # Maiores primeiro: a tabela mais longa não fica para o fim
+        esquemas.sort(key=lambda esquema: esquema['linhas'], reverse=True)
+        contagens = {}
+        with ThreadPoolExecutor(max_workers=max(processos, 1)) as executor:
+            tarefas = [executor.submit(_restaurar_tabela_thread, caminho, esquema, cargas[esquema['nome']])
+                       for esquema in esquemas]
+            for tarefa in as_completed(tarefas):
+                nome, linhas = tarefa.result()
+                contagens[nome] = linhas
+                if progresso:
+                    progresso(len(contagens), len(esquemas))
+    
+        divergentes = [e['nome'] for e in esquemas if contagens[e['nome']] != e['linhas']]
+        if divergentes:
+            raise ValueError(f"Contagem de linhas não confere: {', '.join(sorted(divergentes))}")
+        
+        _trocar_tabelas(tabelas, cargas, contagens, em_manutencao())
+    finally:
+        with db.engine.begin() as conexao:
+            for carga in cargas.values():
+                carga.drop(conexao, checkfirst=True)
+        db.engine.dispose()
+    
+    _invalidar_caches()
+    return {
+        'tabelas': len(esquemas),
+        'linhas': sum(contagens.values()),
+        'segundos': round(time.monotonic() - inicio, 2)
+    }
+
+def dados_restauracao(restauracao):
+    """Status e progresso de uma restauração"""
+    return {
+        'id': restauracao.id,
+        'status': restauracao.status,
+        'tabelas_total': restauracao.tabelas_total,
+        'tabelas_concluidas': restauracao.tabelas_concluidas,
+        'linhas': restauracao.linhas,
+        'erro': restauracao.erro,
+        'criado_em': restauracao.criado_em.isoformat() if restauracao.criado_em else None,
+        'iniciado_em': restauracao.iniciado_em.isoformat() if restauracao.iniciado_em else None,
+        'concluido_em': restauracao.concluido_em.isoformat() if restauracao.concluido_em else None
+    }
+
+def _gravar_restauracao(restauracao_id, **valores):
+    db.session.execute(Restauracao.__table__.update().where(Restauracao.id == restauracao_id).values(**valores))
+    db.session.commit()
+
+def executar_restauracao(restauracao_id):
+    """Executa uma restauração enviada pela interface (tarefa restaurar_backup)
+    
+    O modo manutenção fica ligado do início ao fim e volta ao valor
+    anterior depois; o arquivo enviado é removido em qualquer caso.
+    """
+    restauracao = db.session.get(Restauracao, restauracao_id)
+    caminho = os.path.join(diretorio_backups(), restauracao.arquivo)
+    estava_em_manutencao = em_manutencao()
+    _gravar_restauracao(restauracao_id, status='executando', iniciado_em=datetime.utcnow())
+    definir_manutencao(True)
+    try:
+        resultado = restaurar_dados(
+            caminho,
+            processos=app.config['BACKUP_PROCESSOS_RESTAURACAO'],
+            progresso=lambda carregadas, total: _gravar_restauracao(
+                restauracao_id, tabelas_concluidas=carregadas, tabelas_total=total
+            )
+        )
+    except Exception as e:
+        db.session.rollback()
+        _gravar_restauracao(restauracao_id, status='falha', erro=str(e)[:2000], concluido_em=datetime.utcnow())
+        raise
+    finally:
+        definir_manutencao(estava_em_manutencao)
+        if os.path.exists(caminho):
+            os.remove(caminho)
+    
+    _gravar_restauracao(
+        restauracao_id,
+        status='concluido',
+        tabelas_total=resultado['tabelas'],
+        tabelas_concluidas=resultado['tabelas'],
+        linhas=resultado['linhas'],
+        concluido_em=datetime.utcnow()
+    )
+    return resultado
+
+def remover_backup(backup):
+    # Backups que falharam antes de começar não chegam a ter arquivo
+    if backup.arquivo:
+        for caminho in (caminho_backup(backup), caminho_backup(backup) + '.sha256'):
+            if os.path.exists(caminho):
+                os.remove(caminho)
+    db.session.delete(backup)
+
+def manter_ultimos_automaticos(quantidade=7):
+    """Remove os backups automáticos concluídos além dos `quantidade` mais recentes"""
+    antigos = Backup.query.filter_by(automatico=True, status='concluido').order_by(
+        Backup.id.desc()
+    ).offset(quantidade).all()
+    for backup in antigos:
+        remover_backup(backup)
+    db.session.commit()
+    return len(antigos)
@@ -0,0 +1,180 @@
+from sqlalchemy import event, select, func, case, inspect
+from math import log2
+import re
+import unicodedata
+from app import db
+from models import Registro, Plantao, IndiceBuscaRegistro
+
+# Peso de cada ocorrência conforme o campo em que aparece
+PESOS_CAMPOS = {
+    'titulo': 5,
+    'tags': 4,
+    'descricao_rica': 2,
+    'situacao': 1,
+    'background': 1,
+    'avaliacao': 1,
+    'recomendacao': 1,
+    'patient_summary': 1,
+    'action_list': 1,
+    'situation_awareness': 1,
+    'synthesis_by_receiver': 1
+}
+PESO_MAXIMO = 1000
+TAMANHO_TERMO = 40
+MAX_TERMOS_CONSULTA = 10
+
+STOPWORDS = {
+    'a', 'ao', 'aos', 'as', 'com', 'como', 'da', 'das', 'de', 'do', 'dos', 'e',
+    'ela', 'ele', 'em', 'entre', 'era', 'esta', 'este', 'foi', 'ha', 'isso',
+    'ja', 'mais', 'mas', 'me', 'na', 'nao', 'nas', 'no', 'nos', 'o', 'os', 'ou',
+    'para', 'pela', 'pelo', 'por', 'que', 'se', 'sem', 'ser', 'seu', 'sua',
+    'tem', 'um', 'uma', 'uns', 'umas'
+}
+
+_TOKEN = re.compile(r'[a-z0-9]+')
+
+def normalizar(texto):
+    """Minúsculas sem acentos: 'Ventilação' -> 'ventilacao'"""
+    decomposto = unicodedata.normalize('NFKD', texto.casefold())
+    return ''.join(c for c in decomposto if not unicodedata.combining(c))
+
+def _singular(token):
+    """Reduz plurais comuns do português para que 'ventiladores' encontre 'ventilador'"""
+    if len(token) <= 3 or not token.endswith('s'):
+        return token
+    for sufixo, troca in (('oes', 'ao'), ('aes', 'ao'), ('eis', 'el'), ('ns', 'm'),
+                          ('res', 'r'), ('zes', 'z'), ('ses', 's')):
+        if token.endswith(sufixo):
+            return token[:-len(sufixo)] + troca
+    return token[:-1]
+
+def tokenizar(texto):
+    """Termos indexáveis de um texto (normalizados, sem stopwords)"""
+    if not texto:
+        return []
+    return [
+        _singular(token)[:TAMANHO_TERMO]
+        for token in _TOKEN.findall(normalizar(texto))
+        if len(token) > 1 and token not in STOPWORDS
+    ]
+
+def termos_registro(valores):
+    """{termo: peso} a partir dos campos indexados de um registro"""
+    termos = {}
+    for campo, peso in PESOS_CAMPOS.items():
+        valor = valores.get(campo)
+        if campo == 'tags' and valor:
+            valor = ' '.join(valor)
+        for termo in tokenizar(valor):
+            termos[termo] = min(termos.get(termo, 0) + peso, PESO_MAXIMO)
+    return termos
+
+def indexar_registros(connection, registro_ids):
+    """Reescreve as entradas do índice dos registros (na transação da conexão)"""
+    if not registro_ids:
+        return
+    
+    tabela = IndiceBuscaRegistro.__table__
+    connection.execute(tabela.delete().where(tabela.c.registro_id.in_(registro_ids)))
+    
+    colunas = [Registro.__table__.c[campo] for campo in PESOS_CAMPOS]
+    linhas = connection.execute(
+        select(Registro.__table__.c.id, Plantao.__table__.c.posto_id, *colunas)
+        .join(Plantao.__table__, Plantao.__table__.c.id == Registro.__table__.c.plantao_id)
+        .where(Registro.__table__.c.id.in_(registro_ids))
+    ).mappings().all()
+    
+    entradas = [
+        {'termo': termo, 'registro_id': linha['id'], 'posto_id': linha['posto_id'], 'peso': peso}
+        for linha in linhas
+        for termo, peso in termos_registro(linha).items()
+    ]
+    if entradas:
+        connection.execute(tabela.insert(), entradas)
+
+def registrar_indexacao_busca(session):
+    """Mantém o índice de busca atualizado na mesma transação das gravações de registros"""
+    campos_monitorados = (*PESOS_CAMPOS, 'plantao_id')
+    
+    @event.listens_for(session, 'after_flush')
+    def after_flush(session, flush_context):
+        alterados = [obj.id for obj in session.new if isinstance(obj, Registro)]
+        for obj in session.dirty:
+            if not isinstance(obj, Registro):
+                continue
+            estado = inspect(obj)
+            if any(estado.attrs[campo].history.has_changes() for campo in campos_monitorados):
+                alterados.append(obj.id)
+        
+        removidos = [obj.id for obj in session.deleted if isinstance(obj, Registro)]
+        
+        connection = session.connection()
+        indexar_registros(connection, alterados)
+        if removidos:
+            tabela = IndiceBuscaRegistro.__table__
+            connection.execute(tabela.delete().where(tabela.c.registro_id.in_(removidos)))
+
+def _filtrar_escopo(query, posto_id, de, ate):
+    """Restringe uma consulta sobre o índice ao posto e ao período pedidos"""
+    if posto_id is not None:
+        query = query.where(IndiceBuscaRegistro.posto_id == posto_id)
+    if de or ate:
+        query = query.join(Registro, Registro.id == IndiceBuscaRegistro.registro_id)
+        if de:
+            query = query.where(Registro.criado_em >= de)
+        if ate:
+            query = query.where(Registro.criado_em < ate)
+    return query
+
+def buscar_registros(consulta, posto_id=None, de=None, ate=None, limite=50):
+    """Busca registros contendo todos os termos da consulta, ordenados por relevância
+    
+    Retorna [(registro_id, pontuação)]. Termos raros valem mais que termos
+    frequentes (peso / log2(1 + nº de registros com o termo)), contados
+    no mesmo escopo (posto e período) da busca.
+    """
+    termos = list(dict.fromkeys(tokenizar(consulta)))[:MAX_TERMOS_CONSULTA]
+    if not termos:
+        return []
+    
+    frequencias = dict(db.session.execute(
+        _filtrar_escopo(
+            select(IndiceBuscaRegistro.termo, func.count())
+            .where(IndiceBuscaRegistro.termo.in_(termos)),
+            posto_id, de, ate
+        ).group_by(IndiceBuscaRegistro.termo)
+    ).all())
+    if len(frequencias) < len(termos):
+        return []
+    
+    relevancia = case(
+        {termo: 1 / log2(1 + frequencia) for termo, frequencia in frequencias.items()},
+        value=IndiceBuscaRegistro.termo
+    )
+    pontuacao = func.sum(IndiceBuscaRegistro.peso * relevancia).label('pontuacao')
+    
+    query = _filtrar_escopo(
+        select(IndiceBuscaRegistro.registro_id, pontuacao).where(IndiceBuscaRegistro.termo.in_(termos)),
+        posto_id, de, ate
+    )
+    query = query.group_by(IndiceBuscaRegistro.registro_id).having(
+        func.count() == len(termos)
+    ).order_by(pontuacao.desc()).limit(limite)
+    
+    return [(registro_id, float(valor)) for registro_id, valor in db.session.execute(query)]
+
+def reindexar_todos(lote=500):
+    """Reconstrói o índice inteiro em lotes (carga inicial ou após mudança de tokenização)"""
+    ultimo_id = 0
+    total = 0
+    while True:
+        ids = db.session.execute(
+            select(Registro.id).where(Registro.id > ultimo_id).order_by(Registro.id).limit(lote)
+        ).scalars().all()
+        if not ids:
+            break
+        indexar_registros(db.session.connection(), ids)
+        db.session.commit()
+        total += len(ids)
+        ultimo_id = ids[-1]
+    return total
@@ -3,8 +3,13 @@ import json
 import pickle
 from datetime import timedelta
 from functools import wraps
-from flask import current_app
+from itertools import chain
+from urllib.parse import urlencode
+from flask import current_app, request
+from sqlalchemy import event
 import hashlib
+import threading
+import time
 
 class CacheManager:
     """Gerenciador de cache Redis para o sistema Passômetro"""
@@ -81,6 +86,16 @@ class CacheManager:
         except Exception:
             return False
     
+    def incr(self, key):
+        """Incrementa um contador no cache"""
+        if not self.redis_client:
+            return None
+        
+        try:
+            return self.redis_client.incr(key)
+        except Exception:
+            return None
+    
     def get_or_set(self, key, callback, timeout=None):
         """Obtém do cache ou executa callback e armazena"""
         value = self.get(key)
@@ -161,19 +176,191 @@ class DashboardCache:
         cache.clear_pattern(f"dashboard:{user_id}:*")
 
 class NotificationCache:
-    """Cache específico para notificações"""
+    """Cache específico para notificações
+
+    Mantém por usuário uma caixa de entrada limitada com as últimas
+    notificações não lidas (sorted set com score = id da notificação) e um
+    contador de não lidas. O banco continua sendo a fonte da verdade: sem as
+    chaves, a caixa é reconstruída sob demanda pelo `loader`.
+    
+    Toda escrita após um commit (push, remove, drop, rebuild) incrementa a
+    geração do usuário; a reconstrução sob demanda só grava se a geração
+    lida antes de consultar o banco não mudou (WATCH), para não sobrescrever
+    a caixa com uma leitura anterior ao commit.
+    """
+    
+    INBOX_SIZE = 50
+    TIMEOUT = 86400  # 24 horas
     
     @staticmethod
-    def get_user_notifications(user_id, limit=10):
-        """Obtém notificações do usuário com cache"""
-        cache_key = f"notifications:{user_id}:{limit}"
-        return cache.get(cache_key)
+    def _keys(user_id):
+        return f"notifications:{user_id}:inbox", f"notifications:{user_id}:unread"
     
     @staticmethod
-    def set_user_notifications(user_id, limit, data, timeout=60):
-        """Armazena notificações no cache"""
-        cache_key = f"notifications:{user_id}:{limit}"
-        cache.set(cache_key, data, timeout)
+    def _generation_key(user_id):
+        return f"notifications:{user_id}:gen"
+    
+    @classmethod
+    def _bump(cls, pipe, user_id):
+        pipe.incr(cls._generation_key(user_id))
+        pipe.expire(cls._generation_key(user_id), cls.TIMEOUT)
+    
+    @classmethod
+    def get_inbox(cls, user_id, limit, loader):
+        """Retorna (total de não lidas, últimas `limit` notificações)
+
+        `loader(limit)` consulta o banco e devolve o mesmo par; só é chamado
+        quando a caixa não existe ou não tem itens suficientes, e deve ler
+        numa transação nova (posterior à leitura da geração).
+        """
+        if not cache.redis_client:
+            return loader(limit)
+        
+        inbox_key, unread_key = cls._keys(user_id)
+        try:
+            pipe = cache.redis_client.pipeline()
+            pipe.get(unread_key)
+            pipe.zrevrange(inbox_key, 0, limit - 1)
+            pipe.zcard(inbox_key)
+            pipe.get(cls._generation_key(user_id))
+            unread, members, size, generation = pipe.execute()
+            
+            if unread is not None and size >= min(limit, int(unread)):
+                return int(unread), [json.loads(m) for m in members]
+        except Exception:
+            return loader(limit)
+        
+        total, items = loader(cls.INBOX_SIZE)
+        cls._rebuild_if_unchanged(user_id, generation, total, items)
+        return total, items[:limit]
+    
+    @classmethod
+    def _write(cls, pipe, user_id, total, items):
+        inbox_key, unread_key = cls._keys(user_id)
+        pipe.delete(inbox_key)
+        if items:
+            pipe.zadd(inbox_key, {json.dumps(item, default=str): item['id'] for item in items})
+            pipe.expire(inbox_key, cls.TIMEOUT)
+        pipe.set(unread_key, total, ex=cls.TIMEOUT)
+    
+    @classmethod
+    def _rebuild_if_unchanged(cls, user_id, generation, total, items):
+        """Grava a caixa lida do banco se nenhuma escrita aconteceu desde a leitura de `generation`"""
+        try:
+            with cache.redis_client.pipeline() as pipe:
+                pipe.watch(cls._generation_key(user_id))
+                if pipe.get(cls._generation_key(user_id)) != generation:
+                    return False
+                pipe.multi()
+                cls._write(pipe, user_id, total, items)
+                pipe.execute()
+                return True
+        except Exception:  # WatchError: um commit alterou a caixa durante a leitura
+            return False
+    
+    @classmethod
+    def rebuild(cls, user_id, total, items):
+        """Substitui a caixa de entrada e o contador do usuário"""
+        if not cache.redis_client:
+            return False
+        
+        try:
+            pipe = cache.redis_client.pipeline()
+            cls._write(pipe, user_id, total, items)
+            cls._bump(pipe, user_id)
+            pipe.execute()
+            return True
+        except Exception:
+            return False
+    
+    @classmethod
+    def push(cls, user_id, item):
+        """Adiciona uma notificação nova (não lida) à caixa de entrada"""
+        if not cache.redis_client:
+            return False
+        
+        inbox_key, unread_key = cls._keys(user_id)
+        try:
+            with cache.redis_client.pipeline() as pipe:
+                cls._bump(pipe, user_id)
+                pipe.execute()
+                
+                pipe.watch(inbox_key, unread_key)
+                # Sem contador a caixa será reconstruída do banco na próxima leitura
+                if not pipe.exists(unread_key):
+                    return False
+                # Uma reconstrução posterior ao commit já trouxe a notificação
+                if pipe.zcount(inbox_key, item['id'], item['id']):
+                    return True
+                
+                pipe.multi()
+                pipe.incr(unread_key)
+                pipe.zadd(inbox_key, {json.dumps(item, default=str): item['id']})
+                pipe.zremrangebyrank(inbox_key, 0, -(cls.INBOX_SIZE + 1))
+                pipe.expire(inbox_key, cls.TIMEOUT)
+                pipe.expire(unread_key, cls.TIMEOUT)
+                pipe.execute()
+            return True
+        except Exception:
+            cls.invalidate_user_notifications(user_id)
+            return False
+    
+    @classmethod
+    def remove(cls, user_id, notification_id):
+        """Remove uma notificação marcada como lida"""
+        if not cache.redis_client:
+            return False
+        
+        inbox_key, unread_key = cls._keys(user_id)
+        try:
+            with cache.redis_client.pipeline() as pipe:
+                cls._bump(pipe, user_id)
+                pipe.execute()
+                
+                pipe.watch(inbox_key, unread_key)
+                unread = pipe.get(unread_key)
+                if unread is None:
+                    return False
+                if not pipe.zcount(inbox_key, notification_id, notification_id):
+                    # Ausente de uma caixa que tem todas as não lidas: uma reconstrução
+                    # posterior ao commit já a removeu. Numa caixa cortada em
+                    # INBOX_SIZE não há como saber; ela é descartada.
+                    if pipe.zcard(inbox_key) >= int(unread):
+                        return True
+                    pipe.multi()
+                    pipe.delete(inbox_key, unread_key)
+                    pipe.execute()
+                    return False
+                
+                pipe.multi()
+                pipe.zremrangebyscore(inbox_key, notification_id, notification_id)
+                pipe.decr(unread_key)
+                pipe.execute()
+            return True
+        except Exception:
+            cls.invalidate_user_notifications(user_id)
+            return False
+    
+    @classmethod
+    def clear(cls, user_id):
+        """Esvazia a caixa de entrada (todas marcadas como lidas)"""
+        return cls.rebuild(user_id, 0, [])
+    
+    @classmethod
+    def drop(cls, user_ids):
+        """Descarta as caixas de entrada (reconstruídas do banco na próxima leitura)"""
+        if not cache.redis_client or not user_ids:
+            return False
+        
+        try:
+            pipe = cache.redis_client.pipeline()
+            pipe.delete(*(key for user_id in user_ids for key in cls._keys(user_id)))
+            for user_id in user_ids:
+                cls._bump(pipe, user_id)
+            pipe.execute()
+            return True
+        except Exception:
+            return False
     
     @staticmethod
     def invalidate_user_notifications(user_id):
@@ -198,4 +385,315 @@ class ReportCache:
     @staticmethod
     def invalidate_reports():
         """Invalida todos os caches de relatórios"""
-        cache.clear_pattern("report:*") 
\ No newline at end of file
+        cache.clear_pattern("report:*") 
+
+class ResponseCache:
+    """Cache de respostas HTTP completas (status, headers e corpo)
+
+    As chaves combinam namespace, geração do namespace, escopo explícito
+    (usuário, posto ou global), rota e query string. Invalidar um namespace
+    é apenas incrementar sua geração: as entradas antigas deixam de ser
+    alcançáveis e expiram pelo TTL.
+    """
+    
+    PREFIX = 'api_response'
+    # O escopo explícito já identifica o principal; variar por estes headers
+    # tornaria cada token/sessão uma entrada diferente
+    IGNORED_VARY = {'cookie', 'authorization'}
+    SKIPPED_HEADERS = {'content-length', 'set-cookie'}
+    
+    @classmethod
+    def generation(cls, namespace):
+        """Geração atual de um namespace"""
+        return cache.get(f"{cls.PREFIX}:gen:{namespace}", 0)
+    
+    @classmethod
+    def bump(cls, *namespaces):
+        """Invalida namespaces incrementando suas gerações"""
+        for namespace in namespaces:
+            cache.incr(f"{cls.PREFIX}:gen:{namespace}")
+    
+    @classmethod
+    def base_key(cls, namespace, scope):
+        """Chave base da requisição atual (sem o componente de Vary)"""
+        query = urlencode(sorted(request.args.items(multi=True)))
+        digest = hashlib.md5(f"{request.path}?{query}".encode()).hexdigest()
+        return f"{cls.PREFIX}:{namespace}:{cls.generation(namespace)}:{scope}:{digest}"
+    
+    @staticmethod
+    def _vary_key(base_key, vary_headers):
+        valores = [f"{h}={request.headers.get(h, '')}" for h in vary_headers]
+        return f"{base_key}:{hashlib.md5('|'.join(valores).encode()).hexdigest()}"
+    
+    @classmethod
+    def get(cls, base_key):
+        """Reconstrói a resposta armazenada, se houver"""
+        vary_headers = cache.get(f"{base_key}:vary")
+        if vary_headers is None:
+            return None
+        
+        entry = cache.get(cls._vary_key(base_key, vary_headers))
+        if not entry:
+            return None
+        
+        response = current_app.response_class(
+            entry['body'],
+            status=entry['status'],
+            headers=entry['headers']
+        )
+        response.headers['X-Cache'] = 'HIT'
+        return response
+    
+    @classmethod
+    def set(cls, base_key, response, timeout=300):
+        """Armazena uma resposta 200 respeitando o header Vary"""
+        if response.status_code != 200 or response.direct_passthrough:
+            return False
+        
+        vary_headers = sorted({
+            h.strip().lower() for h in response.headers.get('Vary', '').split(',') if h.strip()
+        } - cls.IGNORED_VARY)
+        if '*' in vary_headers:
+            return False
+        
+        try:
+            body = response.get_data(as_text=False).decode('utf-8')
+        except UnicodeDecodeError:
+            return False
+        
+        entry = {
+            'status': response.status_code,
+            'headers': [(k, v) for k, v in response.headers.items()
+                        if k.lower() not in cls.SKIPPED_HEADERS],
+            'body': body
+        }
+        cache.set(f"{base_key}:vary", vary_headers, timeout)
+        return cache.set(cls._vary_key(base_key, vary_headers), entry, timeout)
+
+def cached_response(namespace, scope, timeout=300):
+    """Decorator para cachear a resposta HTTP completa de uma view/resource
+
+    `scope` recebe o usuário autenticado e devolve o escopo explícito da
+    resposta (ex.: "usuario:3", "posto:2", "global"). Em um acerto a view
+    não é executada: nenhuma consulta ao ORM nem serialização.
+    """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if request.method not in ('GET', 'HEAD') or not cache.redis_client:
+                return func(*args, **kwargs)
+            
+            usuario = kwargs.get('current_user')
+            if usuario is None:
+                from flask_login import current_user as usuario
+            
+            base_key = ResponseCache.base_key(namespace, scope(usuario))
+            response = ResponseCache.get(base_key)
+            if response is not None:
+                return response
+            
+            response = current_app.make_response(func(*args, **kwargs))
+            if ResponseCache.set(base_key, response, timeout):
+                response.headers['X-Cache'] = 'MISS'
+            return response
+        return wrapper
+    return decorator
+
+class MicroCache:
+    """Micro-cache de respostas em memória do worker, com TTL de poucos segundos
+
+    Pensado para endpoints consultados periodicamente por todas as abas
+    abertas. Misses concorrentes da mesma chave são coalescidos: apenas a
+    primeira requisição executa a view, as demais aguardam e reutilizam o
+    resultado.
+    """
+    
+    def __init__(self, max_entries=1000):
+        self.max_entries = max_entries
+        self._entries = {}
+        self._locks = {}
+        self._guard = threading.Lock()
+    
+    def _fresh(self, key):
+        item = self._entries.get(key)
+        if item and item[0] > time.monotonic():
+            return item[1]
+        return None
+    
+    def _lock(self, key):
+        with self._guard:
+            return self._locks.setdefault(key, threading.Lock())
+    
+    def _purge(self):
+        agora = time.monotonic()
+        with self._guard:
+            for key in [k for k, (expira, _) in self._entries.items() if expira <= agora]:
+                self._entries.pop(key, None)
+                lock = self._locks.get(key)
+                if lock and not lock.locked():
+                    del self._locks[key]
+    
+    def get_or_compute(self, key, timeout, compute):
+        """Retorna a entrada da chave, executando `compute` uma única vez por expiração
+
+        `compute` devolve a entrada a armazenar ou None quando o resultado não
+        deve ser reutilizado.
+        """
+        entry = self._fresh(key)
+        if entry is not None:
+            return entry
+        
+        with self._lock(key):
+            entry = self._fresh(key)
+            if entry is not None:
+                return entry
+            
+            entry = compute()
+            if entry is not None:
+                if len(self._entries) >= self.max_entries:
+                    self._purge()
+                self._entries[key] = (time.monotonic() + timeout, entry)
+            return entry
+    
+    def clear(self):
+        with self._guard:
+            self._entries.clear()
+
+micro_cache_store = MicroCache()
+
+def micro_cache(scope, timeout=5, version=None):
+    """Decorator de micro-cache compartilhado para endpoints de polling
+
+    `scope` recebe o usuário autenticado e devolve a chave que determina a
+    resposta (global, posto ou usuário), de modo que todos os usuários do
+    mesmo escopo compartilham a entrada. `version`, opcional, entra na chave
+    para que gravações invalidem a entrada antes do TTL. O TTL pode ser
+    ajustado por endpoint em app.config['MICRO_CACHE_TIMEOUTS'] (0 desativa).
+    """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if request.method not in ('GET', 'HEAD'):
+                return func(*args, **kwargs)
+            
+            timeouts = current_app.config.get('MICRO_CACHE_TIMEOUTS', {})
+            ttl = timeouts.get(request.endpoint, timeout)
+            if not ttl:
+                return func(*args, **kwargs)
+            
+            usuario = kwargs.get('current_user')
+            if usuario is None:
+                from flask_login import current_user as usuario
+            
+            key = (request.endpoint, scope(usuario), version(usuario) if version else None,
+                   urlencode(sorted(request.args.items(multi=True))))
+            gerada = []
+            
+            def compute():
+                response = current_app.make_response(func(*args, **kwargs))
+                gerada.append(response)
+                if response.status_code != 200 or response.direct_passthrough:
+                    return None
+                return (response.get_data(), response.status_code,
+                        [(k, v) for k, v in response.headers.items()
+                         if k.lower() not in ResponseCache.SKIPPED_HEADERS])
+            
+            entry = micro_cache_store.get_or_compute(key, ttl, compute)
+            if gerada:
+                return gerada[0]
+            
+            body, status, headers = entry
+            response = current_app.response_class(body, status=status, headers=headers)
+            response.headers['X-Cache'] = 'HIT'
+            return response
+        return wrapper
+    return decorator
+
+def invalidate_on_commit(session, model_namespaces):
+    """Invalida namespaces do ResponseCache quando um commit grava os modelos mapeados
+
+    `model_namespaces` mapeia classe do modelo -> namespaces afetados. Um
+    namespace pode ser uma função que recebe a instância gravada (ou None em
+    updates/deletes em massa) e devolve o namespace, permitindo gerações
+    por usuário. As gerações só são incrementadas após o commit, nunca em
+    rollback.
+    """
+    info_key = 'response_cache_namespaces'
+    
+    def marcar(session, classe, instancia=None):
+        afetados = session.info.setdefault(info_key, set())
+        for namespace in model_namespaces.get(classe, ()):
+            if callable(namespace):
+                namespace = namespace(instancia)
+            afetados.add(namespace)
+    
+    @event.listens_for(session, 'after_flush')
+    def after_flush(session, flush_context):
+        for obj in chain(session.new, session.dirty, session.deleted):
+            marcar(session, type(obj), obj)
+    
+    @event.listens_for(session, 'after_bulk_update')
+    def after_bulk_update(update_context):
+        marcar(update_context.session, update_context.mapper.class_)
+    
+    @event.listens_for(session, 'after_bulk_delete')
+    def after_bulk_delete(delete_context):
+        marcar(delete_context.session, delete_context.mapper.class_)
+    
+    @event.listens_for(session, 'after_commit')
+    def after_commit(session):
+        afetados = session.info.pop(info_key, None)
+        if afetados:
+            ResponseCache.bump(*afetados)
+    
+    @event.listens_for(session, 'after_rollback')
+    def after_rollback(session):
+        session.info.pop(info_key, None)
+
+def namespace_version(*namespaces):
+    """Token de versão a partir das gerações dos namespaces (None sem Redis)"""
+    if not cache.redis_client:
+        return None
+    return '.'.join(str(ResponseCache.generation(namespace)) for namespace in namespaces)
+
+def conditional_get(version, scope, bucket=None):
+    """Decorator de GET condicional (ETag / If-None-Match)
+
+    `version` recebe o usuário autenticado e devolve um token barato que muda
+    sempre que a resposta mudaria (gerações no Redis ou um agregado no banco).
+    Se o cliente já possui a versão atual, responde 304 sem executar a view.
+    `bucket` (segundos) deve ser usado por respostas com campos relativos ao
+    horário atual, como "tempo_atras" e "sla_restante".
+    """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if request.method not in ('GET', 'HEAD'):
+                return func(*args, **kwargs)
+            
+            usuario = kwargs.get('current_user')
+            if usuario is None:
+                from flask_login import current_user as usuario
+            
+            token = version(usuario)
+            if token is None:
+                return func(*args, **kwargs)
+            
+            janela = int(time.time() // bucket) if bucket else ''
+            query = urlencode(sorted(request.args.items(multi=True)))
+            etag = hashlib.md5(
+                f"{request.path}?{query}|{scope(usuario)}|{token}|{janela}".encode()
+            ).hexdigest()
+            
+            if request.if_none_match.contains_weak(etag):
+                response = current_app.response_class(status=304)
+            else:
+                response = current_app.make_response(func(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+            
+            response.set_etag(etag, weak=True)
+            response.headers['Cache-Control'] = 'private, no-cache'
+            return response
+        return wrapper
+    return decorator
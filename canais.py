@@ -0,0 +1,180 @@
+from email.message import EmailMessage
+import asyncio
+import json
+import queue
+import smtplib
+import time
+import urllib.error
+import urllib.request
+
+class ErroPermanente(Exception):
+    """Falha que não adianta repetir (destino inválido, requisição recusada)"""
+
+class Canal:
+    """Envio assíncrono das notificações de um tipo (email, sms, push, webhook)
+    
+    `enviar` recebe o dicionário da notificação reservada (id, tipo, destino,
+    payload, tentativas) e levanta exceção em caso de falha; ErroPermanente
+    encerra as tentativas. No máximo CONCORRENCIA envios simultâneos por canal.
+    """
+    
+    CONCORRENCIA = 10
+    
+    async def enviar(self, notificacao):
+        raise NotImplementedError
+    
+    async def fechar(self):
+        pass
+
+class CanalSimulado(Canal):
+    """Substituto local para canais sem provedor integrado e para testes
+    
+    Guarda (destino, payload) em `enviadas`; `falhas` mapeia destino -> exceção
+    levantada em vez de enviar.
+    """
+    
+    def __init__(self, latencia=0, falhas=None):
+        self.latencia = latencia
+        self.falhas = falhas or {}
+        self.enviadas = []
+    
+    async def enviar(self, notificacao):
+        await asyncio.sleep(self.latencia)
+        erro = self.falhas.get(notificacao['destino'])
+        if erro:
+            raise erro
+        self.enviadas.append((notificacao['destino'], notificacao['payload']))
+
+class CanalWebhook(Canal):
+    """POST do payload em JSON para a URL de destino"""
+    
+    TIMEOUT = 10
+    
+    def _post(self, url, payload):
+        requisicao = urllib.request.Request(
+            url, data=json.dumps(payload, default=str).encode('utf-8'),
+            headers={'Content-Type': 'application/json'}, method='POST'
+        )
+        try:
+            with urllib.request.urlopen(requisicao, timeout=self.TIMEOUT):
+                pass
+        except urllib.error.HTTPError as e:
+            # 4xx (exceto 408/429) não muda com novas tentativas
+            if 400 <= e.code < 500 and e.code not in (408, 429):
+                raise ErroPermanente(f'HTTP {e.code}') from e
+            raise
+        except ValueError as e:
+            raise ErroPermanente(str(e)) from e
+    
+    async def enviar(self, notificacao):
+        # urllib é bloqueante: cada POST roda em uma thread do executor padrão
+        await asyncio.to_thread(self._post, notificacao['destino'], notificacao['payload'])
+
+class CanalSMTP(Canal):
+    """Email por SMTP reaproveitando conexões entre mensagens
+    
+    As conexões ficam num pool que sobrevive aos lotes (fechar() não as
+    encerra): cada envio pega uma conexão livre ou abre outra, até
+    CONCORRENCIA simultâneas. Conexões paradas há mais de OCIOSO segundos
+    são testadas com NOOP antes do uso. Notificações com 'resumo' (lista de
+    payloads) viram uma única mensagem.
+    """
+    
+    CONCORRENCIA = 5
+    OCIOSO = 30
+    TIMEOUT = 30
+    
+    def __init__(self, servidor, porta=25, usuario=None, senha=None, tls=False, remetente=None):
+        self.servidor = servidor
+        self.porta = porta
+        self.usuario = usuario
+        self.senha = senha
+        self.tls = tls
+        self.remetente = remetente or usuario or f'passometro@{servidor}'
+        self._livres = queue.LifoQueue()  # (conexão, usada em); LIFO mantém quentes as mais recentes
+    
+    def _conectar(self):
+        conexao = smtplib.SMTP(self.servidor, self.porta, timeout=self.TIMEOUT)
+        if self.tls:
+            conexao.starttls()
+        if self.usuario:
+            conexao.login(self.usuario, self.senha)
+        return conexao
+    
+    def _descartar(self, conexao):
+        try:
+            conexao.quit()
+        except (smtplib.SMTPException, OSError):
+            conexao.close()
+    
+    def _obter(self):
+        while True:
+            try:
+                conexao, usada_em = self._livres.get_nowait()
+            except queue.Empty:
+                return self._conectar()
+            if time.monotonic() - usada_em < self.OCIOSO:
+                return conexao
+            try:
+                if conexao.noop()[0] == 250:
+                    return conexao
+            except (smtplib.SMTPException, OSError):
+                pass
+            self._descartar(conexao)
+    
+    def _devolver(self, conexao):
+        self._livres.put((conexao, time.monotonic()))
+    
+    def mensagem(self, notificacao):
+        itens = notificacao.get('resumo') or [notificacao['payload']]
+        mensagem = EmailMessage()
+        mensagem['From'] = self.remetente
+        mensagem['To'] = notificacao['destino']
+        if len(itens) == 1:
+            mensagem['Subject'] = itens[0].get('assunto') or itens[0].get('titulo') or 'Notificação do Passômetro'
+            mensagem.set_content(itens[0].get('mensagem', ''))
+        else:
+            mensagem['Subject'] = f'{len(itens)} notificações do Passômetro'
+            mensagem.set_content('\n\n'.join(
+                f"{item.get('assunto') or item.get('titulo', '')}\n{item.get('mensagem', '')}" for item in itens
+            ))
+        return mensagem
+    
+    def _enviar(self, mensagem):
+        conexao = self._obter()
+        try:
+            try:
+                conexao.send_message(mensagem)
+            except smtplib.SMTPServerDisconnected:
+                # O servidor fechou a conexão parada: uma nova tentativa com conexão nova
+                conexao.close()
+                conexao = self._conectar()
+                conexao.send_message(mensagem)
+        except smtplib.SMTPRecipientsRefused as e:
+            self._devolver(conexao)
+            raise ErroPermanente(f'Destinatário recusado: {", ".join(e.recipients)}') from e
+        except Exception:
+            self._descartar(conexao)
+            raise
+        self._devolver(conexao)
+    
+    async def enviar(self, notificacao):
+        await asyncio.to_thread(self._enviar, self.mensagem(notificacao))
+    
+    def encerrar(self):
+        """Fecha as conexões do pool"""
+        while True:
+            try:
+                conexao, _ = self._livres.get_nowait()
+            except queue.Empty:
+                return
+            self._descartar(conexao)
+
+def canais_padrao():
+    """Canais por tipo; email, sms e push ainda sem provedor integrado"""
+    return {
+        'email': CanalSimulado(),
+        'sms': CanalSimulado(),
+        'push': CanalSimulado(),
+        'webhook': CanalWebhook()
+    }
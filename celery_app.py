@@ -25,13 +25,18 @@ def make_celery(app):
         worker_max_tasks_per_child=1000,
         result_expires=3600,  # 1 hora
         beat_schedule={
+            'despachar-alertas-sla': {
+                'task': 'celery_app.despachar_alertas_sla',
+                'schedule': timedelta(seconds=10),
+                'options': {'expires': 10},  # Execuções atrasadas são substituídas pela próxima
+            },
             'verificar-sla-pendencias': {
                 'task': 'celery_app.verificar_sla_pendencias',
-                'schedule': crontab(minute='*/15'),  # A cada 15 minutos
+                'schedule': crontab(minute=0),  # A cada hora (reconciliação)
             },
             'enviar-notificacoes-pendentes': {
                 'task': 'celery_app.enviar_notificacoes_pendentes',
-                'schedule': crontab(minute='*/5'),  # A cada 5 minutos
+                'schedule': crontab(minute='*'),  # A cada minuto
             },
             'limpar-cache-antigo': {
                 'task': 'celery_app.limpar_cache_antigo',
@@ -48,109 +53,96 @@ def make_celery(app):
             'limpar-dados-antigos': {
                 'task': 'celery_app.limpar_dados_antigos',
                 'schedule': crontab(day_of_week=1, hour=3, minute=0),  # Segunda 3h
+            },
+            'compactar-log-alteracoes': {
+                'task': 'celery_app.compactar_log_alteracoes',
+                'schedule': crontab(hour=3, minute=30),  # 3h30 da manhã
+            },
+            'limpar-chaves-idempotencia': {
+                'task': 'celery_app.limpar_chaves_idempotencia',
+                'schedule': crontab(minute=15),  # A cada hora
+            },
+            'selar-auditoria': {
+                'task': 'celery_app.selar_auditoria',
+                'schedule': crontab(minute='*/5'),  # A cada 5 minutos
+            },
+            'aplicar-politica-retencao': {
+                'task': 'celery_app.aplicar_politica_retencao',
+                'schedule': crontab(hour=4, minute=0),  # 4h da manhã
             }
         }
     )
     
+    # Tarefas periódicas não rodam em modo manutenção (ex.: durante uma restauração)
+    periodicas = {agendamento['task'] for agendamento in celery.conf.beat_schedule.values()}
+    
     class ContextTask(celery.Task):
         def __call__(self, *args, **kwargs):
             with app.app_context():
-                return self.run(*args, **kwargs)
+                if self.name in periodicas:
+                    from manutencao import em_manutencao
+                    if em_manutencao():
+                        return "Ignorada: modo manutenção"
+                
+                # O que a tarefa gravar é auditado em nome do usuário do sistema
+                from app import db
+                from models import Usuario
+                db.session.info['autor_auditoria'] = Usuario.sistema().id
+                try:
+                    return self.run(*args, **kwargs)
+                finally:
+                    db.session.info.pop('autor_auditoria', None)
     
     celery.Task = ContextTask
     return celery
 
+# Inicialização do Celery
+from app import app
+celery = make_celery(app)
+
 # Tarefas assíncronas
+@celery.task(bind=True)
+def despachar_alertas_sla(self):
+    """Envia os alertas de SLA cujo momento chegou, pela agenda de prazos no Redis"""
+    from sla import despachar_alertas_sla as despachar
+    
+    try:
+        alertadas = despachar()
+        return f"Alertadas {alertadas} pendências"
+    
+    except Exception as e:
+        self.retry(countdown=5, max_retries=3)
+        raise e
+
 @celery.task(bind=True)
 def verificar_sla_pendencias(self):
-    """Verifica pendências próximas do SLA e envia alertas"""
-    from app import db
-    from models import Pendencia, Usuario, Configuracao
-    from datetime import datetime, timedelta
+    """Reconcilia a agenda de prazos e alerta o que ela tiver perdido"""
+    from sla import reconciliar_agenda_sla, verificar_sla
     
     try:
-        # Buscar pendências em risco
-        agora = datetime.utcnow()
-        alerta_antecedencia = Configuracao.get_valor('alerta_antecedencia', 30)
-        
-        pendencias_risco = Pendencia.query.filter(
-            Pendencia.status.in_(['aberta', 'em_andamento']),
-            Pendencia.prazo > agora,
-            Pendencia.prazo <= agora + timedelta(minutes=alerta_antecedencia)
-        ).all()
-        
-        for pendencia in pendencias_risco:
-            # Enviar notificação para o responsável
-            from routes import criar_notificacao
-            criar_notificacao(
-                usuario_id=pendencia.responsavel_id,
-                tipo='sla_vencendo',
-                titulo='SLA Vencendo',
-                mensagem=f'Pendência "{pendencia.descricao[:50]}..." vence em {(pendencia.prazo - agora).total_seconds() / 60:.0f} minutos',
-                link=f'/pendencias/{pendencia.id}'
-            )
-            
-            # Notificar gestores se for crítica
-            if pendencia.prioridade == 'critica':
-                gestores = Usuario.query.filter(
-                    Usuario.perfis.contains(['gestor']),
-                    Usuario.ativo == True
-                ).all()
-                
-                for gestor in gestores:
-                    criar_notificacao(
-                        usuario_id=gestor.id,
-                        tipo='sla_critico_vencendo',
-                        titulo='SLA Crítico Vencendo',
-                        mensagem=f'Pendência crítica vence em {(pendencia.prazo - agora).total_seconds() / 60:.0f} minutos',
-                        link=f'/pendencias/{pendencia.id}'
-                    )
-        
-        return f"Verificadas {len(pendencias_risco)} pendências em risco"
-        
+        # Rede de segurança: o alerta normal vem de despachar_alertas_sla
+        agendadas = reconciliar_agenda_sla()
+        alertadas = verificar_sla()
+        return f"Reagendadas {agendadas} pendências e alertadas {alertadas} em risco"
+    
     except Exception as e:
         self.retry(countdown=60, max_retries=3)
         raise e
 
 @celery.task(bind=True)
 def enviar_notificacoes_pendentes(self):
-    """Envia notificações pendentes (email, SMS, etc.)"""
-    from app import db
-    from models import Notificacao
+    """Envia notificações pendentes (email, SMS, push, webhook)"""
+    from models import Configuracao
+    from envio import enviar_notificacoes
     
     try:
-        # Buscar notificações pendentes
-        notificacoes = Notificacao.query.filter_by(
-            status='pendente',
-            tentativas__lt=3
-        ).limit(50).all()
-        
-        enviadas = 0
-        for notificacao in notificacoes:
-            try:
-                # Simular envio (em produção seria integração real)
-                if notificacao.tipo == 'email':
-                    # Enviar email
-                    pass
-                elif notificacao.tipo == 'sms':
-                    # Enviar SMS
-                    pass
-                elif notificacao.tipo == 'push':
-                    # Enviar push notification
-                    pass
-                
-                notificacao.status = 'enviado'
-                notificacao.enviado_em = datetime.utcnow()
-                enviadas += 1
-                
-            except Exception as e:
-                notificacao.tentativas += 1
-                if notificacao.tentativas >= 3:
-                    notificacao.status = 'falha'
-        
-        db.session.commit()
-        return f"Enviadas {enviadas} notificações"
-        
+        # Lotes reservados por worker: várias execuções em paralelo não repetem envios
+        enviadas, falhas = enviar_notificacoes(
+            lote=Configuracao.get_valor('envio_lote', 100),
+            janela_resumo=Configuracao.get_valor('email_resumo_segundos', 0)
+        )
+        return f"Enviadas {enviadas} notificações ({falhas} falhas)"
+    
     except Exception as e:
         self.retry(countdown=60, max_retries=3)
         raise e
@@ -181,50 +173,44 @@ def limpar_cache_antigo(self):
 @celery.task(bind=True)
 def backup_automatico(self):
     """Realiza backup automático do banco de dados"""
-    import subprocess
-    import os
-    from datetime import datetime
+    from app import db
+    from models import Backup
+    from backups import executar_backup, manter_ultimos_automaticos
     
     try:
-        # Criar diretório de backup
-        backup_dir = os.path.join(os.getcwd(), 'backups')
-        os.makedirs(backup_dir, exist_ok=True)
-        
-        # Nome do arquivo
-        timestamp = datetime.utcnow().strftime('%Y%m%d_%H%M%S')
-        backup_file = os.path.join(backup_dir, f'backup_auto_{timestamp}.sql')
+        backup = Backup(automatico=True)
+        db.session.add(backup)
+        db.session.commit()
         
-        # Comando de backup
-        cmd = [
-            'mysqldump',
-            '-u', 'root',
-            '-p12345678',
-            'passometro',
-            '--single-transaction',
-            '--skip-lock-tables'
-        ]
+        backup = executar_backup(backup.id)
         
-        with open(backup_file, 'w') as f:
-            result = subprocess.run(cmd, stdout=f, stderr=subprocess.PIPE, text=True)
+        # Manter apenas os últimos 7 backups automáticos
+        manter_ultimos_automaticos(7)
         
-        if result.returncode == 0:
-            # Manter apenas os últimos 7 backups
-            import glob
-            backups = glob.glob(os.path.join(backup_dir, 'backup_auto_*.sql'))
-            backups.sort()
-            
-            if len(backups) > 7:
-                for backup in backups[:-7]:
-                    os.remove(backup)
-            
-            return f"Backup automático criado: {os.path.basename(backup_file)}"
-        else:
-            raise Exception(f"Erro no backup: {result.stderr}")
+        return f"Backup automático criado: {backup.arquivo} ({backup.bytes} bytes, sha256 {backup.sha256})"
             
     except Exception as e:
         self.retry(countdown=3600, max_retries=2)
         raise e
 
+@celery.task(bind=True)
+def gerar_backup(self, backup_id):
+    """Gera um backup solicitado pela interface (progresso na linha de Backup)"""
+    from backups import executar_backup
+    
+    # Sem retry: a falha fica registrada no Backup e o gestor pode pedir outro
+    backup = executar_backup(backup_id)
+    return f"Backup {backup.id} concluído: {backup.arquivo}"
+
+@celery.task(bind=True, time_limit=4 * 60 * 60, soft_time_limit=4 * 60 * 60 - 60)
+def restaurar_backup(self, restauracao_id):
+    """Restaura um backup enviado pela interface (progresso na linha de Restauracao)"""
+    from backups import executar_restauracao
+    
+    # Sem retry: a falha fica registrada na Restauracao e os dados atuais ficam intactos
+    resultado = executar_restauracao(restauracao_id)
+    return f"Restauração {restauracao_id} concluída: {resultado['tabelas']} tabelas, {resultado['linhas']} linhas"
+
 @celery.task(bind=True)
 def gerar_relatorio_diario(self):
     """Gera relatório diário automático"""
@@ -252,32 +238,83 @@ def gerar_relatorio_diario(self):
 @celery.task(bind=True)
 def limpar_dados_antigos(self):
     """Limpa dados antigos do sistema"""
-    from app import db
-    from models import Notificacao, Auditoria
-    from datetime import datetime, timedelta
+    from arquivamento import arquivar_auditoria
     
     try:
-        # Limpar notificações antigas (mais de 30 dias)
-        data_limite = datetime.utcnow() - timedelta(days=30)
-        
-        notificacoes_removidas = Notificacao.query.filter(
-            Notificacao.enviado_em < data_limite
-        ).delete()
+        # Notificações seguem a política de retenção (aplicar_politica_retencao)
+        # Auditoria antiga (mais de 90 dias) vai para arquivos verificados, bloco a bloco
+        blocos, auditoria_arquivada = arquivar_auditoria(dias=90)
         
-        # Limpar auditoria antiga (mais de 90 dias)
-        data_limite_auditoria = datetime.utcnow() - timedelta(days=90)
+        return f"Arquivados {auditoria_arquivada} registros de auditoria em {blocos} blocos"
+    
+    except Exception as e:
+        self.retry(countdown=3600, max_retries=2)
+        raise e
+
+@celery.task(bind=True)
+def aplicar_politica_retencao(self):
+    """Remove notificações, relatórios, backups e temporários expirados pela política de retenção"""
+    from retencao import aplicar_retencao
+    
+    try:
+        resultado = aplicar_retencao()
+        linhas = sum(metricas.get('linhas', 0) for metricas in resultado.values())
+        arquivos = sum(metricas.get('arquivos', 0) for metricas in resultado.values())
+        liberados = sum(metricas['bytes'] or 0 for metricas in resultado.values())
+        return f"Removidas {linhas} linhas e {arquivos} arquivos ({liberados} bytes)"
         
-        auditoria_removida = Auditoria.query.filter(
-            Auditoria.timestamp < data_limite_auditoria
-        ).delete()
+    except Exception as e:
+        self.retry(countdown=3600, max_retries=2)
+        raise e
+
+@celery.task(bind=True)
+def compactar_log_alteracoes(self):
+    """Compacta o log de alterações usado na sincronização incremental"""
+    from alteracoes import compactar_log_alteracoes as compactar
+    
+    try:
+        compactadas, expiradas = compactar()
+        return f"Compactadas {compactadas} entradas e expiradas {expiradas} do log de alterações"
         
-        db.session.commit()
+    except Exception as e:
+        self.retry(countdown=3600, max_retries=2)
+        raise e
+
+@celery.task(bind=True)
+def limpar_chaves_idempotencia(self):
+    """Remove chaves de idempotência expiradas"""
+    from idempotencia import limpar_chaves_expiradas
+    
+    try:
+        removidas = limpar_chaves_expiradas()
+        return f"Removidas {removidas} chaves de idempotência expiradas"
         
-        return f"Removidas {notificacoes_removidas} notificações e {auditoria_removida} registros de auditoria"
+    except Exception as e:
+        self.retry(countdown=600, max_retries=3)
+        raise e
+
+@celery.task(bind=True)
+def selar_auditoria(self):
+    """Encadeia as novas linhas da auditoria e grava checkpoints Merkle"""
+    from cache import cache
+    from integridade import selar_auditoria as selar
+    
+    # Uma execução por vez: duas cadeias concorrentes divergiriam. A trava é
+    # renovada a cada lote, então uma selagem longa não a perde no meio
+    trava = cache.redis_client.lock('auditoria:selar', timeout=120) if cache.redis_client else None
+    if trava and not trava.acquire(blocking=False):
+        return "Selagem já em andamento"
+    
+    try:
+        seladas, checkpoints = selar(renovar=trava.reacquire if trava else None)
+        return f"Seladas {seladas} linhas de auditoria e criados {checkpoints} checkpoints"
         
     except Exception as e:
-        self.retry(countdown=3600, max_retries=2)
+        self.retry(countdown=300, max_retries=2)
         raise e
+    finally:
+        if trava:
+            trava.release()
 
 @celery.task(bind=True)
 def processar_upload_arquivo(self, arquivo_path, registro_id):
@@ -312,20 +349,21 @@ def processar_upload_arquivo(self, arquivo_path, registro_id):
 
 @celery.task(bind=True)
 def enviar_email_notificacao(self, destinatario, assunto, mensagem):
-    """Envia email de notificação de forma assíncrona"""
+    """Enfileira email de notificação para o despachante (pool SMTP e resumo por destinatário)"""
+    from app import db
+    from models import Notificacao
+    
     try:
-        # Aqui seria integração com serviço de email (SendGrid, AWS SES, etc.)
-        # Por enquanto, apenas simula o envio
-        
-        # Simular delay de envio
-        import time
-        time.sleep(2)
+        notificacao = Notificacao(
+            tipo='email',
+            destino=destinatario,
+            payload={'assunto': assunto, 'mensagem': mensagem}
+        )
+        db.session.add(notificacao)
+        db.session.commit()
         
-        return f"Email enviado para {destinatario}"
+        return f"Email para {destinatario} enfileirado (notificação {notificacao.id})"
         
     except Exception as e:
         self.retry(countdown=300, max_retries=3)
         raise e
-
-# Inicialização do Celery
-celery = None 
\ No newline at end of file
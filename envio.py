@@ -0,0 +1,251 @@
+from sqlalchemy import select, or_, bindparam
+from datetime import datetime, timedelta
+from uuid import uuid4
+import asyncio
+import os
+import random
+import socket
+import time
+from app import app, db
+from cache import cache
+from models import Notificacao
+from canais import ErroPermanente, CanalSMTP, canais_padrao
+
+MAX_TENTATIVAS = 3
+RESERVA_SEGUNDOS = 300  # Reservas de um worker que morreu voltam à fila após este prazo
+BACKOFF_BASE = 30
+BACKOFF_MAXIMO = 3600
+
+def identificador_worker():
+    return f'{socket.gethostname()}:{os.getpid()}:{uuid4().hex[:8]}'
+
+_canal_email = None
+
+def canal_email():
+    """CanalSMTP do processo (o pool de conexões vale para todos os lotes); None sem MAIL_SERVER"""
+    global _canal_email
+    if _canal_email is None and app.config.get('MAIL_SERVER'):
+        _canal_email = CanalSMTP(
+            app.config['MAIL_SERVER'], app.config.get('MAIL_PORT', 25),
+            usuario=app.config.get('MAIL_USERNAME'), senha=app.config.get('MAIL_PASSWORD'),
+            tls=app.config.get('MAIL_USE_TLS', False), remetente=app.config.get('MAIL_DEFAULT_SENDER')
+        )
+    return _canal_email
+
+def canais_configurados():
+    """Canais por tipo: app.config['NOTIFICACAO_CANAIS'] sobrescreve os padrões (ex.: testes)"""
+    canais = canais_padrao()
+    if canal_email():
+        canais['email'] = canal_email()
+    return {**canais, **app.config.get('NOTIFICACAO_CANAIS', {})}
+
+def _chave_destino(prefixo, tipo, destino):
+    return f'envio:{prefixo}:{tipo}:{destino}'
+
+def _atraso(falhas):
+    """Backoff exponencial com jitter completo: uniforme entre 0 e BASE * 2^(falhas - 1)"""
+    return random.uniform(0, min(BACKOFF_MAXIMO, BACKOFF_BASE * 2 ** (falhas - 1)))
+
+def _adiar_destino(tipo, destino, tentativas):
+    """Segundos até a próxima tentativa no destino após uma falha
+    
+    Com Redis o contador de falhas é do destino (compartilhado entre
+    notificações e workers) e o destino fica adiado pelo atraso sorteado;
+    sem Redis vale o número de tentativas da própria notificação.
+    """
+    if not cache.redis_client:
+        return _atraso(tentativas)
+    try:
+        chave = _chave_destino('falhas', tipo, destino)
+        pipe = cache.redis_client.pipeline()
+        pipe.incr(chave)
+        pipe.expire(chave, BACKOFF_MAXIMO * 2)
+        atraso = _atraso(max(pipe.execute()[0], tentativas))
+        cache.redis_client.set(_chave_destino('adiado', tipo, destino), 1, px=max(1, int(atraso * 1000)))
+        return atraso
+    except Exception:
+        return _atraso(tentativas)
+
+def _destinos_adiados(notificacoes):
+    """{(tipo, destino): segundos restantes} dos destinos em backoff"""
+    destinos = list({(n['tipo'], n['destino']) for n in notificacoes})
+    if not cache.redis_client or not destinos:
+        return {}
+    try:
+        pipe = cache.redis_client.pipeline()
+        for tipo, destino in destinos:
+            pipe.pttl(_chave_destino('adiado', tipo, destino))
+        return {destino: restante / 1000 for destino, restante in zip(destinos, pipe.execute()) if restante > 0}
+    except Exception:
+        return {}
+
+def _limpar_falhas_destino(destinos):
+    if cache.redis_client and destinos:
+        try:
+            cache.redis_client.delete(*(
+                _chave_destino(prefixo, tipo, destino)
+                for tipo, destino in destinos for prefixo in ('falhas', 'adiado')
+            ))
+        except Exception:
+            pass
+
+def reservar_notificacoes(dono, lote=100, agora=None, janela_resumo=0):
+    """Reserva até `lote` notificações prontas para envio em nome de `dono`
+    
+    As linhas são travadas com SKIP LOCKED e recebem uma reserva com
+    validade, gravada na mesma transação curta: workers concorrentes pegam
+    lotes disjuntos e a reserva de um worker que morreu expira sozinha.
+    Com `janela_resumo` (segundos) os emails só saem depois da janela, para
+    que os do mesmo destinatário sigam juntos.
+    """
+    agora = agora or datetime.utcnow()
+    filtros = []
+    if janela_resumo:
+        filtros.append(or_(
+            Notificacao.tipo != 'email',
+            Notificacao.enviado_em <= agora - timedelta(seconds=janela_resumo)
+        ))
+    linhas = db.session.execute(
+        select(Notificacao.id, Notificacao.tipo, Notificacao.destino, Notificacao.payload, Notificacao.tentativas)
+        .where(
+            Notificacao.status == 'pendente',
+            Notificacao.tentativas < MAX_TENTATIVAS,
+            or_(Notificacao.proxima_tentativa.is_(None), Notificacao.proxima_tentativa <= agora),
+            or_(Notificacao.reservada_ate.is_(None), Notificacao.reservada_ate < agora),
+            *filtros
+        )
+        .order_by(Notificacao.id).limit(lote)
+        .with_for_update(skip_locked=True)
+    ).all()
+    if linhas:
+        db.session.execute(
+            Notificacao.__table__.update()
+            .where(Notificacao.id.in_([linha.id for linha in linhas]))
+            .values(reservada_ate=agora + timedelta(seconds=RESERVA_SEGUNDOS), reservada_por=dono)
+        )
+    db.session.commit()
+    return [linha._asdict() for linha in linhas]
+
+def agrupar_resumos(notificacoes):
+    """Envios do lote: os emails de cada destinatário viram um só, com 'resumo' = payloads"""
+    envios, resumos = [], {}
+    for notificacao in notificacoes:
+        if notificacao['tipo'] != 'email':
+            envios.append({**notificacao, 'notificacoes': [notificacao]})
+            continue
+        envio = resumos.get(notificacao['destino'])
+        if envio is None:
+            envio = resumos[notificacao['destino']] = {**notificacao, 'resumo': [], 'notificacoes': []}
+            envios.append(envio)
+        envio['resumo'].append(notificacao['payload'])
+        envio['notificacoes'].append(notificacao)
+    return envios
+
+async def _enviar_todas(notificacoes, canais):
+    """[(notificação, exceção ou None)] enviando em paralelo, limitado por canal"""
+    limites = {tipo: asyncio.Semaphore(canal.CONCORRENCIA) for tipo, canal in canais.items()}
+    
+    async def enviar(notificacao):
+        canal = canais.get(notificacao['tipo'])
+        if canal is None:
+            return notificacao, ErroPermanente(f"Canal desconhecido: {notificacao['tipo']}")
+        async with limites[notificacao['tipo']]:
+            try:
+                await canal.enviar(notificacao)
+                return notificacao, None
+            except Exception as e:
+                return notificacao, e
+    
+    try:
+        return await asyncio.gather(*(enviar(notificacao) for notificacao in notificacoes))
+    finally:
+        for canal in canais.values():
+            await canal.fechar()
+
+def _gravar_resultados(dono, resultados, adiadas, agora):
+    """Grava envios, falhas e adiamentos em uma transação, só nas linhas ainda reservadas por `dono`"""
+    tabela = Notificacao.__table__
+    enviadas = [notificacao['id'] for notificacao, erro in resultados if erro is None]
+    falhas = []
+    atrasos = {}  # Uma falha por destino e lote, mesmo com várias notificações para ele
+    for notificacao, erro in resultados:
+        if erro is None:
+            continue
+        tentativas = notificacao['tentativas'] + 1
+        encerrar = isinstance(erro, ErroPermanente) or tentativas >= MAX_TENTATIVAS
+        destino = (notificacao['tipo'], notificacao['destino'])
+        if not encerrar and destino not in atrasos:
+            atrasos[destino] = _adiar_destino(*destino, tentativas)
+        atraso = atrasos.get(destino, 0)
+        falhas.append({
+            'id_': notificacao['id'],
+            'status': 'falha' if encerrar else 'pendente',
+            'tentativas': tentativas,
+            'proxima_tentativa': None if encerrar else agora + timedelta(seconds=atraso),
+            'ultimo_erro': str(erro)[:500] or type(erro).__name__
+        })
+    
+    if enviadas:
+        db.session.execute(
+            tabela.update()
+            .where(tabela.c.id.in_(enviadas), tabela.c.reservada_por == dono)
+            .values(status='enviado', enviado_em=agora, reservada_ate=None, reservada_por=None)
+        )
+    if falhas:
+        db.session.execute(
+            tabela.update()
+            .where(tabela.c.id == bindparam('id_'), tabela.c.reservada_por == dono)
+            .values(
+                status=bindparam('status'), tentativas=bindparam('tentativas'),
+                proxima_tentativa=bindparam('proxima_tentativa'), ultimo_erro=bindparam('ultimo_erro'),
+                reservada_ate=None, reservada_por=None
+            ),
+            falhas
+        )
+    if adiadas:
+        # Destino em backoff: volta à fila sem gastar tentativa
+        db.session.execute(
+            tabela.update()
+            .where(tabela.c.id == bindparam('id_'), tabela.c.reservada_por == dono)
+            .values(proxima_tentativa=bindparam('proxima_tentativa'), reservada_ate=None, reservada_por=None),
+            [{'id_': notificacao['id'], 'proxima_tentativa': agora + timedelta(seconds=restante)}
+             for notificacao, restante in adiadas]
+        )
+    db.session.commit()
+    
+    _limpar_falhas_destino({(n['tipo'], n['destino']) for n, erro in resultados if erro is None})
+    return len(enviadas), len(falhas)
+
+def enviar_notificacoes(lote=100, tempo_maximo=50, canais=None, janela_resumo=0):
+    """Reserva e envia lotes até esvaziar a fila ou passar `tempo_maximo` segundos
+    
+    Cada worker trabalha nos próprios lotes, então a vazão cresce com o
+    número de workers. Destinos com falhas seguidas são adiados com backoff
+    exponencial e jitter. Com `janela_resumo` os emails de um destinatário
+    acumulados na janela saem numa única mensagem. Retorna (enviadas, falhas),
+    contadas por notificação.
+    """
+    dono = identificador_worker()
+    inicio = time.monotonic()
+    total_enviadas = total_falhas = 0
+    
+    while time.monotonic() - inicio < tempo_maximo:
+        notificacoes = reservar_notificacoes(dono, lote, janela_resumo=janela_resumo)
+        if not notificacoes:
+            break
+        adiados = _destinos_adiados(notificacoes)
+        adiadas = [(n, adiados[(n['tipo'], n['destino'])]) for n in notificacoes if (n['tipo'], n['destino']) in adiados]
+        prontas = [n for n in notificacoes if (n['tipo'], n['destino']) not in adiados]
+        envios = agrupar_resumos(prontas) if janela_resumo else [{**n, 'notificacoes': [n]} for n in prontas]
+        resultados = [
+            (notificacao, erro)
+            for envio, erro in (asyncio.run(_enviar_todas(envios, canais or canais_configurados())) if envios else [])
+            for notificacao in envio['notificacoes']
+        ]
+        enviadas, falhas = _gravar_resultados(dono, resultados, adiadas, datetime.utcnow())
+        total_enviadas += enviadas
+        total_falhas += falhas
+        if len(notificacoes) < lote:
+            break
+    
+    return total_enviadas, total_falhas
@@ -0,0 +1,113 @@
+from sqlalchemy import event, inspect
+from itertools import chain
+import json
+import time
+from cache import cache
+from models import Pendencia, Plantao, NotificacaoSistema
+
+PREFIXO_CANAL = 'eventos'
+
+def canal_usuario(usuario_id):
+    return f'{PREFIXO_CANAL}:usuario:{usuario_id}'
+
+def canal_posto(posto_id):
+    return f'{PREFIXO_CANAL}:posto:{posto_id}'
+
+def canal_global():
+    return f'{PREFIXO_CANAL}:global'
+
+def publicar(canal, tipo, dados):
+    """Publica um evento no Redis pub/sub (ignorado sem Redis)"""
+    if not cache.redis_client:
+        return False
+    
+    try:
+        cache.redis_client.publish(canal, json.dumps({'tipo': tipo, 'dados': dados}, default=str))
+        return True
+    except Exception:
+        return False
+
+@event.listens_for(Pendencia.prioridade, 'set', active_history=True)
+def _carregar_prioridade_anterior(target, valor, anterior, initiator):
+    """Só para ativar active_history: mesmo numa pendência expirada (após um
+    commit) o valor anterior é carregado e fica no histórico do atributo"""
+
+def _deixou_de_ser_critica(obj):
+    """A prioridade era crítica antes desta gravação (histórico lido no after_flush)"""
+    return 'critica' in inspect(obj).attrs.prioridade.history.deleted
+
+def _eventos_do_objeto(obj):
+    """Eventos (canal, tipo, dados) gerados pela gravação de um objeto"""
+    if isinstance(obj, NotificacaoSistema):
+        return [(canal_usuario(obj.usuario_id), 'notificacao', {
+            'id': obj.id,
+            'tipo': obj.tipo,
+            'titulo': obj.titulo
+        })]
+    
+    # Rebaixar uma pendência crítica também avisa, para o alerta sumir das telas
+    if isinstance(obj, Pendencia) and (obj.prioridade == 'critica' or _deixou_de_ser_critica(obj)):
+        return [(canal_global(), 'pendencia_critica', {
+            'id': obj.id,
+            'status': obj.status,
+            'prioridade': obj.prioridade
+        })]
+    
+    if isinstance(obj, Plantao):
+        dados = {'id': obj.id, 'status': obj.status}
+        return [
+            (canal_usuario(obj.usuario_id), 'plantao_status', dados),
+            (canal_posto(obj.posto_id), 'plantao_status', dados)
+        ]
+    
+    return []
+
+def registrar_publicacao_eventos(session):
+    """Publica eventos de tempo real após o commit das gravações relevantes
+    
+    Updates em massa não passam por aqui; quem os executa publica o evento
+    diretamente (ver marcar_todas_notificacoes_lidas).
+    """
+    info_key = 'eventos_pendentes'
+    
+    @event.listens_for(session, 'after_flush')
+    def after_flush(session, flush_context):
+        pendentes = session.info.setdefault(info_key, [])
+        for obj in chain(session.new, session.dirty):
+            pendentes.extend(_eventos_do_objeto(obj))
+    
+    @event.listens_for(session, 'after_commit')
+    def after_commit(session):
+        for canal, tipo, dados in session.info.pop(info_key, []):
+            publicar(canal, tipo, dados)
+    
+    @event.listens_for(session, 'after_rollback')
+    def after_rollback(session):
+        session.info.pop(info_key, None)
+
+def stream_eventos(canais, heartbeat=15):
+    """Gerador Server-Sent Events para os canais informados
+    
+    Envia um comentário a cada `heartbeat` segundos sem eventos para manter a
+    conexão viva atrás de proxies e detectar clientes desconectados.
+    """
+    pubsub = cache.redis_client.pubsub(ignore_subscribe_messages=True)
+    pubsub.subscribe(*canais)
+    
+    try:
+        yield 'retry: 5000\n\n'
+        ultimo_envio = time.monotonic()
+        while True:
+            # None também é devolvido para confirmações de inscrição ignoradas
+            mensagem = pubsub.get_message(timeout=heartbeat)
+            if mensagem is None:
+                if time.monotonic() - ultimo_envio >= heartbeat:
+                    ultimo_envio = time.monotonic()
+                    yield ': ping\n\n'
+                continue
+            
+            ultimo_envio = time.monotonic()
+            evento = json.loads(mensagem['data'])
+            yield f"event: {evento['tipo']}\ndata: {json.dumps(evento['dados'])}\n\n"
+    finally:
+        pubsub.close()
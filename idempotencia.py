@@ -0,0 +1,287 @@
+from flask import current_app, request, g, jsonify
+from flask_login import current_user
+from sqlalchemy.exc import IntegrityError
+from datetime import datetime, timedelta
+import json
+import jwt
+import os
+import time
+import uuid
+from app import db
+from cache import cache
+from models import ChaveIdempotencia
+
+# Por quanto tempo uma resposta pode ser reaproveitada
+TTL_PADRAO = timedelta(hours=24)
+TAMANHO_MAXIMO_CHAVE = 64
+# Tempo máximo de uma primeira execução; duplicatas aguardam até este limite
+TEMPO_EM_ANDAMENTO = 60
+INTERVALO_ESPERA = 0.1
+
+METODOS_IDEMPOTENTES = ('POST', 'PUT', 'PATCH', 'DELETE')
+HEADER_CHAVE = 'Idempotency-Key'
+CAMPO_FORMULARIO = 'idempotency_key'
+HEADERS_REPETIDOS = ('content-type', 'location')
+
+def chave_valida(chave):
+    return isinstance(chave, str) and 0 < len(chave) <= TAMANHO_MAXIMO_CHAVE
+
+def respostas_registradas(usuario_id, chaves):
+    """Respostas já gravadas para as chaves, como {chave: (status, corpo)}"""
+    if not chaves:
+        return {}
+    
+    registradas = ChaveIdempotencia.query.filter(
+        ChaveIdempotencia.usuario_id == usuario_id,
+        ChaveIdempotencia.chave.in_(list(chaves)),
+        ChaveIdempotencia.status_code.isnot(None),
+        ChaveIdempotencia.expira_em > datetime.utcnow()
+    ).all()
+    return {
+        r.chave: (r.status_code, json.loads(r.resposta) if r.resposta else None)
+        for r in registradas
+    }
+
+def registrar_resposta(usuario_id, chave, rota, status_code, corpo, ttl=TTL_PADRAO):
+    """Grava a resposta na transação corrente, junto com o efeito da operação
+    
+    Como a chave e o efeito são confirmados no mesmo commit, uma repetição
+    nunca encontra o efeito sem a resposta (ou vice-versa). Uma resposta
+    expirada que limpar_chaves_expiradas ainda não removeu conta como
+    ausente (respostas_registradas a ignora) e é substituída.
+    """
+    agora = datetime.utcnow()
+    ChaveIdempotencia.query.filter(
+        ChaveIdempotencia.usuario_id == usuario_id,
+        ChaveIdempotencia.chave == chave,
+        ChaveIdempotencia.expira_em <= agora
+    ).delete(synchronize_session=False)
+    db.session.add(ChaveIdempotencia(
+        chave=chave,
+        usuario_id=usuario_id,
+        rota=rota,
+        status_code=status_code,
+        resposta=json.dumps(corpo, default=str) if corpo is not None else None,
+        criada_em=agora,
+        expira_em=agora + ttl
+    ))
+
+def limpar_chaves_expiradas(lote=1000):
+    """Remove chaves expiradas em lotes"""
+    removidas = 0
+    while True:
+        ids = [i for (i,) in db.session.query(ChaveIdempotencia.id).filter(
+            ChaveIdempotencia.expira_em <= datetime.utcnow()
+        ).limit(lote)]
+        if not ids:
+            break
+        removidas += ChaveIdempotencia.query.filter(
+            ChaveIdempotencia.id.in_(ids)
+        ).delete(synchronize_session=False)
+        db.session.commit()
+    return removidas
+
+class ArmazenamentoRedis:
+    """Respostas de idempotência no Redis (reserva atômica com SET NX)"""
+    
+    PREFIX = 'idempotencia'
+    
+    def _key(self, usuario_id, chave):
+        return f"{self.PREFIX}:{usuario_id}:{chave}"
+    
+    def reservar(self, usuario_id, chave, rota):
+        """Reserva a chave para esta execução; devolve a entrada existente se já houver"""
+        reservada = cache.redis_client.set(
+            self._key(usuario_id, chave),
+            json.dumps({'rota': rota, 'status_code': None}),
+            nx=True, ex=TEMPO_EM_ANDAMENTO
+        )
+        return None if reservada else self.buscar(usuario_id, chave)
+    
+    def buscar(self, usuario_id, chave):
+        valor = cache.redis_client.get(self._key(usuario_id, chave))
+        return json.loads(valor) if valor else None
+    
+    def gravar(self, usuario_id, chave, rota, status_code, headers, corpo):
+        cache.redis_client.set(self._key(usuario_id, chave), json.dumps({
+            'rota': rota,
+            'status_code': status_code,
+            'headers': headers,
+            'corpo': corpo
+        }), ex=int(TTL_PADRAO.total_seconds()))
+    
+    def liberar(self, usuario_id, chave):
+        cache.redis_client.delete(self._key(usuario_id, chave))
+
+class ArmazenamentoBanco:
+    """Respostas de idempotência na tabela chaves_idempotencia (sem Redis)
+    
+    Usa uma conexão própria para que a reserva fique visível às requisições
+    concorrentes antes do commit da transação da view.
+    """
+    
+    tabela = ChaveIdempotencia.__table__
+    
+    def reservar(self, usuario_id, chave, rota):
+        agora = datetime.utcnow()
+        with db.engine.begin() as conexao:
+            # Reserva abandonada (worker caiu) ou resposta expirada
+            conexao.execute(self.tabela.delete().where(
+                self.tabela.c.usuario_id == usuario_id,
+                self.tabela.c.chave == chave,
+                self.tabela.c.expira_em <= agora
+            ))
+        try:
+            with db.engine.begin() as conexao:
+                conexao.execute(self.tabela.insert().values(
+                    chave=chave,
+                    usuario_id=usuario_id,
+                    rota=rota,
+                    criada_em=agora,
+                    expira_em=agora + timedelta(seconds=TEMPO_EM_ANDAMENTO)
+                ))
+            return None
+        except IntegrityError:
+            return self.buscar(usuario_id, chave)
+    
+    def buscar(self, usuario_id, chave):
+        with db.engine.connect() as conexao:
+            linha = conexao.execute(self.tabela.select().where(
+                self.tabela.c.usuario_id == usuario_id,
+                self.tabela.c.chave == chave
+            )).mappings().first()
+        if not linha:
+            return None
+        return {
+            'rota': linha['rota'],
+            'status_code': linha['status_code'],
+            'headers': linha['headers'],
+            'corpo': linha['resposta']
+        }
+    
+    def gravar(self, usuario_id, chave, rota, status_code, headers, corpo):
+        with db.engine.begin() as conexao:
+            conexao.execute(self.tabela.update().where(
+                self.tabela.c.usuario_id == usuario_id,
+                self.tabela.c.chave == chave
+            ).values(
+                status_code=status_code,
+                headers=headers,
+                resposta=corpo,
+                expira_em=datetime.utcnow() + TTL_PADRAO
+            ))
+    
+    def liberar(self, usuario_id, chave):
+        with db.engine.begin() as conexao:
+            conexao.execute(self.tabela.delete().where(
+                self.tabela.c.usuario_id == usuario_id,
+                self.tabela.c.chave == chave,
+                self.tabela.c.status_code.is_(None)
+            ))
+
+def _armazenamento():
+    return ArmazenamentoRedis() if cache.redis_client else ArmazenamentoBanco()
+
+def _principal():
+    """Id do usuário da sessão ou do token JWT (sem consultar o banco)"""
+    # Sub-requisições de /batch: o token já foi validado pela requisição externa
+    usuario = g.get('api_usuario')
+    if usuario is not None:
+        return usuario.id
+    if current_user.is_authenticated:
+        return current_user.id
+    
+    autorizacao = request.headers.get('Authorization', '')
+    if autorizacao.startswith('Bearer '):
+        try:
+            payload = jwt.decode(autorizacao[7:], os.getenv('JWT_SECRET_KEY', 'dev-secret'), algorithms=['HS256'])
+            return payload.get('user_id')
+        except jwt.InvalidTokenError:
+            return None
+    return None
+
+def _resposta_repetida(entrada):
+    response = current_app.response_class(
+        entrada['corpo'] or '',
+        status=entrada['status_code'],
+        headers=entrada['headers'] or {}
+    )
+    response.headers['Idempotent-Replayed'] = 'true'
+    return response
+
+def registrar_idempotencia(app):
+    """Honra o header Idempotency-Key (ou o campo oculto idempotency_key) em escritas
+    
+    A primeira requisição com a chave reserva-a e executa normalmente; sua
+    resposta (exceto 5xx) é guardada por TTL_PADRAO. Repetições devolvem a
+    resposta guardada e, se a primeira ainda estiver em andamento, aguardam
+    por ela em vez de executar de novo.
+    """
+    # Formulários incluem {{ chave_idempotencia() }} no campo oculto
+    app.jinja_env.globals['chave_idempotencia'] = lambda: uuid.uuid4().hex
+    
+    @app.before_request
+    def verificar_chave_idempotencia():
+        if request.method not in METODOS_IDEMPOTENTES:
+            return None
+        
+        chave = request.headers.get(HEADER_CHAVE) or request.form.get(CAMPO_FORMULARIO)
+        if not chave:
+            return None
+        if not chave_valida(chave):
+            return jsonify({'message': f'{HEADER_CHAVE} inválida'}), 400
+        
+        usuario_id = _principal()
+        if usuario_id is None:
+            return None
+        
+        rota = f"{request.method} {request.path}"
+        armazenamento = _armazenamento()
+        entrada = armazenamento.reservar(usuario_id, chave, rota)
+        
+        limite = time.monotonic() + TEMPO_EM_ANDAMENTO
+        while entrada is not None and entrada['status_code'] is None:
+            if time.monotonic() >= limite:
+                return jsonify({'message': 'Requisição com esta chave ainda em processamento'}), 409
+            time.sleep(INTERVALO_ESPERA)
+            entrada = armazenamento.buscar(usuario_id, chave)
+            if entrada is None:
+                # A primeira execução falhou e liberou a chave: esta assume
+                entrada = armazenamento.reservar(usuario_id, chave, rota)
+        
+        if entrada is not None:
+            if entrada['rota'] != rota:
+                return jsonify({'message': f'{HEADER_CHAVE} já usada em outra operação'}), 422
+            return _resposta_repetida(entrada)
+        
+        g.idempotencia = (armazenamento, usuario_id, chave, rota)
+        return None
+    
+    @app.after_request
+    def gravar_resposta_idempotente(response):
+        pendente = g.pop('idempotencia', None)
+        if pendente is None:
+            return response
+        
+        armazenamento, usuario_id, chave, rota = pendente
+        corpo = None
+        if response.status_code < 500 and not response.direct_passthrough:
+            try:
+                corpo = response.get_data(as_text=False).decode('utf-8')
+            except UnicodeDecodeError:
+                corpo = None
+        
+        if corpo is None:
+            armazenamento.liberar(usuario_id, chave)
+        else:
+            headers = {k: v for k, v in response.headers.items() if k.lower() in HEADERS_REPETIDOS}
+            armazenamento.gravar(usuario_id, chave, rota, response.status_code, headers, corpo)
+        return response
+    
+    @app.teardown_request
+    def liberar_chave_idempotencia(exc):
+        # Exceção não tratada: after_request não rodou
+        pendente = g.pop('idempotencia', None)
+        if pendente is not None:
+            armazenamento, usuario_id, chave, _ = pendente
+            armazenamento.liberar(usuario_id, chave)
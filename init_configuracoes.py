@@ -5,6 +5,8 @@ Script para inicializar as configurações padrão do sistema
 
 from app import app, db
 from models import Configuracao
+from retencao import POLITICA_PADRAO
+import json
 
 def init_configuracoes():
     """Inicializa as configurações padrão do sistema"""
@@ -24,6 +26,9 @@ def init_configuracoes():
         Configuracao.set_valor('alerta_sla', True, 'bool', 'Alertar quando SLA estiver próximo do vencimento')
         Configuracao.set_valor('alerta_antecedencia', 30, 'int', 'Antecedência do alerta em minutos')
         
+        # Retenção: {alvo: {dias, max_linhas | max_arquivos}}; null desativa o alvo
+        Configuracao.set_valor('politica_retencao', json.dumps(POLITICA_PADRAO), 'json', 'Política de retenção por tabela/diretório')
+        
         print("✅ Configurações padrão inicializadas com sucesso!")
         
         # Listar configurações criadas
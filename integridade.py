@@ -0,0 +1,342 @@
+from sqlalchemy import select, update, bindparam
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+import hashlib
+import json
+from app import app, db
+from models import Auditoria, CheckpointAuditoria, ArquivoAuditoria, Registro
+
+# Linhas por checkpoint: a prova de inclusão tem log2(BLOCO) hashes
+BLOCO = 1024
+HASH_INICIAL = '0' * 64
+
+COLUNAS = (Auditoria.id, Auditoria.objeto, Auditoria.objeto_id, Auditoria.acao, Auditoria.antes,
+           Auditoria.depois, Auditoria.versao, Auditoria.snapshot, Auditoria.autor_id,
+           Auditoria.timestamp, Auditoria.assinatura_digital, Auditoria.posicao)
+
+def _json(valor):
+    return json.dumps(valor, sort_keys=True, separators=(',', ':'), ensure_ascii=False, default=str)
+
+def hash_folha(linha):
+    """Hash do conteúdo de uma linha de auditoria (folha da árvore Merkle)"""
+    conteudo = _json({
+        'id': linha.id,
+        'objeto': linha.objeto,
+        'objeto_id': linha.objeto_id,
+        'acao': linha.acao,
+        'antes': linha.antes,
+        'depois': linha.depois,
+        'versao': linha.versao,
+        'snapshot': bool(linha.snapshot),
+        'autor_id': linha.autor_id,
+        'timestamp': linha.timestamp.isoformat() if linha.timestamp else None
+    })
+    return hashlib.sha256(b'\x00' + conteudo.encode()).digest()
+
+def encadear(hash_anterior, folha):
+    """Hash encadeado (hex) de uma linha a partir do hash da linha anterior"""
+    return hashlib.sha256(bytes.fromhex(hash_anterior) + folha).hexdigest()
+
+def _no(esquerda, direita):
+    return hashlib.sha256(b'\x01' + esquerda + direita).digest()
+
+def raiz_merkle(folhas):
+    """Raiz (hex) da árvore; um nó sem par sobe de nível sem ser rehasheado"""
+    nivel = list(folhas)
+    if not nivel:
+        return HASH_INICIAL
+    while len(nivel) > 1:
+        proximo = [_no(nivel[i], nivel[i + 1]) for i in range(0, len(nivel) - 1, 2)]
+        if len(nivel) % 2:
+            proximo.append(nivel[-1])
+        nivel = proximo
+    return nivel[0].hex()
+
+def caminho_merkle(folhas, indice):
+    """Irmãos do caminho folha -> raiz: [(hash hex, 'e' ou 'd'), ...]"""
+    caminho = []
+    nivel = list(folhas)
+    while len(nivel) > 1:
+        irmao = indice ^ 1
+        if irmao < len(nivel):
+            caminho.append((nivel[irmao].hex(), 'e' if irmao < indice else 'd'))
+        proximo = [_no(nivel[i], nivel[i + 1]) for i in range(0, len(nivel) - 1, 2)]
+        if len(nivel) % 2:
+            proximo.append(nivel[-1])
+        nivel = proximo
+        indice //= 2
+    return caminho
+
+def verificar_prova(folha_hex, caminho, raiz_hex):
+    """Confere uma prova de inclusão sem acesso ao banco"""
+    atual = bytes.fromhex(folha_hex)
+    for irmao, lado in caminho:
+        irmao = bytes.fromhex(irmao)
+        atual = _no(irmao, atual) if lado == 'e' else _no(atual, irmao)
+    return atual.hex() == raiz_hex
+
+def _linhas(primeira_posicao, ultima_posicao=None, lote=1000):
+    """Linhas seladas da auditoria na ordem da cadeia, lidas em streaming"""
+    consulta = select(*COLUNAS).where(Auditoria.posicao >= primeira_posicao).order_by(Auditoria.posicao)
+    if ultima_posicao is not None:
+        consulta = consulta.where(Auditoria.posicao <= ultima_posicao)
+    return db.session.execute(consulta.execution_options(yield_per=lote))
+
+def _topo_cadeia():
+    """(posição, hash) da última linha selada; com a auditoria arquivada, vem do último checkpoint"""
+    ultima = db.session.execute(
+        select(Auditoria.posicao, Auditoria.assinatura_digital)
+        .where(Auditoria.posicao.isnot(None))
+        .order_by(Auditoria.posicao.desc()).limit(1)
+    ).first()
+    if ultima:
+        return ultima.posicao, ultima.assinatura_digital
+    checkpoint = db.session.execute(
+        select(CheckpointAuditoria.ultima_posicao, CheckpointAuditoria.hash_final)
+        .order_by(CheckpointAuditoria.ultima_posicao.desc()).limit(1)
+    ).first()
+    return (checkpoint.ultima_posicao, checkpoint.hash_final) if checkpoint else (0, HASH_INICIAL)
+
+def selar_auditoria(lote=BLOCO, renovar=None):
+    """Encadeia as linhas ainda sem selo e grava os checkpoints dos blocos completos
+    
+    A cadeia segue a posição atribuída aqui, na ordem em que as linhas
+    ficam visíveis (confirmadas), e não o id: uma transação com id menor que
+    confirma depois da última execução é selada na próxima, na posição
+    seguinte, em vez de ficar fora da cadeia. `renovar` é chamado após cada
+    lote confirmado (ex.: renovar a trava da tarefa). Retorna (linhas
+    seladas, checkpoints criados).
+    """
+    posicao, hash_atual = _topo_cadeia()
+    
+    seladas = 0
+    while True:
+        linhas = db.session.execute(
+            select(*COLUNAS)
+            .where(Auditoria.posicao.is_(None))
+            .order_by(Auditoria.id).limit(lote)
+        ).all()
+        if not linhas:
+            break
+        
+        assinaturas = []
+        for linha in linhas:
+            posicao += 1
+            hash_atual = encadear(hash_atual, hash_folha(linha))
+            assinaturas.append({'_id': linha.id, 'posicao': posicao, 'hash': hash_atual})
+        # posicao é única: uma execução concorrente falha aqui em vez de bifurcar a cadeia
+        db.session.execute(
+            update(Auditoria.__table__)
+            .where(Auditoria.__table__.c.id == bindparam('_id'))
+            .values(posicao=bindparam('posicao'), assinatura_digital=bindparam('hash')),
+            assinaturas
+        )
+        db.session.commit()
+        seladas += len(linhas)
+        if renovar:
+            renovar()
+    
+    return seladas, criar_checkpoints(renovar)
+
+def criar_checkpoints(renovar=None):
+    """Grava um checkpoint para cada bloco completo de BLOCO linhas seladas"""
+    anterior = db.session.execute(
+        select(CheckpointAuditoria.ultima_posicao, CheckpointAuditoria.hash_final)
+        .order_by(CheckpointAuditoria.ultima_posicao.desc()).limit(1)
+    ).first()
+    ultima_posicao, hash_anterior = (anterior.ultima_posicao, anterior.hash_final) if anterior else (0, HASH_INICIAL)
+    
+    criados = 0
+    while True:
+        linhas = db.session.execute(
+            select(*COLUNAS)
+            .where(Auditoria.posicao > ultima_posicao)
+            .order_by(Auditoria.posicao).limit(BLOCO)
+        ).all()
+        if len(linhas) < BLOCO:
+            break
+        
+        db.session.add(CheckpointAuditoria(
+            primeira_posicao=linhas[0].posicao,
+            ultima_posicao=linhas[-1].posicao,
+            quantidade=len(linhas),
+            hash_anterior=hash_anterior,
+            hash_final=linhas[-1].assinatura_digital,
+            raiz_merkle=raiz_merkle(hash_folha(linha) for linha in linhas)
+        ))
+        db.session.commit()
+        criados += 1
+        if renovar:
+            renovar()
+        ultima_posicao, hash_anterior = linhas[-1].posicao, linhas[-1].assinatura_digital
+    
+    return criados
+
+def _verificar_sequencia(linhas, hash_anterior, posicao_anterior):
+    """Reencadeia as linhas; retorna (folhas, último hash, problemas)
+    
+    Um salto de posição indica linhas seladas removidas da cadeia.
+    """
+    folhas, problemas = [], []
+    hash_atual = hash_anterior
+    for linha in linhas:
+        if linha.posicao != posicao_anterior + 1:
+            ausentes = range(posicao_anterior + 1, linha.posicao)
+            problemas.append(f'posições {ausentes[0]} a {ausentes[-1]} ausentes' if len(ausentes) > 1
+                             else f'posição {posicao_anterior + 1} ausente')
+        posicao_anterior = linha.posicao
+        folha = hash_folha(linha)
+        hash_atual = encadear(hash_atual, folha)
+        if linha.assinatura_digital != hash_atual:
+            problemas.append(f'linha {linha.id}: hash encadeado não confere')
+            # Segue a partir do valor gravado para apontar só as linhas adulteradas
+            hash_atual = linha.assinatura_digital or hash_atual
+        folhas.append(folha)
+    return folhas, hash_atual, problemas
+
+def verificar_bloco(checkpoint):
+    """Confere um bloco: encadeamento, quantidade e raiz Merkle do checkpoint
+    
+    Blocos arquivados são lidos do arquivo compactado em vez do banco.
+    As posições do bloco têm de ser contíguas.
+    """
+    if checkpoint.get('arquivo'):
+        from arquivamento import linhas_arquivo
+        linhas = linhas_arquivo(checkpoint['arquivo'])
+    else:
+        linhas = _linhas(checkpoint['primeira_posicao'], checkpoint['ultima_posicao'])
+    folhas, hash_final, problemas = _verificar_sequencia(
+        linhas, checkpoint['hash_anterior'], checkpoint['primeira_posicao'] - 1
+    )
+    if len(folhas) != checkpoint['quantidade']:
+        problemas.append(f"{checkpoint['quantidade']} linhas esperadas, {len(folhas)} encontradas")
+    if hash_final != checkpoint['hash_final']:
+        problemas.append('hash final do bloco não confere')
+    if raiz_merkle(folhas) != checkpoint['raiz_merkle']:
+        problemas.append('raiz Merkle não confere')
+    return checkpoint['id'], problemas
+
+def _iniciar_processo():
+    # Conexões herdadas pelo fork pertencem ao processo pai
+    app.app_context().push()
+    db.engine.dispose(close=False)
+
+def _verificar_bloco_processo(checkpoint):
+    try:
+        return verificar_bloco(checkpoint)
+    finally:
+        db.session.remove()
+
+def verificar_integridade(processos=4):
+    """Verifica a auditoria inteira
+    
+    Os blocos com checkpoint são independentes entre si (cada um guarda o
+    hash encadeado anterior) e são conferidos em paralelo; a cauda ainda sem
+    checkpoint é reencadeada a partir do último bloco. Também confere que os
+    blocos e as posições são contíguos. Só leitura: linhas ainda sem selo
+    ficam para a tarefa selar_auditoria. Retorna {'linhas', 'blocos', 'problemas'}.
+    """
+    arquivos = dict(db.session.execute(select(ArquivoAuditoria.checkpoint_id, ArquivoAuditoria.caminho)).all())
+    checkpoints = [
+        {**{coluna: getattr(c, coluna) for coluna in
+            ('id', 'primeira_posicao', 'ultima_posicao', 'quantidade', 'hash_anterior', 'hash_final', 'raiz_merkle')},
+         'arquivo': arquivos.get(c.id)}
+        for c in CheckpointAuditoria.query.order_by(CheckpointAuditoria.ultima_posicao)
+    ]
+    
+    problemas = []
+    hash_esperado, posicao_esperada = HASH_INICIAL, 0
+    for checkpoint in checkpoints:
+        if checkpoint['hash_anterior'] != hash_esperado or checkpoint['primeira_posicao'] != posicao_esperada + 1:
+            problemas.append(f"checkpoint {checkpoint['id']}: não continua o bloco anterior")
+        hash_esperado, posicao_esperada = checkpoint['hash_final'], checkpoint['ultima_posicao']
+    
+    if processos > 1 and len(checkpoints) > 1:
+        with ProcessPoolExecutor(max_workers=processos, initializer=_iniciar_processo) as executor:
+            resultados = list(executor.map(_verificar_bloco_processo, checkpoints))
+    else:
+        resultados = [verificar_bloco(checkpoint) for checkpoint in checkpoints]
+    for checkpoint_id, erros in resultados:
+        problemas.extend(f'checkpoint {checkpoint_id}: {erro}' for erro in erros)
+    
+    # Cauda selada ainda sem checkpoint
+    folhas, _, erros = _verificar_sequencia(_linhas(posicao_esperada + 1), hash_esperado, posicao_esperada)
+    problemas.extend(f'cauda: {erro}' for erro in erros)
+    
+    return {
+        'linhas': sum(c['quantidade'] for c in checkpoints) + len(folhas),
+        'blocos': len(checkpoints),
+        'problemas': problemas
+    }
+
+def prova_inclusao(auditoria_id):
+    """Prova de inclusão de uma linha: folha, caminho Merkle e raiz do checkpoint
+    
+    Retorna None se a linha ainda não pertence a um bloco com checkpoint.
+    """
+    posicao = db.session.execute(select(Auditoria.posicao).where(Auditoria.id == auditoria_id)).scalar()
+    if posicao is not None:
+        checkpoint = CheckpointAuditoria.query.filter(
+            CheckpointAuditoria.primeira_posicao <= posicao,
+            CheckpointAuditoria.ultima_posicao >= posicao
+        ).first()
+        if not checkpoint:
+            return None
+        linhas = list(_linhas(checkpoint.primeira_posicao, checkpoint.ultima_posicao))
+    else:
+        # Fora do banco: procura nos blocos arquivados cuja faixa de ids inclui a linha
+        from arquivamento import linhas_arquivo
+        linhas = []
+        for arquivo in ArquivoAuditoria.query.filter(
+            ArquivoAuditoria.primeiro_id <= auditoria_id, ArquivoAuditoria.ultimo_id >= auditoria_id
+        ):
+            linhas = list(linhas_arquivo(arquivo.caminho))
+            if any(linha.id == auditoria_id for linha in linhas):
+                checkpoint = db.session.get(CheckpointAuditoria, arquivo.checkpoint_id)
+                break
+        else:
+            return None
+    indice = next((i for i, linha in enumerate(linhas) if linha.id == auditoria_id), None)
+    if indice is None:
+        return None
+    
+    folhas = [hash_folha(linha) for linha in linhas]
+    return {
+        'auditoria_id': auditoria_id,
+        'checkpoint_id': checkpoint.id,
+        'folha': folhas[indice].hex(),
+        'caminho': caminho_merkle(folhas, indice),
+        'raiz_merkle': checkpoint.raiz_merkle
+    }
+
+def hash_resumo_plantao(plantao):
+    """Hash do resumo do plantão: dados do plantão, seus registros e a âncora na cadeia de auditoria
+    
+    A âncora é o último checkpoint criado até o fim do plantão, e não o topo
+    da cadeia, que muda a cada selagem: checkpoints não mudam depois de
+    gravados, então o hash pode ser recalculado depois (ver
+    verificar_resumo_plantao).
+    """
+    registros = db.session.execute(
+        select(Registro.id, Registro.atualizado_em)
+        .where(Registro.plantao_id == plantao.id).order_by(Registro.id)
+    ).all()
+    ancora = db.session.execute(
+        select(CheckpointAuditoria.ultima_posicao, CheckpointAuditoria.hash_final)
+        .where(CheckpointAuditoria.criado_em <= (plantao.data_fim or datetime.utcnow()))
+        .order_by(CheckpointAuditoria.ultima_posicao.desc()).limit(1)
+    ).first()
+    return hashlib.sha256(_json({
+        'plantao': plantao.id,
+        'posto': plantao.posto_id,
+        'usuario': plantao.usuario_id,
+        'inicio': plantao.data_inicio,
+        'fim': plantao.data_fim,
+        'observacoes': plantao.observacoes,
+        'registros': [[registro_id, atualizado_em] for registro_id, atualizado_em in registros],
+        'auditoria': [ancora.ultima_posicao, ancora.hash_final] if ancora else [0, HASH_INICIAL]
+    }).encode()).hexdigest()
+
+def verificar_resumo_plantao(plantao):
+    """Confere o hash gravado no encerramento contra o estado atual do plantão"""
+    return plantao.hash_resumo is not None and plantao.hash_resumo == hash_resumo_plantao(plantao)
@@ -0,0 +1,48 @@
+from flask import request, jsonify
+from datetime import datetime
+from app import db
+from models import Configuracao
+
+CHAVE = 'modo_manutencao'
+# Continuam liberadas durante a manutenção (entrar, sair e desligar o modo).
+# O /batch passa: cada sub-requisição de escrita é recusada individualmente
+ROTAS_LIBERADAS = {'login', 'logout', 'modo_manutencao', 'static', 'api.batchresource'}
+METODOS_ESCRITA = ('POST', 'PUT', 'PATCH', 'DELETE')
+
+def em_manutencao():
+    valor = Configuracao.get_valor(CHAVE, False)
+    # Gravações antigas da rota usavam o tipo string ('True'/'False')
+    return valor is True or str(valor).lower() == 'true'
+
+def definir_manutencao(ativo, conexao=None):
+    """Liga ou desliga o modo manutenção
+    
+    Com `conexao` a gravação é feita pelo Core na transação dela (ex.: a
+    troca de tabelas da restauração, que substitui as configurações).
+    """
+    if conexao is None:
+        Configuracao.set_valor(CHAVE, ativo, tipo='bool')
+        return
+    
+    tabela = Configuracao.__table__
+    valores = {'valor': str(bool(ativo)).lower(), 'tipo': 'bool', 'atualizado_em': datetime.utcnow()}
+    if not conexao.execute(tabela.update().where(tabela.c.chave == CHAVE).values(**valores)).rowcount:
+        conexao.execute(tabela.insert().values(chave=CHAVE, criado_em=datetime.utcnow(), **valores))
+
+def registrar_bloqueio_manutencao(app):
+    """Recusa escritas (503) enquanto o modo manutenção estiver ligado
+    
+    Leituras continuam funcionando; as tarefas periódicas do Celery também
+    param (ver celery_app.ContextTask).
+    """
+    
+    @app.before_request
+    def bloquear_escritas():
+        if request.method not in METODOS_ESCRITA or request.endpoint in ROTAS_LIBERADAS:
+            return None
+        if not em_manutencao():
+            return None
+        return jsonify({
+            'success': False,
+            'message': 'Sistema em manutenção. Tente novamente em alguns minutos.'
+        }), 503, {'Retry-After': '60'}
@@ -2,6 +2,8 @@ from app import db
 from flask_login import UserMixin
 from datetime import datetime
 from werkzeug.security import generate_password_hash, check_password_hash
+from sqlalchemy.exc import IntegrityError
+import secrets
 
 class Unidade(db.Model):
     __tablename__ = 'unidades'
@@ -32,6 +34,8 @@ class PostoTrabalho(db.Model):
 class Usuario(UserMixin, db.Model):
     __tablename__ = 'usuarios'
     
+    EMAIL_SISTEMA = 'sistema@passometro.local'
+    
     id = db.Column(db.Integer, primary_key=True)
     nome = db.Column(db.String(100), nullable=False)
     registro_profissional = db.Column(db.String(20))  # CRM, COREN, etc.
@@ -55,6 +59,24 @@ class Usuario(UserMixin, db.Model):
         if not self.perfis:
             return False
         return perfil in self.perfis
+    
+    @classmethod
+    def sistema(cls):
+        """Usuário técnico, inativo e sem senha conhecida, que assina o que as tarefas em background gravam"""
+        usuario = cls.query.filter_by(email=cls.EMAIL_SISTEMA).first()
+        if usuario:
+            return usuario
+        
+        usuario = cls(nome='Sistema', email=cls.EMAIL_SISTEMA, perfis=[], ativo=False)
+        usuario.set_senha(secrets.token_urlsafe(32))
+        db.session.add(usuario)
+        try:
+            db.session.commit()
+        except IntegrityError:
+            # Outro worker criou ao mesmo tempo
+            db.session.rollback()
+            usuario = cls.query.filter_by(email=cls.EMAIL_SISTEMA).one()
+        return usuario
 
 class Escala(db.Model):
     __tablename__ = 'escalas'
@@ -83,6 +105,7 @@ class Plantao(db.Model):
     observacoes = db.Column(db.Text)  # Observações sobre o plantão
     hash_resumo = db.Column(db.String(64))  # Hash do resumo para auditoria
     criado_em = db.Column(db.DateTime, default=datetime.utcnow)
+    versao_auditoria = db.Column(db.Integer, nullable=False, default=1, server_default='0')  # Última versão auditada (ver auditoria.py); 0 em linhas anteriores ao contador
     
     # Relacionamentos
     registros = db.relationship('Registro', backref='plantao', lazy=True)
@@ -97,20 +120,21 @@ class Registro(db.Model):
     tipo = db.Column(db.String(20), nullable=False)  # evento, ocorrencia, comunicado, alerta
     categoria = db.Column(db.String(50), nullable=False)  # clinico, logistica, ti, manutencao, etc.
     titulo = db.Column(db.String(200), nullable=False)
-    descricao_rica = db.Column(db.Text, nullable=False)
+    # Colunas de texto longas ficam em grupos adiados: listagens não as carregam
+    descricao_rica = db.deferred(db.Column(db.Text, nullable=False), group='conteudo')
     
     # Campos SBAR
-    situacao = db.Column(db.Text)
-    background = db.Column(db.Text)
-    avaliacao = db.Column(db.Text)
-    recomendacao = db.Column(db.Text)
+    situacao = db.deferred(db.Column(db.Text), group='sbar')
+    background = db.deferred(db.Column(db.Text), group='sbar')
+    avaliacao = db.deferred(db.Column(db.Text), group='sbar')
+    recomendacao = db.deferred(db.Column(db.Text), group='sbar')
     
     # Campos I-PASS
-    illness_severity = db.Column(db.String(20))  # estavel, inquieto, critico
-    patient_summary = db.Column(db.Text)
-    action_list = db.Column(db.Text)
-    situation_awareness = db.Column(db.Text)
-    synthesis_by_receiver = db.Column(db.Text)
+    illness_severity = db.deferred(db.Column(db.String(20)), group='ipass')  # estavel, inquieto, critico
+    patient_summary = db.deferred(db.Column(db.Text), group='ipass')
+    action_list = db.deferred(db.Column(db.Text), group='ipass')
+    situation_awareness = db.deferred(db.Column(db.Text), group='ipass')
+    synthesis_by_receiver = db.deferred(db.Column(db.Text), group='ipass')
     
     tags = db.Column(db.JSON)  # Lista de tags
     prioridade = db.Column(db.String(20), default='media')  # baixa, media, alta, critica
@@ -119,12 +143,67 @@ class Registro(db.Model):
     criado_em = db.Column(db.DateTime, default=datetime.utcnow)
     atualizado_em = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     atualizado_por = db.Column(db.Integer, db.ForeignKey('usuarios.id'))
+    versao_auditoria = db.Column(db.Integer, nullable=False, default=1, server_default='0')  # Última versão auditada (ver auditoria.py); 0 em linhas anteriores ao contador
     
     # Relacionamentos
     criador = db.relationship('Usuario', foreign_keys=[criado_por], backref='registros_criados')
     atualizador = db.relationship('Usuario', foreign_keys=[atualizado_por], backref='registros_atualizados')
     anexos = db.relationship('Anexo', backref='registro', lazy=True)
-    pendencias = db.relationship('Pendencia', lazy=True)
+    pendencias = db.relationship('Pendencia', back_populates='registro', lazy=True)
+    
+    GRUPOS_TEXTO = ('conteudo', 'sbar', 'ipass')
+    
+    @classmethod
+    def opcoes_detalhe(cls):
+        """Opções de consulta para telas de detalhe: carrega todas as colunas de texto"""
+        return [db.undefer_group(grupo) for grupo in cls.GRUPOS_TEXTO]
+
+# Prévia da descrição para as listagens, sem trafegar o texto completo
+Registro.descricao_resumo = db.column_property(
+    db.func.substr(Registro.__table__.c.descricao_rica, 1, 100)
+)
+
+class IndiceBuscaRegistro(db.Model):
+    """Índice invertido da busca textual de registros (ver busca.py)"""
+    __tablename__ = 'indice_busca_registros'
+    
+    termo = db.Column(db.String(40), primary_key=True)  # Normalizado: minúsculo, sem acentos
+    registro_id = db.Column(db.Integer, primary_key=True)
+    posto_id = db.Column(db.Integer)  # Escopo da busca para não gestores
+    peso = db.Column(db.Integer, nullable=False)  # Ocorrências ponderadas pelo campo
+    
+    __table_args__ = (
+        db.Index('ix_indice_busca_termo_posto', 'termo', 'posto_id'),
+        db.Index('ix_indice_busca_registro', 'registro_id'),
+    )
+
+class Tag(db.Model):
+    """Dicionário de tags dos registros"""
+    __tablename__ = 'tags'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    chave = db.Column(db.String(50), unique=True, nullable=False)  # Normalizada: minúscula, sem acentos
+    nome = db.Column(db.String(50), nullable=False)  # Grafia da primeira ocorrência
+    criada_em = db.Column(db.DateTime, default=datetime.utcnow)
+
+class RegistroTag(db.Model):
+    """Associação registro-tag derivada de Registro.tags (ver tags.py)
+    
+    posto_id e criado_em são copiados do registro para que filtros e
+    contagens por período/posto sejam resolvidos só pelos índices.
+    """
+    __tablename__ = 'registro_tags'
+    
+    tag_id = db.Column(db.Integer, db.ForeignKey('tags.id'), primary_key=True)
+    registro_id = db.Column(db.Integer, primary_key=True)
+    posto_id = db.Column(db.Integer)
+    criado_em = db.Column(db.DateTime)
+    
+    __table_args__ = (
+        db.Index('ix_registro_tags_tag_posto_data', 'tag_id', 'posto_id', 'criado_em'),
+        db.Index('ix_registro_tags_posto_data', 'posto_id', 'criado_em', 'tag_id'),
+        db.Index('ix_registro_tags_registro', 'registro_id'),
+    )
 
 class Anexo(db.Model):
     __tablename__ = 'anexos'
@@ -149,12 +228,18 @@ class Pendencia(db.Model):
     motivo_bloqueio = db.Column(db.Text)
     prioridade = db.Column(db.String(20), default='media')  # baixa, media, alta, critica
     sla_minutos = db.Column(db.Integer)  # SLA em minutos
+    sla_alerta_prazo = db.Column(db.DateTime)  # Prazo cujo alerta de SLA já foi enviado
     criado_em = db.Column(db.DateTime, default=datetime.utcnow)
     atualizado_em = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    versao_auditoria = db.Column(db.Integer, nullable=False, default=1, server_default='0')  # Última versão auditada (ver auditoria.py); 0 em linhas anteriores ao contador
     
     # Relacionamentos
-    registro = db.relationship('Registro')
+    registro = db.relationship('Registro', back_populates='pendencias')
     responsavel = db.relationship('Usuario', foreign_keys=[responsavel_id])
+    
+    __table_args__ = (
+        db.Index('ix_pendencias_status_prazo', 'status', 'prazo'),
+    )
 
 class Entrega(db.Model):
     __tablename__ = 'entregas'
@@ -196,6 +281,14 @@ class Notificacao(db.Model):
     enviado_em = db.Column(db.DateTime, default=datetime.utcnow)
     status = db.Column(db.String(20), default='pendente')  # pendente, enviado, falha
     tentativas = db.Column(db.Integer, default=0)
+    proxima_tentativa = db.Column(db.DateTime)  # Backoff após falha
+    reservada_ate = db.Column(db.DateTime)  # Reserva do worker que está enviando
+    reservada_por = db.Column(db.String(100))
+    ultimo_erro = db.Column(db.String(500))
+    
+    __table_args__ = (
+        db.Index('ix_notificacoes_status_proxima', 'status', 'proxima_tentativa'),
+    )
 
 class NotificacaoSistema(db.Model):
     __tablename__ = 'notificacoes_sistema'
@@ -212,6 +305,27 @@ class NotificacaoSistema(db.Model):
     
     # Relacionamentos
     usuario = db.relationship('Usuario', backref='notificacoes_sistema')
+    
+    __table_args__ = (
+        db.Index('ix_notificacoes_sistema_usuario_lida', 'usuario_id', 'lida', 'id'),
+    )
+
+class ChaveIdempotencia(db.Model):
+    __tablename__ = 'chaves_idempotencia'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    chave = db.Column(db.String(64), nullable=False)  # Gerada pelo cliente
+    usuario_id = db.Column(db.Integer, db.ForeignKey('usuarios.id'), nullable=False)
+    rota = db.Column(db.String(200))  # Operação a que a chave foi aplicada
+    status_code = db.Column(db.Integer)  # Nulo enquanto a primeira execução está em andamento
+    headers = db.Column(db.JSON)  # Headers da resposta (Location, Content-Type...)
+    resposta = db.Column(db.Text)  # Corpo devolvido na primeira execução
+    criada_em = db.Column(db.DateTime, default=datetime.utcnow)
+    expira_em = db.Column(db.DateTime, nullable=False, index=True)
+    
+    __table_args__ = (
+        db.UniqueConstraint('usuario_id', 'chave', name='uq_chaves_idempotencia_usuario_chave'),
+    )
 
 class Auditoria(db.Model):
     __tablename__ = 'auditoria'
@@ -220,14 +334,119 @@ class Auditoria(db.Model):
     objeto = db.Column(db.String(50), nullable=False)  # registro, pendencia, entrega, etc.
     objeto_id = db.Column(db.Integer, nullable=False)
     acao = db.Column(db.String(20), nullable=False)  # criar, atualizar, deletar, ler
-    antes = db.Column(db.JSON)  # Estado anterior
-    depois = db.Column(db.JSON)  # Estado posterior
+    # none_as_null: None vira NULL, e não o JSON 'null', para que os filtros IS NULL funcionem
+    antes = db.Column(db.JSON(none_as_null=True))  # Estado completo ao deletar
+    depois = db.Column(db.JSON(none_as_null=True))  # Estado completo (snapshot) ou só os campos alterados (ver auditoria.py)
+    versao = db.Column(db.Integer)  # Sequência das alterações do objeto
+    snapshot = db.Column(db.Boolean, default=False)  # `depois` contém o estado completo
     autor_id = db.Column(db.Integer, db.ForeignKey('usuarios.id'), nullable=False)
     timestamp = db.Column(db.DateTime, default=datetime.utcnow)
     assinatura_digital = db.Column(db.String(64))  # Hash para integridade
+    posicao = db.Column(db.Integer, unique=True)  # Posição na cadeia de hashes, atribuída ao selar (ver integridade.py)
     
     # Relacionamentos
     autor = db.relationship('Usuario', backref='acoes_auditoria')
+    
+    __table_args__ = (
+        db.Index('ix_auditoria_objeto', 'objeto', 'objeto_id', 'id'),
+        db.UniqueConstraint('objeto', 'objeto_id', 'versao', name='uq_auditoria_versao'),
+    )
+
+class CheckpointAuditoria(db.Model):
+    """Raiz Merkle de um bloco contíguo de linhas seladas da auditoria (ver integridade.py)"""
+    __tablename__ = 'checkpoints_auditoria'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    primeira_posicao = db.Column(db.Integer, nullable=False)  # Primeira posição da cadeia no bloco
+    ultima_posicao = db.Column(db.Integer, nullable=False, unique=True)
+    quantidade = db.Column(db.Integer, nullable=False)
+    hash_anterior = db.Column(db.String(64), nullable=False)  # Encadeamento antes do bloco
+    hash_final = db.Column(db.String(64), nullable=False)  # Encadeamento da última linha do bloco
+    raiz_merkle = db.Column(db.String(64), nullable=False)
+    criado_em = db.Column(db.DateTime, default=datetime.utcnow)
+
+class ArquivoAuditoria(db.Model):
+    """Manifesto dos blocos de auditoria movidos para arquivos JSONL compactados (ver arquivamento.py)"""
+    __tablename__ = 'arquivos_auditoria'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    checkpoint_id = db.Column(db.Integer, db.ForeignKey('checkpoints_auditoria.id'), nullable=False, unique=True)
+    caminho = db.Column(db.String(255), nullable=False)  # Relativo a AUDITORIA_ARQUIVO_DIR
+    primeiro_id = db.Column(db.Integer, nullable=False)  # Menor id de auditoria do bloco
+    ultimo_id = db.Column(db.Integer, nullable=False)  # Maior id de auditoria do bloco
+    quantidade = db.Column(db.Integer, nullable=False)
+    inicio = db.Column(db.DateTime, nullable=False)  # Menor timestamp do bloco
+    fim = db.Column(db.DateTime, nullable=False)  # Maior timestamp do bloco
+    sha256 = db.Column(db.String(64), nullable=False)  # Do arquivo compactado
+    bytes = db.Column(db.Integer, nullable=False)
+    criado_em = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    __table_args__ = (
+        db.Index('ix_arquivos_auditoria_periodo', 'inicio', 'fim'),
+    )
+
+class ObjetoArquivoAuditoria(db.Model):
+    """Objetos com linhas em cada arquivo de auditoria: a consulta só abre os arquivos relevantes"""
+    __tablename__ = 'objetos_arquivos_auditoria'
+    
+    arquivo_id = db.Column(db.Integer, db.ForeignKey('arquivos_auditoria.id'), primary_key=True)
+    objeto = db.Column(db.String(50), primary_key=True)
+    objeto_id = db.Column(db.Integer, primary_key=True)
+    
+    __table_args__ = (
+        db.Index('ix_objetos_arquivos_auditoria_objeto', 'objeto', 'objeto_id'),
+    )
+
+class Backup(db.Model):
+    """Backup do banco gerado em background (ver backups.py)"""
+    __tablename__ = 'backups'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    status = db.Column(db.String(20), default='pendente')  # pendente, executando, concluido, falha
+    automatico = db.Column(db.Boolean, default=False)
+    arquivo = db.Column(db.String(255))  # Relativo a BACKUP_DIR
+    compressao = db.Column(db.String(10), default='gzip')
+    tabelas_total = db.Column(db.Integer)
+    tabelas_concluidas = db.Column(db.Integer, default=0)
+    bytes_dump = db.Column(db.BigInteger, default=0)  # SQL gerado (antes da compressão)
+    bytes = db.Column(db.BigInteger)  # Arquivo compactado
+    sha256 = db.Column(db.String(64))  # Do arquivo compactado
+    erro = db.Column(db.Text)
+    solicitado_por = db.Column(db.Integer, db.ForeignKey('usuarios.id'))
+    criado_em = db.Column(db.DateTime, default=datetime.utcnow)
+    iniciado_em = db.Column(db.DateTime)
+    concluido_em = db.Column(db.DateTime)
+
+class Restauracao(db.Model):
+    """Restauração de um backup enviado pela interface, executada em background (ver backups.py)"""
+    __tablename__ = 'restauracoes'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    status = db.Column(db.String(20), default='pendente')  # pendente, executando, concluido, falha
+    arquivo = db.Column(db.String(255))  # Relativo a BACKUP_DIR; removido ao terminar
+    tabelas_total = db.Column(db.Integer)
+    tabelas_concluidas = db.Column(db.Integer, default=0)
+    linhas = db.Column(db.BigInteger, default=0)
+    erro = db.Column(db.Text)
+    solicitado_por = db.Column(db.Integer, db.ForeignKey('usuarios.id'))
+    criado_em = db.Column(db.DateTime, default=datetime.utcnow)
+    iniciado_em = db.Column(db.DateTime)
+    concluido_em = db.Column(db.DateTime)
+
+class LogAlteracao(db.Model):
+    __tablename__ = 'log_alteracoes'
+    
+    id = db.Column(db.BigInteger().with_variant(db.Integer, 'sqlite'), primary_key=True)  # Número de sequência
+    entidade = db.Column(db.String(20), nullable=False)  # registro, pendencia, plantao, notificacao
+    entidade_id = db.Column(db.Integer)  # Nulo em alterações em massa (recarregar)
+    operacao = db.Column(db.String(20), nullable=False)  # criar, atualizar, deletar, recarregar
+    posto_id = db.Column(db.Integer)  # Escopo de visibilidade de registros e plantões
+    usuario_id = db.Column(db.Integer)  # Escopo de visibilidade de notificações
+    criado_em = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+    
+    __table_args__ = (
+        db.Index('ix_log_alteracoes_entidade', 'entidade', 'entidade_id'),
+    )
 
 class Paciente(db.Model):
     __tablename__ = 'pacientes'
@@ -278,6 +497,9 @@ class Configuracao(db.Model):
         
         if tipo == 'bool':
             config.valor = str(valor).lower()
+        elif tipo == 'json' and not isinstance(valor, str):
+            import json
+            config.valor = json.dumps(valor)
         else:
             config.valor = str(valor)
         
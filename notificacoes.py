@@ -0,0 +1,66 @@
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session
+from app import db
+from cache import NotificationCache
+from models import NotificacaoSistema
+
+def payload_notificacao(notificacao):
+    """Representação de uma notificação guardada na caixa de entrada"""
+    return {
+        'id': notificacao.id,
+        'tipo': notificacao.tipo,
+        'titulo': notificacao.titulo,
+        'mensagem': notificacao.mensagem,
+        'link': notificacao.link,
+        'criada_em': notificacao.criada_em.isoformat()
+    }
+
+def carregar_caixa_entrada(usuario_id, limite):
+    """Lê do banco o total de não lidas e as últimas `limite` não lidas
+    
+    Numa sessão própria: a transação começa depois que NotificationCache
+    leu a geração da caixa, então enxerga todo commit anterior a ela.
+    """
+    with Session(db.engine) as sessao:
+        query = sessao.query(NotificacaoSistema).filter_by(usuario_id=usuario_id, lida=False)
+        total = query.count()
+        notificacoes = query.order_by(NotificacaoSistema.id.desc()).limit(limite).all()
+        return total, [payload_notificacao(n) for n in notificacoes]
+
+def caixa_entrada(usuario_id, limite=10):
+    """Retorna (total de não lidas, últimas notificações) sem consultar o banco quando possível"""
+    return NotificationCache.get_inbox(
+        usuario_id, limite,
+        lambda quantidade: carregar_caixa_entrada(usuario_id, quantidade)
+    )
+
+def registrar_caixa_entrada(session):
+    """Mantém a caixa de entrada no Redis após o commit das notificações
+    
+    Updates em massa não passam por aqui; quem os executa esvazia a caixa
+    diretamente (ver marcar_todas_notificacoes_lidas).
+    """
+    info_key = 'caixa_entrada_pendente'
+    
+    @event.listens_for(session, 'after_flush')
+    def after_flush(session, flush_context):
+        pendentes = session.info.setdefault(info_key, [])
+        for obj in session.new:
+            if isinstance(obj, NotificacaoSistema) and not obj.lida:
+                pendentes.append((NotificationCache.push, obj.usuario_id, payload_notificacao(obj)))
+        
+        for obj in session.dirty:
+            if not isinstance(obj, NotificacaoSistema):
+                continue
+            historico = inspect(obj).attrs.lida.history
+            if historico.added == [True] and not any(historico.deleted):
+                pendentes.append((NotificationCache.remove, obj.usuario_id, obj.id))
+    
+    @event.listens_for(session, 'after_commit')
+    def after_commit(session):
+        for operacao, usuario_id, dados in session.info.pop(info_key, []):
+            operacao(usuario_id, dados)
+    
+    @event.listens_for(session, 'after_rollback')
+    def after_rollback(session):
+        session.info.pop(info_key, None)
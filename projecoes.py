@@ -0,0 +1,148 @@
+from sqlalchemy import select
+from sqlalchemy.orm import aliased
+from datetime import datetime
+from models import Usuario, Registro, Pendencia
+
+def _iso(valor):
+    return valor.isoformat() if isinstance(valor, datetime) else valor
+
+class CampoInvalido(ValueError):
+    """Campo pedido em ?fields= que o endpoint não expõe"""
+
+class Projecao:
+    """Campos que um endpoint de listagem pode devolver
+    
+    `campos` mapeia nome -> (expressão SQL, conversor ou None). Um campo
+    aninhado mapeia nome -> Projecao, cujas colunas são lidas do mesmo
+    SELECT (via join) e reagrupadas em um objeto; ele vira None quando a
+    primeira coluna for nula (join externo sem correspondência).
+    Os encoders são compilados uma vez por combinação de campos.
+    """
+    
+    def __init__(self, campos, padrao=None):
+        self.campos = campos
+        self.padrao = tuple(padrao or campos)
+        self._encoders = {}
+    
+    def selecionar(self, fields=None):
+        """Valida ?fields= e devolve os nomes na ordem declarada"""
+        if not fields:
+            return self.padrao
+        
+        pedidos = {f.strip() for f in fields.split(',') if f.strip()}
+        invalidos = pedidos - set(self.campos)
+        if invalidos:
+            raise CampoInvalido(', '.join(sorted(invalidos)))
+        return tuple(nome for nome in self.campos if nome in pedidos)
+    
+    def colunas(self, nomes):
+        """Expressões do SELECT para os campos, já achatadas"""
+        colunas = []
+        for nome in nomes:
+            campo = self.campos[nome]
+            if isinstance(campo, Projecao):
+                colunas.extend(campo.colunas(campo.padrao))
+            else:
+                colunas.append(campo[0])
+        return colunas
+    
+    def encoder(self, nomes):
+        """Função linha -> dict para esta combinação de campos"""
+        encoder = self._encoders.get(nomes)
+        if encoder is None:
+            encoder = self._encoders[nomes] = self._compilar(nomes)
+        return encoder
+    
+    def _largura(self, nomes):
+        return len(self.colunas(nomes))
+    
+    def _compilar(self, nomes):
+        passos = []
+        posicao = 0
+        for nome in nomes:
+            campo = self.campos[nome]
+            if isinstance(campo, Projecao):
+                largura = campo._largura(campo.padrao)
+                passos.append((nome, posicao, largura, campo.encoder(campo.padrao)))
+                posicao += largura
+            else:
+                passos.append((nome, posicao, None, campo[1]))
+                posicao += 1
+        
+        # Caso comum: só colunas simples sem conversão
+        if all(largura is None and conversor is None for _, _, largura, conversor in passos):
+            return lambda linha: dict(zip(nomes, linha))
+        
+        def encode(linha):
+            dados = {}
+            for nome, inicio, largura, conversor in passos:
+                if largura is not None:
+                    trecho = linha[inicio:inicio + largura]
+                    dados[nome] = conversor(trecho) if trecho[0] is not None else None
+                else:
+                    valor = linha[inicio]
+                    dados[nome] = conversor(valor) if conversor and valor is not None else valor
+            return dados
+        return encode
+    
+    def serializar(self, linhas, nomes):
+        encode = self.encoder(nomes)
+        return [encode(linha) for linha in linhas]
+
+def projecao_usuario(tabela=Usuario):
+    """Mesmos campos de UsuarioSchema"""
+    return Projecao({
+        'id': (tabela.id, None),
+        'nome': (tabela.nome, None),
+        'email': (tabela.email, None),
+        'registro_profissional': (tabela.registro_profissional, None),
+        'perfis': (tabela.perfis, None),
+        'ativo': (tabela.ativo, None),
+        'criado_em': (tabela.criado_em, _iso)
+    })
+
+# Aliases usados nos joins dos campos aninhados
+Criador = aliased(Usuario, name='criador')
+Responsavel = aliased(Usuario, name='responsavel')
+
+PROJECAO_USUARIOS = projecao_usuario()
+
+PROJECAO_REGISTROS = Projecao({
+    'id': (Registro.id, None),
+    'tipo': (Registro.tipo, None),
+    'categoria': (Registro.categoria, None),
+    'titulo': (Registro.titulo, None),
+    'descricao_rica': (Registro.descricao_rica, None),
+    'prioridade': (Registro.prioridade, None),
+    'confidencial': (Registro.confidencial, None),
+    'tags': (Registro.tags, None),
+    'criado_em': (Registro.criado_em, _iso),
+    'criador': projecao_usuario(Criador)
+})
+
+PROJECAO_PENDENCIAS = Projecao({
+    'id': (Pendencia.id, None),
+    'descricao': (Pendencia.descricao, None),
+    'prazo': (Pendencia.prazo, _iso),
+    'status': (Pendencia.status, None),
+    'prioridade': (Pendencia.prioridade, None),
+    'responsavel': projecao_usuario(Responsavel),
+    'criado_em': (Pendencia.criado_em, _iso)
+})
+
+def consulta_registros(nomes):
+    """SELECT de registros só com as colunas dos campos pedidos"""
+    consulta = select(*PROJECAO_REGISTROS.colunas(nomes)).select_from(Registro)
+    if 'criador' in nomes:
+        consulta = consulta.outerjoin(Criador, Registro.criado_por == Criador.id)
+    return consulta
+
+def consulta_pendencias(nomes):
+    """SELECT de pendências só com as colunas dos campos pedidos"""
+    consulta = select(*PROJECAO_PENDENCIAS.colunas(nomes)).select_from(Pendencia)
+    if 'responsavel' in nomes:
+        consulta = consulta.outerjoin(Responsavel, Pendencia.responsavel_id == Responsavel.id)
+    return consulta
+
+def consulta_usuarios(nomes):
+    return select(*PROJECAO_USUARIOS.colunas(nomes)).select_from(Usuario)
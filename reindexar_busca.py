@@ -0,0 +1,20 @@
+#!/usr/bin/env python3
+"""
+Script para reconstruir o índice de busca textual e o índice de tags dos registros
+"""
+
+from app import app, db
+from busca import reindexar_todos
+from tags import reindexar_tags
+
+def reindexar_busca():
+    """Reindexa todos os registros em lotes"""
+    with app.app_context():
+        db.create_all()
+        total = reindexar_todos()
+        print(f"✅ {total} registros indexados para busca")
+        total = reindexar_tags()
+        print(f"✅ {total} registros indexados por tag")
+
+if __name__ == '__main__':
+    reindexar_busca()
@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+"""
+Script para restaurar um backup .tar do Passômetro (ver backups.py)
+
+Uso:
+    python restaurar_backup.py ARQUIVO.tar [--processos N]   # substitui os dados do banco
+    python restaurar_backup.py ARQUIVO.tar --verificar       # só confere manifesto e blocos
+"""
+
+import argparse
+import sys
+from app import app, db
+from backups import restaurar_dados, verificar_backup
+from manutencao import em_manutencao, definir_manutencao
+
+def restaurar(caminho, processos, somente_verificar):
+    with app.app_context():
+        try:
+            manifesto = verificar_backup(caminho)
+        except Exception as e:
+            print(f"❌ Backup inválido: {e}")
+            return False
+        linhas = sum(tabela['linhas'] for tabela in manifesto['tabelas'])
+        print(f"🔎 Backup de {manifesto['criado_em']} ({manifesto['dialeto']}): "
+              f"{len(manifesto['tabelas'])} tabelas, {linhas} linhas")
+        if somente_verificar:
+            print("✅ Blocos íntegros")
+            return True
+        
+        db.create_all()
+        # Escritas e tarefas periódicas param enquanto os dados são trocados
+        estava_em_manutencao = em_manutencao()
+        definir_manutencao(True)
+        try:
+            resultado = restaurar_dados(caminho, processos=processos)
+        except Exception as e:
+            print(f"❌ Erro na restauração (dados atuais mantidos): {e}")
+            return False
+        finally:
+            definir_manutencao(estava_em_manutencao)
+        print(f"✅ {resultado['tabelas']} tabelas e {resultado['linhas']} linhas restauradas em {resultado['segundos']}s")
+        return True
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Restaura um backup do Passômetro')
+    parser.add_argument('arquivo', help='arquivo .tar gerado pelo backup')
+    parser.add_argument('--processos', type=int, default=4, help='tabelas carregadas em paralelo (threads)')
+    parser.add_argument('--verificar', action='store_true', help='apenas confere o arquivo')
+    args = parser.parse_args()
+    
+    sys.exit(0 if restaurar(args.arquivo, args.processos, args.verificar) else 1)
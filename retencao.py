@@ -0,0 +1,220 @@
+from sqlalchemy import select, func, text, or_
+from datetime import datetime, timedelta
+import os
+import time
+from app import app, db
+from cache import cache
+from backups import remover_backup
+from models import Notificacao, NotificacaoSistema, Configuracao, Backup
+
+CHAVE_CONFIGURACAO = 'politica_retencao'
+CHAVE_METRICAS = 'metricas:retencao'
+
+# Limites por alvo: 'dias' (idade máxima) e/ou 'max_linhas' / 'max_arquivos'
+# (quantos itens mais recentes ficam; em backups, quantos backups concluídos). Sobrescritos pela configuração
+# 'politica_retencao' (tipo json); um alvo com valor null fica desativado.
+POLITICA_PADRAO = {
+    'notificacoes_sistema': {'dias': 90},
+    'notificacoes': {'dias': 30},
+    'relatorios_gerados': {'dias': 30},
+    'backups': {'dias': 90, 'max_arquivos': 30},
+    'temp': {'dias': 1}
+}
+
+# Tabelas que a política alcança: (modelo, coluna de data, condição extra)
+TABELAS = {
+    # Só notificações já lidas: as não lidas ainda aparecem na caixa de entrada
+    'notificacoes_sistema': (NotificacaoSistema, NotificacaoSistema.criada_em, NotificacaoSistema.lida.is_(True)),
+    # Pendentes (inclusive as reservadas por um worker) ainda serão enviadas
+    'notificacoes': (Notificacao, Notificacao.enviado_em, Notificacao.status != 'pendente')
+}
+
+# Diretórios relativos ao diretório de trabalho, como nas rotas que os criam
+DIRETORIOS = ('relatorios_gerados', 'temp')
+
+# Backups saem pelas linhas de Backup (arquivo em BACKUP_DIR, .sha256 e linha juntos)
+BACKUPS = 'backups'
+
+def politica_retencao():
+    """Política efetiva: padrão mesclado com a configuração salva"""
+    politica = {alvo: dict(regra) for alvo, regra in POLITICA_PADRAO.items()}
+    for alvo, regra in (Configuracao.get_valor(CHAVE_CONFIGURACAO, {}) or {}).items():
+        if regra is None:
+            politica.pop(alvo, None)
+        elif alvo in TABELAS or alvo in DIRETORIOS or alvo == BACKUPS:
+            politica.setdefault(alvo, {}).update(regra)
+    return politica
+
+def _expiracao_tabela(modelo, coluna_data, condicao, regra):
+    """(maior id a remover, condição que a linha expirada atende) segundo a regra
+    
+    Uma linha expira pela idade ou por estar além das `max_linhas` mais
+    recentes. O maior id só limita a varredura: ids e datas não seguem
+    necessariamente a mesma ordem, então a condição é aplicada a cada lote.
+    Retorna (None, None) se nada expirou.
+    """
+    filtros = [condicao] if condicao is not None else []
+    cortes, expiradas = [], []
+    if regra.get('dias') is not None:
+        limite = datetime.utcnow() - timedelta(days=int(regra['dias']))
+        corte = db.session.execute(select(func.max(modelo.id)).where(coluna_data < limite, *filtros)).scalar()
+        if corte is not None:
+            cortes.append(corte)
+            expiradas.append(coluna_data < limite)
+    if regra.get('max_linhas') is not None:
+        # O id na posição max_linhas + 1 (do mais novo para o mais antigo) e os anteriores saem
+        corte = db.session.execute(
+            select(modelo.id).where(*filtros).order_by(modelo.id.desc())
+            .offset(int(regra['max_linhas'])).limit(1)
+        ).scalar()
+        if corte is not None:
+            cortes.append(corte)
+            expiradas.append(modelo.id <= corte)
+    if not cortes:
+        return None, None
+    return max(cortes), or_(*expiradas)
+
+def _tamanho_medio_linha(tabela):
+    """Bytes por linha segundo as estatísticas do MySQL (None nos demais bancos)"""
+    if db.engine.dialect.name != 'mysql':
+        return None
+    return db.session.execute(text(
+        'SELECT AVG_ROW_LENGTH FROM information_schema.TABLES '
+        'WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = :tabela'
+    ), {'tabela': tabela}).scalar()
+
+def _aplicar_tabela(alvo, regra, lote, pausa):
+    modelo, coluna_data, condicao = TABELAS[alvo]
+    corte, expirada = _expiracao_tabela(modelo, coluna_data, condicao, regra)
+    tamanho_linha = _tamanho_medio_linha(modelo.__tablename__)
+    db.session.commit()
+    
+    removidas = 0
+    ultimo_id = 0
+    while corte is not None:
+        # Lotes pela faixa da chave primária, cada um em uma transação curta.
+        # DELETE pelo Core: retenção não é alteração que os clientes precisem sincronizar
+        filtros = [expirada] if condicao is None else [expirada, condicao]
+        ids = db.session.execute(
+            select(modelo.id).where(modelo.id > ultimo_id, modelo.id <= corte, *filtros)
+            .order_by(modelo.id).limit(lote)
+        ).scalars().all()
+        if not ids:
+            break
+        # Filtros repetidos no DELETE: a linha pode ter mudado desde o SELECT
+        removidas += db.session.execute(
+            modelo.__table__.delete().where(modelo.id.in_(ids), *filtros)
+        ).rowcount
+        db.session.commit()
+        ultimo_id = ids[-1]
+        time.sleep(pausa)
+    
+    return {'linhas': removidas, 'bytes': removidas * tamanho_linha if tamanho_linha else None}
+
+def _arquivos(diretorio):
+    """[(mtime, tamanho, caminho)] de todos os arquivos sob o diretório"""
+    arquivos = []
+    for raiz, _, nomes in os.walk(diretorio):
+        for nome in nomes:
+            caminho = os.path.join(raiz, nome)
+            try:
+                estado = os.stat(caminho)
+            except FileNotFoundError:
+                continue
+            arquivos.append((estado.st_mtime, estado.st_size, caminho))
+    return arquivos
+
+def _aplicar_diretorio(alvo, regra, lote, pausa):
+    arquivos = sorted(_arquivos(os.path.join(os.getcwd(), alvo)), reverse=True)
+    expirados = []
+    if regra.get('max_arquivos') is not None:
+        expirados = arquivos[int(regra['max_arquivos']):]
+        arquivos = arquivos[:int(regra['max_arquivos'])]
+    if regra.get('dias') is not None:
+        limite = time.time() - int(regra['dias']) * 86400
+        expirados += [arquivo for arquivo in arquivos if arquivo[0] < limite]
+    
+    removidos = liberados = 0
+    for indice, (_, tamanho, caminho) in enumerate(expirados, 1):
+        try:
+            os.remove(caminho)
+        except FileNotFoundError:
+            continue
+        removidos += 1
+        liberados += tamanho
+        if indice % lote == 0:
+            time.sleep(pausa)
+    
+    return {'arquivos': removidos, 'bytes': liberados}
+
+def _aplicar_backups(regra, lote, pausa):
+    """Remove os backups expirados por remover_backup; backups em andamento nunca saem"""
+    expirados = {}
+    if regra.get('max_arquivos') is not None:
+        # Só os concluídos contam: backups com falha não tomam o lugar de um bom
+        for backup in Backup.query.filter_by(status='concluido').order_by(
+            Backup.id.desc()
+        ).offset(int(regra['max_arquivos'])):
+            expirados[backup.id] = backup
+    if regra.get('dias') is not None:
+        limite = datetime.utcnow() - timedelta(days=int(regra['dias']))
+        for backup in Backup.query.filter(
+            Backup.status.in_(['concluido', 'falha']), Backup.criado_em < limite
+        ):
+            expirados[backup.id] = backup
+    
+    removidos = liberados = 0
+    for indice, backup in enumerate(expirados.values(), 1):
+        liberados += backup.bytes or 0
+        remover_backup(backup)
+        db.session.commit()
+        removidos += 1
+        if indice % lote == 0:
+            time.sleep(pausa)
+    
+    return {'arquivos': removidos, 'bytes': liberados}
+
+def _registrar_metricas(resultado):
+    """Última execução e totais acumulados por alvo no Redis"""
+    cache.set(CHAVE_METRICAS, {'executado_em': datetime.utcnow().isoformat(), 'alvos': resultado})
+    if not cache.redis_client:
+        return
+    
+    try:
+        pipe = cache.redis_client.pipeline()
+        for alvo, metricas in resultado.items():
+            for nome, valor in metricas.items():
+                if valor:
+                    pipe.hincrby(f'{CHAVE_METRICAS}:total', f'{alvo}:{nome}', valor)
+        pipe.execute()
+    except Exception as e:
+        app.logger.warning(f"Erro ao registrar métricas de retenção: {e}")
+
+def metricas_retencao():
+    """{'ultima': última execução, 'total': {alvo:métrica: acumulado}}"""
+    total = {}
+    if cache.redis_client:
+        total = {campo: int(valor) for campo, valor in cache.redis_client.hgetall(f'{CHAVE_METRICAS}:total').items()}
+    return {'ultima': cache.get(CHAVE_METRICAS), 'total': total}
+
+def aplicar_retencao(lote=1000, pausa=0.1):
+    """Remove o que a política de retenção expirou, em lotes
+    
+    Linhas saem em lotes de `lote` ids, cada lote em sua própria transação,
+    com `pausa` segundos entre lotes para não segurar travas nem disputar o
+    banco com as requisições; arquivos também pausam a cada `lote`. Retorna
+    {alvo: {'linhas'|'arquivos': removidos, 'bytes': liberados}}; nas
+    tabelas os bytes são estimados pelas estatísticas do banco (None se
+    indisponíveis).
+    """
+    resultado = {}
+    for alvo, regra in politica_retencao().items():
+        if alvo in TABELAS:
+            resultado[alvo] = _aplicar_tabela(alvo, regra, lote, pausa)
+        elif alvo == BACKUPS:
+            resultado[alvo] = _aplicar_backups(regra, lote, pausa)
+        else:
+            resultado[alvo] = _aplicar_diretorio(alvo, regra, lote, pausa)
+    
+    _registrar_metricas(resultado)
+    return resultado
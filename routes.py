@@ -2,20 +2,49 @@ from flask import render_template, request, redirect, url_for, flash, jsonify
 from flask_login import login_required, current_user
 from app import app, db
 from models import *
+from cache import conditional_get, micro_cache, namespace_version, cache, NotificationCache
+from eventos import publicar, canal_usuario, canal_posto, canal_global, stream_eventos
+from notificacoes import caixa_entrada
+from busca import buscar_registros
+from tags import registros_com_tag, facetas_tags, autocomplete_tags
+from integridade import hash_resumo_plantao
+from arquivamento import consultar_auditoria
+from retencao import politica_retencao, metricas_retencao
+from backups import dados_backup, caminho_backup, dados_restauracao, diretorio_backups
+from manutencao import em_manutencao, definir_manutencao
+from sqlalchemy import func, inspect
+from sqlalchemy.orm import joinedload
 from datetime import datetime, timedelta
 import json
+import os
+import uuid
+
+_serializadores = {}
+
+def _compilar_serializador(classe):
+    """Lista (atributo, coluna, é data) da tabela do modelo, resolvida uma única vez"""
+    mapper = inspect(classe)
+    colunas = [
+        (mapper.get_property_by_column(coluna).key, coluna.name,
+         isinstance(coluna.type, db.DateTime))
+        for coluna in mapper.local_table.columns
+    ]
+    
+    def serializar(obj):
+        dados = {}
+        for atributo, nome, data in colunas:
+            valor = getattr(obj, atributo)
+            if valor is not None:
+                dados[nome] = valor.isoformat() if data else valor
+        return dados
+    return serializar
 
 def serializar_objeto(obj):
     """Serializa um objeto SQLAlchemy para JSON de forma segura"""
-    dados = {}
-    for coluna in obj.__table__.columns:
-        valor = getattr(obj, coluna.name)
-        if valor is not None:
-            if isinstance(valor, datetime):
-                dados[coluna.name] = valor.isoformat()
-            else:
-                dados[coluna.name] = valor
-    return dados
+    serializar = _serializadores.get(type(obj))
+    if serializar is None:
+        serializar = _serializadores[type(obj)] = _compilar_serializador(type(obj))
+    return serializar(obj)
 
 def verificar_perfil(perfil_necessario):
     """Verifica se o usuário atual tem o perfil necessário"""
@@ -23,6 +52,45 @@ def verificar_perfil(perfil_necessario):
         return False
     return True
 
+# Escopos explícitos para cache de respostas e GET condicional
+def escopo_global(usuario):
+    """Resposta idêntica para todos os usuários"""
+    return 'global'
+
+def escopo_usuario(usuario):
+    """Resposta específica do usuário"""
+    return f'usuario:{usuario.id}'
+
+# Versões baratas para GET condicional dos endpoints consultados periodicamente
+def versao_plantao_status(usuario):
+    versao = namespace_version('plantao', f'plantao:{usuario.id}')
+    if versao is None:
+        total, ultimo_id, ultimo_fim = db.session.query(
+            func.count(Plantao.id), func.max(Plantao.id), func.max(Plantao.data_fim)
+        ).filter(Plantao.usuario_id == usuario.id).one()
+        versao = f'{total}:{ultimo_id}:{ultimo_fim}'
+    return versao
+
+def versao_notificacoes(usuario):
+    versao = namespace_version('notificacoes', f'notificacoes:{usuario.id}')
+    if versao is None:
+        total, ultima_id, ultima_leitura = db.session.query(
+            func.count(NotificacaoSistema.id),
+            func.max(NotificacaoSistema.id),
+            func.max(NotificacaoSistema.lida_em)
+        ).filter(NotificacaoSistema.usuario_id == usuario.id).one()
+        versao = f'{total}:{ultima_id}:{ultima_leitura}'
+    return versao
+
+def versao_pendencias(usuario):
+    versao = namespace_version('pendencias')
+    if versao is None:
+        total, ultima = db.session.query(
+            func.count(Pendencia.id), func.max(Pendencia.atualizado_em)
+        ).one()
+        versao = f'{total}:{ultima}'
+    return versao
+
 # Rotas para Registros
 @app.route('/registros')
 @login_required
@@ -35,21 +103,68 @@ def registros():
     # Verificar se é gestor
     is_gestor = current_user.tem_perfil('gestor')
     
+    # Busca textual (ordenada por relevância)
+    busca = request.args.get('q', '').strip()
+    if busca:
+        posto_id_usuario = None if is_gestor else (plantao_ativo.posto_id if plantao_ativo else None)
+        registros = []
+        if is_gestor or posto_id_usuario:
+            registros = registros_da_busca(busca, posto_id_usuario)
+        return render_template('registros.html', registros=registros, plantao_ativo=plantao_ativo,
+                               is_gestor=is_gestor, busca=busca)
+    
+    # Filtro por tag (resolvido pelo índice registro_tags)
+    tag = request.args.get('tag', '').strip()
+    query = Registro.query
+    if tag:
+        query = query.filter(registros_com_tag(tag))
+    
     # Buscar registros (filtrados por posto se não for gestor)
+    facetas = []
     if is_gestor:
         # Gestor vê todos os registros
-        registros = Registro.query.order_by(Registro.criado_em.desc()).all()
+        registros = query.order_by(Registro.criado_em.desc()).all()
+        facetas = facetas_tags(de=datetime.utcnow() - timedelta(days=30))
     else:
         # Usuário normal: filtrar por plantões do posto de trabalho atual
         if plantao_ativo:
             posto_id_usuario = plantao_ativo.posto_id
-            registros = Registro.query.join(Plantao).filter(
+            registros = query.join(Plantao).filter(
                 Plantao.posto_id == posto_id_usuario
             ).order_by(Registro.criado_em.desc()).all()
+            facetas = facetas_tags(posto_id_usuario, de=datetime.utcnow() - timedelta(days=30))
         else:
             registros = []
     
-    return render_template('registros.html', registros=registros, plantao_ativo=plantao_ativo, is_gestor=is_gestor)
+    return render_template('registros.html', registros=registros, plantao_ativo=plantao_ativo,
+                           is_gestor=is_gestor, tag=tag, facetas=facetas)
+
+def _data_busca(nome):
+    valor = request.args.get(nome)
+    try:
+        return datetime.strptime(valor, '%Y-%m-%d') if valor else None
+    except ValueError:
+        return None
+
+def registros_da_busca(busca, posto_id=None, limite=50):
+    """Registros encontrados pela busca textual, na ordem de relevância"""
+    ate = _data_busca('ate')
+    resultados = buscar_registros(
+        busca, posto_id=posto_id, de=_data_busca('de'),
+        ate=ate + timedelta(days=1) if ate else None, limite=limite
+    )
+    if not resultados:
+        return []
+    
+    por_id = {r.id: r for r in Registro.query.options(joinedload(Registro.criador)).filter(
+        Registro.id.in_([registro_id for registro_id, _ in resultados])
+    )}
+    registros = []
+    for registro_id, pontuacao in resultados:
+        if registro_id in por_id:
+            por_id[registro_id].relevancia = pontuacao
+            registros.append(por_id[registro_id])
+    return registros
 
 @app.route('/registros/novo', methods=['GET', 'POST'])
 @login_required
@@ -97,20 +212,8 @@ def novo_registro():
         registro.tags = [tag.strip() for tag in tags if tag.strip()]
         
         db.session.add(registro)
-        db.session.commit()
-        
-        # Registrar na auditoria
-        auditoria = Auditoria(
-            objeto='registro',
-            objeto_id=registro.id,
-            acao='criar',
-            depois=serializar_objeto(registro),
-            autor_id=current_user.id
-        )
-        db.session.add(auditoria)
-        db.session.commit()
         
-        # Criar pendência relacionada se solicitado
+        # Criar pendência relacionada se solicitado (gravada no mesmo commit do registro)
         if request.form.get('criar_pendencia'):
             pendencia_descricao = request.form.get('pendencia_descricao')
             pendencia_prazo = request.form.get('pendencia_prazo')
@@ -120,7 +223,7 @@ def novo_registro():
                     prazo_datetime = datetime.strptime(pendencia_prazo, '%Y-%m-%dT%H:%M')
                     
                     pendencia = Pendencia(
-                        registro_id=registro.id,
+                        registro=registro,
                         descricao=pendencia_descricao,
                         responsavel_id=request.form.get('pendencia_responsavel_id', current_user.id),
                         prazo=prazo_datetime,
@@ -129,7 +232,6 @@ def novo_registro():
                     )
                     
                     db.session.add(pendencia)
-                    db.session.commit()
                     
                     flash('Registro e pendência criados com sucesso!', 'success')
                 except ValueError:
@@ -139,6 +241,8 @@ def novo_registro():
         else:
             flash('Registro criado com sucesso!', 'success')
         
+        db.session.commit()
+        
         # Criar notificação para gestores sobre novo registro
         if current_user.tem_perfil('gestor'):
             # Gestor criou o registro, notificar outros gestores
@@ -186,13 +290,13 @@ def novo_registro():
 @app.route('/registros/<int:registro_id>')
 @login_required
 def visualizar_registro(registro_id):
-    registro = Registro.query.get_or_404(registro_id)
+    registro = Registro.query.options(*Registro.opcoes_detalhe()).get_or_404(registro_id)
     return render_template('visualizar_registro.html', registro=registro)
 
 @app.route('/registros/<int:registro_id>/editar', methods=['GET', 'POST'])
 @login_required
 def editar_registro(registro_id):
-    registro = Registro.query.get_or_404(registro_id)
+    registro = Registro.query.options(*Registro.opcoes_detalhe()).get_or_404(registro_id)
     
     # Verificar se o usuário pode editar (criador ou gestor)
     if registro.criador.id != current_user.id and not current_user.tem_perfil('gestor'):
@@ -207,9 +311,6 @@ def editar_registro(registro_id):
                 flash(f'Campo "{campo}" é obrigatório', 'error')
                 return redirect(url_for('editar_registro', registro_id=registro_id))
         
-        # Salvar dados antigos para auditoria
-        dados_antes = serializar_objeto(registro)
-        
         # Atualizar registro
         registro.tipo = request.form.get('tipo')
         registro.categoria = request.form.get('categoria')
@@ -235,18 +336,6 @@ def editar_registro(registro_id):
         
         db.session.commit()
         
-        # Registrar na auditoria
-        auditoria = Auditoria(
-            objeto='registro',
-            objeto_id=registro.id,
-            acao='editar',
-            antes=dados_antes,
-            depois=serializar_objeto(registro),
-            autor_id=current_user.id
-        )
-        db.session.add(auditoria)
-        db.session.commit()
-        
         flash('Registro atualizado com sucesso!', 'success')
         return redirect(url_for('registros'))
     
@@ -255,6 +344,8 @@ def editar_registro(registro_id):
 # API para verificar status do plantão
 @app.route('/api/plantao/status')
 @login_required
+@conditional_get(versao_plantao_status, escopo_usuario)
+@micro_cache(escopo_usuario, version=versao_plantao_status)
 def api_plantao_status():
     """API para verificar se o usuário tem um plantão ativo"""
     plantao_ativo = Plantao.query.filter_by(
@@ -270,24 +361,15 @@ def api_plantao_status():
 # Rotas para Notificações
 @app.route('/api/notificacoes')
 @login_required
+@conditional_get(versao_notificacoes, escopo_usuario, bucket=60)
 def api_notificacoes():
     """API para buscar notificações do usuário"""
-    notificacoes = NotificacaoSistema.query.filter_by(
-        usuario_id=current_user.id,
-        lida=False
-    ).order_by(NotificacaoSistema.criada_em.desc()).limit(10).all()
+    total, notificacoes = caixa_entrada(current_user.id, 10)
     
     return jsonify({
-        'notificacoes': [{
-            'id': n.id,
-            'tipo': n.tipo,
-            'titulo': n.titulo,
-            'mensagem': n.mensagem,
-            'link': n.link,
-            'criada_em': n.criada_em.isoformat(),
-            'tempo_atras': get_tempo_atras(n.criada_em)
-        } for n in notificacoes],
-        'total': len(notificacoes)
+        'notificacoes': [dict(n, tempo_atras=get_tempo_atras(datetime.fromisoformat(n['criada_em'])))
+                         for n in notificacoes],
+        'total': total
     })
 
 @app.route('/api/notificacoes/<int:notificacao_id>/ler', methods=['POST'])
@@ -319,8 +401,39 @@ def marcar_todas_notificacoes_lidas():
         'lida_em': datetime.utcnow()
     })
     db.session.commit()
+    NotificationCache.clear(current_user.id)
+    publicar(canal_usuario(current_user.id), 'notificacao', {'recarregar': True})
     return jsonify({'success': True})
 
+# Canal de eventos em tempo real (Server-Sent Events)
+@app.route('/api/eventos')
+@login_required
+def api_eventos():
+    """Stream SSE de pendências críticas, notificações e status de plantão"""
+    if not cache.redis_client:
+        # 204 faz o EventSource desistir; o cliente passa a usar polling
+        return '', 204
+    
+    canais = [canal_global(), canal_usuario(current_user.id)]
+    plantao_ativo = Plantao.query.filter_by(
+        usuario_id=current_user.id,
+        status='aberto'
+    ).first()
+    if plantao_ativo:
+        canais.append(canal_posto(plantao_ativo.posto_id))
+    
+    # Devolver a conexão ao pool: o stream pode ficar aberto por horas
+    db.session.close()
+    
+    return app.response_class(
+        stream_eventos(canais),
+        mimetype='text/event-stream',
+        headers={
+            'Cache-Control': 'no-cache',
+            'X-Accel-Buffering': 'no'
+        }
+    )
+
 def criar_notificacao(usuario_id, tipo, titulo, mensagem, link=None):
     """Função helper para criar notificações"""
     notificacao = NotificacaoSistema(
@@ -392,17 +505,6 @@ def nova_pendencia():
         db.session.add(pendencia)
         db.session.commit()
         
-        # Registrar na auditoria
-        auditoria = Auditoria(
-            objeto='pendencia',
-            objeto_id=pendencia.id,
-            acao='criar',
-            depois=serializar_objeto(pendencia),
-            autor_id=current_user.id
-        )
-        db.session.add(auditoria)
-        db.session.commit()
-        
         flash('Pendência criada com sucesso!', 'success')
         
         # Criar notificação para pendências críticas
@@ -469,9 +571,6 @@ def atualizar_pendencia(pendencia_id):
     if status not in ['aberta', 'em_andamento', 'bloqueada', 'concluida']:
         return jsonify({'success': False, 'message': 'Status inválido'})
     
-    # Salvar estado anterior para auditoria
-    estado_anterior = serializar_objeto(pendencia)
-    
     # Atualizar pendência
     pendencia.status = status
     pendencia.motivo_bloqueio = request.form.get('motivo_bloqueio') if status == 'bloqueada' else None
@@ -479,18 +578,6 @@ def atualizar_pendencia(pendencia_id):
     
     db.session.commit()
     
-    # Registrar na auditoria
-    auditoria = Auditoria(
-        objeto='pendencia',
-        objeto_id=pendencia.id,
-        acao='atualizar',
-        antes=estado_anterior,
-        depois=serializar_objeto(pendencia),
-        autor_id=current_user.id
-    )
-    db.session.add(auditoria)
-    db.session.commit()
-    
     return jsonify({'success': True, 'message': 'Pendência atualizada com sucesso!'})
 
 @app.route('/pendencias/<int:pendencia_id>')
@@ -528,7 +615,7 @@ def passagem():
             return redirect(url_for('selecionar_plantao'))
     
     # Buscar pendências em aberto
-    registros_ids = [r.id for r in Registro.query.filter_by(plantao_id=plantao_ativo.id).all()]
+    registros_ids = [r.id for r in Registro.query.filter_by(plantao_id=plantao_ativo.id).with_entities(Registro.id)]
     pendencias_abertas = Pendencia.query.filter(
         Pendencia.registro_id.in_(registros_ids),
         Pendencia.status.in_(['aberta', 'em_andamento'])
@@ -600,17 +687,6 @@ def iniciar_plantao():
         db.session.add(novo_plantao)
         db.session.commit()
         
-        # Registrar na auditoria
-        auditoria = Auditoria(
-            objeto='plantao',
-            objeto_id=novo_plantao.id,
-            acao='iniciar',
-            depois=serializar_objeto(novo_plantao),
-            autor_id=current_user.id
-        )
-        db.session.add(auditoria)
-        db.session.commit()
-        
         flash(f'Plantão iniciado com sucesso no posto {posto.nome}!', 'success')
         return redirect(url_for('passagem'))
     
@@ -658,32 +734,15 @@ def encerrar_plantao():
             flash(f'Item obrigatório não marcado: {item}', 'error')
             return redirect(url_for('passagem'))
     
-    # Salvar estado anterior para auditoria
-    estado_anterior = serializar_objeto(plantao_ativo)
-    
     # Encerrar plantão
     plantao_ativo.status = 'encerrado'
     plantao_ativo.data_fim = datetime.utcnow()
     
-    # Gerar hash do resumo para auditoria
-    resumo = f"Plantão {plantao_ativo.id} - {plantao_ativo.data_inicio} a {plantao_ativo.data_fim}"
-    import hashlib
-    plantao_ativo.hash_resumo = hashlib.sha256(resumo.encode()).hexdigest()
+    # Gerar hash do resumo para auditoria (plantão, registros e âncora na cadeia de auditoria)
+    plantao_ativo.hash_resumo = hash_resumo_plantao(plantao_ativo)
     
     db.session.commit()
     
-    # Registrar na auditoria
-    auditoria = Auditoria(
-        objeto='plantao',
-        objeto_id=plantao_ativo.id,
-        acao='encerrar',
-        antes=estado_anterior,
-        depois=serializar_objeto(plantao_ativo),
-        autor_id=current_user.id
-    )
-    db.session.add(auditoria)
-    db.session.commit()
-    
     # Mensagem personalizada baseada em quem encerrou
     if plantao_ativo.usuario_id == current_user.id:
         flash('Plantão encerrado com sucesso!', 'success')
@@ -1133,7 +1192,8 @@ def configuracoes():
     ultima_atualizacao = datetime.utcnow().strftime('%d/%m/%Y %H:%M')
     espaco_disco = '2.5 GB livre de 500 GB'
     memoria_uso = '45% (1.8 GB de 4 GB)'
-    ultimo_backup = datetime.utcnow().strftime('%d/%m/%Y às %H:%M')
+    backup = Backup.query.filter_by(status='concluido').order_by(Backup.id.desc()).first()
+    ultimo_backup = backup.concluido_em.strftime('%d/%m/%Y às %H:%M') if backup else None
     
     return render_template('configuracoes.html',
                          unidades=unidades,
@@ -1398,62 +1458,62 @@ def realizar_backup():
     if not verificar_perfil('gestor'):
         return jsonify({'success': False, 'message': 'Acesso negado'})
     
+    # O dump roda no Celery; a interface acompanha por /backup/<id>
+    backup = Backup(solicitado_por=current_user.id)
+    db.session.add(backup)
+    db.session.commit()
+    
     try:
-        import os
-        import subprocess
-        from datetime import datetime
-        
-        # Criar diretório de backup se não existir
-        backup_dir = os.path.join(os.getcwd(), 'backups')
-        os.makedirs(backup_dir, exist_ok=True)
-        
-        # Nome do arquivo de backup
-        timestamp = datetime.utcnow().strftime('%Y%m%d_%H%M%S')
-        backup_file = os.path.join(backup_dir, f'backup_passometro_{timestamp}.sql')
-        
-        # Comando para fazer backup do MySQL (versão simplificada)
-        cmd = [
-            'mysqldump',
-            '-u', 'root',
-            '-p12345678',
-            'passometro',
-            '--single-transaction',
-            '--skip-lock-tables'
-        ]
-        
-        # Executar backup
-        with open(backup_file, 'w') as f:
-            result = subprocess.run(cmd, stdout=f, stderr=subprocess.PIPE, text=True)
-        
-        # Verificar se o backup foi criado e tem conteúdo
-        if result.returncode == 0 and os.path.exists(backup_file) and os.path.getsize(backup_file) > 0:
-            # Atualizar configuração de último backup
-            Configuracao.set_valor('ultimo_backup', datetime.utcnow().isoformat())
-            
-            # Retornar arquivo para download
-            from flask import send_file
-            return send_file(
-                backup_file,
-                as_attachment=True,
-                download_name=os.path.basename(backup_file),
-                mimetype='application/sql'
-            )
-        else:
-            # Se o arquivo foi criado mas está vazio, removê-lo
-            if os.path.exists(backup_file):
-                os.remove(backup_file)
-            
-            error_msg = result.stderr if result.stderr else 'Erro desconhecido'
-            return jsonify({
-                'success': False, 
-                'message': f'Erro ao realizar backup: {error_msg}'
-            })
-            
+        from celery_app import gerar_backup
+        gerar_backup.delay(backup.id)
     except Exception as e:
+        backup.status = 'falha'
+        backup.erro = f'Fila indisponível: {e}'
+        db.session.commit()
         return jsonify({
             'success': False, 
-            'message': f'Erro ao realizar backup: {str(e)}'
+            'message': f'Erro ao agendar backup: {str(e)}'
         })
+    
+    return jsonify({
+        'success': True,
+        'backup': dados_backup(backup),
+        'status_url': url_for('status_backup', backup_id=backup.id),
+        'download_url': url_for('download_backup', backup_id=backup.id)
+    }), 202
+
+@app.route('/backup/<int:backup_id>')
+@login_required
+def status_backup(backup_id):
+    if not verificar_perfil('gestor'):
+        return jsonify({'success': False, 'message': 'Acesso negado'}), 403
+    
+    backup = Backup.query.get_or_404(backup_id)
+    return jsonify({'success': True, 'backup': dados_backup(backup)})
+
+@app.route('/backup/<int:backup_id>/download')
+@login_required
+def download_backup(backup_id):
+    if not verificar_perfil('gestor'):
+        return jsonify({'success': False, 'message': 'Acesso negado'}), 403
+    
+    backup = Backup.query.get_or_404(backup_id)
+    if backup.status != 'concluido' or not os.path.exists(caminho_backup(backup)):
+        return jsonify({'success': False, 'message': 'Backup indisponível'}), 404
+    
+    # conditional=True: suporte a Range (downloads retomáveis) e If-None-Match
+    from flask import send_file
+    resposta = send_file(
+        caminho_backup(backup),
+        as_attachment=True,
+        download_name=os.path.basename(backup.arquivo),
+        mimetype='application/x-tar',
+        conditional=True,
+        etag=backup.sha256
+    )
+    resposta.headers['Accept-Ranges'] = 'bytes'
+    resposta.headers['X-Checksum-SHA256'] = backup.sha256
+    return resposta
 
 @app.route('/backup/restaurar', methods=['POST'])
 @login_required
@@ -1462,8 +1522,6 @@ def restaurar_backup():
         return jsonify({'success': False, 'message': 'Acesso negado'})
     
     try:
-        import os
-        import subprocess
         from werkzeug.utils import secure_filename
         
         # Verificar se arquivo foi enviado
@@ -1475,47 +1533,54 @@ def restaurar_backup():
             return jsonify({'success': False, 'message': 'Nenhum arquivo selecionado'})
         
         # Verificar extensão
-        if not file.filename.endswith('.sql'):
-            return jsonify({'success': False, 'message': 'Arquivo deve ser .sql'})
-        
-        # Salvar arquivo temporariamente
-        filename = secure_filename(file.filename)
-        temp_dir = os.path.join(os.getcwd(), 'temp')
-        os.makedirs(temp_dir, exist_ok=True)
-        temp_file = os.path.join(temp_dir, filename)
-        file.save(temp_file)
-        
-        # Comando para restaurar backup
-        cmd = [
-            'mysql',
-            '-u', 'root',
-            '-p12345678',
-            'passometro'
-        ]
+        if not file.filename.endswith('.tar'):
+            return jsonify({'success': False, 'message': 'Arquivo deve ser um backup .tar do Passômetro'})
         
-        # Executar restauração
-        with open(temp_file, 'r') as f:
-            result = subprocess.run(cmd, stdin=f, stderr=subprocess.PIPE, text=True)
+        if Restauracao.query.filter(Restauracao.status.in_(['pendente', 'executando'])).first():
+            return jsonify({'success': False, 'message': 'Já existe uma restauração em andamento'}), 409
         
-        # Limpar arquivo temporário
-        os.remove(temp_file)
-        
-        if result.returncode == 0:
-            return jsonify({
-                'success': True, 
-                'message': 'Backup restaurado com sucesso!'
-            })
-        else:
-            return jsonify({
-                'success': False, 
-                'message': f'Erro ao restaurar backup: {result.stderr}'
-            })
-            
+        # O arquivo fica em BACKUP_DIR, visível para o worker do Celery que faz a restauração
+        arquivo = os.path.join('restauracoes', f'{uuid.uuid4().hex}_{secure_filename(file.filename)}')
+        os.makedirs(os.path.join(diretorio_backups(), 'restauracoes'), exist_ok=True)
+        file.save(os.path.join(diretorio_backups(), arquivo))
     except Exception as e:
         return jsonify({
             'success': False, 
             'message': f'Erro ao restaurar backup: {str(e)}'
         })
+    
+    # A restauração roda no Celery, em modo manutenção; a interface acompanha por /backup/restauracao/<id>
+    restauracao = Restauracao(arquivo=arquivo, solicitado_por=current_user.id)
+    db.session.add(restauracao)
+    db.session.commit()
+    
+    try:
+        from celery_app import restaurar_backup as tarefa_restaurar_backup
+        tarefa_restaurar_backup.delay(restauracao.id)
+    except Exception as e:
+        os.remove(os.path.join(diretorio_backups(), arquivo))
+        restauracao.status = 'falha'
+        restauracao.erro = f'Fila indisponível: {e}'
+        db.session.commit()
+        return jsonify({
+            'success': False, 
+            'message': f'Erro ao agendar restauração: {str(e)}'
+        })
+    
+    return jsonify({
+        'success': True,
+        'restauracao': dados_restauracao(restauracao),
+        'status_url': url_for('status_restauracao', restauracao_id=restauracao.id)
+    }), 202
+
+@app.route('/backup/restauracao/<int:restauracao_id>')
+@login_required
+def status_restauracao(restauracao_id):
+    if not verificar_perfil('gestor'):
+        return jsonify({'success': False, 'message': 'Acesso negado'}), 403
+    
+    restauracao = Restauracao.query.get_or_404(restauracao_id)
+    return jsonify({'success': True, 'restauracao': dados_restauracao(restauracao)})
 
 @app.route('/manutencao/limpar-cache', methods=['POST'])
 @login_required
@@ -1608,10 +1673,9 @@ def modo_manutencao():
     
     try:
         # Alternar modo manutenção
-        modo_atual = Configuracao.get_valor('modo_manutencao', False)
-        novo_modo = not modo_atual
+        novo_modo = not em_manutencao()
         
-        Configuracao.set_valor('modo_manutencao', novo_modo)
+        definir_manutencao(novo_modo)
         
         if novo_modo:
             return jsonify({
@@ -1634,7 +1698,7 @@ def modo_manutencao():
 @app.route('/api/registros/<int:plantao_id>')
 @login_required
 def api_registros(plantao_id):
-    registros = Registro.query.filter_by(plantao_id=plantao_id).order_by(
+    registros = Registro.query.options(joinedload(Registro.criador)).filter_by(plantao_id=plantao_id).order_by(
         Registro.criado_em.desc()
     ).all()
     
@@ -1648,12 +1712,113 @@ def api_registros(plantao_id):
         'criador': r.criador.nome
     } for r in registros])
 
+@app.route('/api/registros/busca')
+@login_required
+def api_busca_registros():
+    """Busca textual de registros (sem acentos/maiúsculas, limitada ao posto para não gestores)"""
+    busca = request.args.get('q', '').strip()
+    if not busca:
+        return jsonify({'error': 'Informe o termo de busca (q)'}), 400
+    
+    posto_id = None
+    if not current_user.tem_perfil('gestor'):
+        plantao_ativo = Plantao.query.filter_by(
+            usuario_id=current_user.id,
+            status='aberto'
+        ).first()
+        if not plantao_ativo:
+            return jsonify([])
+        posto_id = plantao_ativo.posto_id
+    
+    limite = min(request.args.get('limit', 20, type=int), 100)
+    return jsonify([{
+        'id': r.id,
+        'titulo': r.titulo,
+        'tipo': r.tipo,
+        'categoria': r.categoria,
+        'prioridade': r.prioridade,
+        'criado_em': r.criado_em.strftime('%d/%m/%Y %H:%M'),
+        'criador': r.criador.nome,
+        'relevancia': round(r.relevancia, 2)
+    } for r in registros_da_busca(busca, posto_id, limite)])
+
+@app.route('/api/tags/autocomplete')
+@login_required
+def api_tags_autocomplete():
+    """Sugestões de tags por prefixo (lista ordenada em memória do worker)"""
+    limite = min(request.args.get('limit', 10, type=int), 50)
+    return jsonify(autocomplete_tags.sugerir(request.args.get('q', ''), limite))
+
+@app.route('/api/tags/facetas')
+@login_required
+def api_tags_facetas():
+    """Quantidade de registros por tag no período (e no posto, para não gestores)"""
+    if current_user.tem_perfil('gestor'):
+        posto_id = request.args.get('posto_id', type=int)
+    else:
+        plantao_ativo = Plantao.query.filter_by(
+            usuario_id=current_user.id,
+            status='aberto'
+        ).first()
+        if not plantao_ativo:
+            return jsonify([])
+        posto_id = plantao_ativo.posto_id
+    
+    ate = _data_busca('ate')
+    facetas = facetas_tags(
+        posto_id, de=_data_busca('de'), ate=ate + timedelta(days=1) if ate else None,
+        limite=min(request.args.get('limit', 20, type=int), 100)
+    )
+    return jsonify([{'tag': nome, 'quantidade': quantidade} for nome, quantidade in facetas])
+
+@app.route('/api/auditoria')
+@login_required
+def api_auditoria():
+    """Consulta a auditoria, incluindo períodos já arquivados (apenas gestores)"""
+    if not current_user.tem_perfil('gestor'):
+        return jsonify({'error': 'Acesso negado'}), 403
+    
+    from auditoria import reconstruir_linhas
+    
+    ate = _data_busca('ate')
+    linhas = consultar_auditoria(
+        objeto=request.args.get('objeto'),
+        objeto_id=request.args.get('objeto_id', type=int),
+        de=_data_busca('de'),
+        ate=ate + timedelta(days=1) if ate else None,
+        limite=min(request.args.get('limit', 100, type=int), 1000)
+    )
+    estados = reconstruir_linhas(linhas)
+    return jsonify([{
+        'id': linha.id,
+        'objeto': linha.objeto,
+        'objeto_id': linha.objeto_id,
+        'acao': linha.acao,
+        'antes': linha.antes,
+        'depois': linha.depois,
+        'snapshot': bool(linha.snapshot),
+        'estado': estados[linha.id],
+        'autor_id': linha.autor_id,
+        'timestamp': linha.timestamp.isoformat()
+    } for linha in linhas])
+
+@app.route('/api/retencao')
+@login_required
+def api_retencao():
+    """Política de retenção efetiva e espaço recuperado (apenas gestores)"""
+    if not current_user.tem_perfil('gestor'):
+        return jsonify({'error': 'Acesso negado'}), 403
+    
+    return jsonify({'politica': politica_retencao(), 'metricas': metricas_retencao()})
+
 @app.route('/api/pendencias/criticas')
 @login_required
+@conditional_get(versao_pendencias, escopo_global, bucket=60)
+@micro_cache(escopo_global, timeout=10, version=versao_pendencias)
 def api_pendencias_criticas():
-    pendencias = Pendencia.query.filter_by(
+    pendencias = Pendencia.query.options(joinedload(Pendencia.responsavel)).filter_by(
         status='aberta',
-        prioridade='crítica'
+        prioridade='critica'
     ).limit(10).all()
     
     return jsonify([{
@@ -1664,4 +1829,3 @@ def api_pendencias_criticas():
         'sla_restante': (p.prazo - datetime.utcnow()).total_seconds() / 60
     } for p in pendencias])
 
- 
\ No newline at end of file
@@ -0,0 +1,213 @@
+from sqlalchemy import event, select, or_, inspect, cast, String
+from sqlalchemy.orm.attributes import flag_modified
+from datetime import datetime, timedelta
+from app import db
+from cache import cache
+from models import Pendencia, Usuario, NotificacaoSistema, Configuracao
+
+STATUS_ATIVOS = ('aberta', 'em_andamento')
+
+def antecedencia_alerta():
+    return timedelta(minutes=Configuracao.get_valor('alerta_antecedencia', 30))
+
+def ids_gestores():
+    """Ids dos gestores ativos
+    
+    perfis é uma lista JSON: o texto serializado contém o perfil entre aspas,
+    o que funciona em qualquer banco sem funções JSON específicas.
+    """
+    return db.session.execute(
+        select(Usuario.id).where(Usuario.ativo.is_(True), cast(Usuario.perfis, String).like('%"gestor"%'))
+    ).scalars().all()
+
+def _nao_alertadas():
+    # O alerta vale para um prazo: alterar o prazo rearma a pendência
+    return or_(Pendencia.sla_alerta_prazo.is_(None), Pendencia.sla_alerta_prazo != Pendencia.prazo)
+
+def _notificacoes(pendencias, agora, gestores):
+    linhas = []
+    for pendencia in pendencias:
+        minutos = (pendencia.prazo - agora).total_seconds() / 60
+        linhas.append({
+            'usuario_id': pendencia.responsavel_id,
+            'tipo': 'sla_vencendo',
+            'titulo': 'SLA Vencendo',
+            'mensagem': f'Pendência "{pendencia.descricao[:50]}..." vence em {minutos:.0f} minutos',
+            'link': f'/pendencias/{pendencia.id}',
+            'lida': False,
+            'criada_em': agora
+        })
+        if pendencia.prioridade == 'critica':
+            linhas.extend({
+                'usuario_id': gestor_id,
+                'tipo': 'sla_critico_vencendo',
+                'titulo': 'SLA Crítico Vencendo',
+                'mensagem': f'Pendência crítica vence em {minutos:.0f} minutos',
+                'link': f'/pendencias/{pendencia.id}',
+                'lida': False,
+                'criada_em': agora
+            } for gestor_id in gestores)
+    return linhas
+
+def alertar_sla(filtros, agora=None):
+    """Envia o alerta de SLA das pendências ativas que atendem `filtros` e ainda não o receberam
+    
+    As pendências são travadas (SKIP LOCKED) e marcadas com o prazo alertado
+    na mesma transação das notificações; duas execuções simultâneas não
+    alertam a mesma pendência. Tudo passa pela sessão, então auditoria, log
+    de alterações, caixas de entrada, caches, eventos e a agenda seguem os
+    hooks de sempre; as notificações saem num INSERT em lote do flush.
+    Retorna os ids das pendências alertadas (as travadas por outra execução
+    ficam de fora).
+    """
+    agora = agora or datetime.utcnow()
+    pendencias = Pendencia.query.filter(
+        Pendencia.status.in_(STATUS_ATIVOS), Pendencia.prazo > agora, _nao_alertadas(), *filtros
+    ).with_for_update(skip_locked=True).all()
+    if not pendencias:
+        db.session.commit()
+        return []
+    
+    gestores = ids_gestores() if any(p.prioridade == 'critica' for p in pendencias) else []
+    db.session.add_all(NotificacaoSistema(**linha) for linha in _notificacoes(pendencias, agora, gestores))
+    alertadas = []
+    for pendencia in pendencias:
+        pendencia.sla_alerta_prazo = pendencia.prazo
+        # A marcação é controle interno: atualizado_em continua o da última edição
+        flag_modified(pendencia, 'atualizado_em')
+        alertadas.append(pendencia.id)
+    db.session.commit()
+    return alertadas
+
+def verificar_sla(agora=None):
+    """Alerta as pendências que entraram na janela de antecedência do prazo"""
+    agora = agora or datetime.utcnow()
+    return len(alertar_sla([Pendencia.prazo <= agora + antecedencia_alerta()], agora))
+
+# Agenda de prazos no Redis: membro = id da pendência, score = prazo (epoch).
+# O despachante alerta o que vence até agora + antecedência, então mudar
+# 'alerta_antecedencia' não exige reagendar nada.
+CHAVE_AGENDA = 'sla:prazos'
+CAMPOS_AGENDA = ('prazo', 'prioridade', 'status', 'sla_alerta_prazo')
+
+def _score(prazo):
+    return (prazo - datetime(1970, 1, 1)).total_seconds()
+
+def _agendavel(status, prazo, sla_alerta_prazo):
+    return status in STATUS_ATIVOS and prazo is not None and sla_alerta_prazo != prazo
+
+def registrar_agenda_sla(session):
+    """Mantém a agenda de prazos no Redis após o commit das pendências
+    
+    Criações e mudanças de prazo, prioridade ou status (re)agendam a
+    pendência; conclusão, cancelamento e exclusão a retiram. Sem Redis o
+    alerta fica a cargo da varredura periódica (verificar_sla).
+    """
+    info_key = 'agenda_sla_pendente'
+    
+    @event.listens_for(session, 'after_flush')
+    def after_flush(session, flush_context):
+        pendentes = session.info.setdefault(info_key, {})
+        for obj in session.new:
+            if isinstance(obj, Pendencia):
+                pendentes[obj.id] = (obj.status, obj.prazo, obj.sla_alerta_prazo)
+        
+        for obj in session.dirty:
+            if not isinstance(obj, Pendencia):
+                continue
+            estado = inspect(obj)
+            if any(estado.attrs[campo].history.has_changes() for campo in CAMPOS_AGENDA):
+                pendentes[obj.id] = (obj.status, obj.prazo, obj.sla_alerta_prazo)
+        
+        for obj in session.deleted:
+            if isinstance(obj, Pendencia):
+                pendentes[obj.id] = None
+    
+    @event.listens_for(session, 'after_commit')
+    def after_commit(session):
+        pendentes = session.info.pop(info_key, {})
+        if not pendentes or not cache.redis_client:
+            return
+        
+        try:
+            pipe = cache.redis_client.pipeline()
+            for pendencia_id, dados in pendentes.items():
+                if dados and _agendavel(*dados):
+                    pipe.zadd(CHAVE_AGENDA, {pendencia_id: _score(dados[1])})
+                else:
+                    pipe.zrem(CHAVE_AGENDA, pendencia_id)
+            pipe.execute()
+        except Exception:
+            pass  # A reconciliação periódica reconstrói a agenda
+    
+    @event.listens_for(session, 'after_rollback')
+    def after_rollback(session):
+        session.info.pop(info_key, None)
+
+def despachar_alertas_sla(agora=None, lote=500):
+    """Alerta as pendências da agenda cujo momento de alerta já chegou
+    
+    Cada id é reivindicado com ZREM (só um worker recebe 1), então
+    despachantes concorrentes não repetem alertas. Entradas obsoletas
+    (pendência concluída, prazo já alertado) são descartadas; as que
+    alertar_sla pulou por estarem travadas (SKIP LOCKED) voltam para a
+    agenda com o prazo atual. Retorna quantas pendências foram alertadas.
+    """
+    if not cache.redis_client:
+        return 0
+    
+    agora = agora or datetime.utcnow()
+    vencidas = cache.redis_client.zrangebyscore(
+        CHAVE_AGENDA, '-inf', _score(agora + antecedencia_alerta()), start=0, num=lote, withscores=True
+    )
+    if not vencidas:
+        return 0
+    
+    pipe = cache.redis_client.pipeline()
+    for membro, _ in vencidas:
+        pipe.zrem(CHAVE_AGENDA, membro)
+    reivindicadas = {membro: score for (membro, score), removido in zip(vencidas, pipe.execute()) if removido}
+    if not reivindicadas:
+        return 0
+    
+    try:
+        alertadas = alertar_sla([Pendencia.id.in_([int(membro) for membro in reivindicadas])], agora)
+    except Exception:
+        db.session.rollback()
+        cache.redis_client.zadd(CHAVE_AGENDA, reivindicadas)
+        raise
+    
+    # Sem trava: o que ainda estiver pendente de alerta foi pulado, não está obsoleto
+    restantes = set(map(int, reivindicadas)) - set(alertadas)
+    if restantes:
+        puladas = db.session.execute(
+            select(Pendencia.id, Pendencia.prazo)
+            .where(Pendencia.id.in_(restantes), Pendencia.status.in_(STATUS_ATIVOS),
+                   Pendencia.prazo > agora, _nao_alertadas())
+        ).all()
+        db.session.commit()
+        if puladas:
+            cache.redis_client.zadd(CHAVE_AGENDA, {linha.id: _score(linha.prazo) for linha in puladas})
+    return len(alertadas)
+
+def reconciliar_agenda_sla(lote=1000):
+    """Reinsere na agenda todas as pendências ativas ainda não alertadas (rede de segurança)"""
+    if not cache.redis_client:
+        return 0
+    
+    agendadas = 0
+    ultimo_id = 0
+    while True:
+        linhas = db.session.execute(
+            select(Pendencia.id, Pendencia.prazo)
+            .where(Pendencia.id > ultimo_id, Pendencia.status.in_(STATUS_ATIVOS),
+                   Pendencia.prazo > datetime.utcnow(), _nao_alertadas())
+            .order_by(Pendencia.id).limit(lote)
+        ).all()
+        if not linhas:
+            break
+        cache.redis_client.zadd(CHAVE_AGENDA, {linha.id: _score(linha.prazo) for linha in linhas})
+        agendadas += len(linhas)
+        ultimo_id = linhas[-1].id
+    db.session.commit()
+    return agendadas
@@ -13,7 +13,11 @@ $(document).ready(function() {
     }, 5000);
     
     // Real-time updates for critical items
-    updateCriticalItems();
+    TempoReal.assinar('pendencia_critica', updateCriticalItems);
+    TempoReal.iniciar();
+    
+    // Results of writes replayed from the offline queue
+    FilaOffline.ouvirResultados();
     
     // Initialize form validations
     initializeFormValidations();
@@ -22,19 +26,187 @@ $(document).ready(function() {
     initializeTimelineAnimations();
 });
 
-// Update critical items every 30 seconds
-function updateCriticalItems() {
-    setInterval(function() {
-        fetch('/api/pendencias/criticas')
-            .then(response => response.json())
-            .then(data => {
-                updateCriticalCounters(data);
-                updateCriticalAlerts(data);
-            })
-            .catch(error => {
-                console.error('Erro ao atualizar dados críticos:', error);
+// Real-time channel: Server-Sent Events, falling back to adaptive polling
+const TempoReal = {
+    // Configured "auto_refresh" interval (seconds)
+    intervaloBase: (window.PASSOMETRO_AUTO_REFRESH || 30) * 1000,
+    intervaloMaximo: 5 * 60 * 1000,
+    assinaturas: [],
+    fonte: null,
+    polling: false,
+    
+    // Register a refresh callback for an event type
+    // ('pendencia_critica', 'notificacao' or 'plantao_status')
+    assinar(tipo, atualizar) {
+        const assinatura = { tipo, atualizar, intervalo: this.intervaloBase, timer: null, ultimo: null };
+        this.assinaturas.push(assinatura);
+        
+        if (this.polling) {
+            this.agendar(assinatura, 0);
+        }
+    },
+    
+    iniciar() {
+        if (!window.EventSource) {
+            this.iniciarPolling();
+            return;
+        }
+        
+        this.fonte = new EventSource('/api/eventos');
+        
+        // (Re)connected: refresh everything once to cover the gap
+        this.fonte.onopen = () => this.assinaturas.forEach(a => a.atualizar());
+        
+        this.fonte.onerror = () => {
+            // CLOSED means the server refused the stream (e.g. 204 without Redis);
+            // otherwise the browser reconnects by itself
+            if (this.fonte.readyState === EventSource.CLOSED) {
+                this.fonte = null;
+                this.iniciarPolling();
+            }
+        };
+        
+        ['pendencia_critica', 'notificacao', 'plantao_status'].forEach(tipo => {
+            this.fonte.addEventListener(tipo, () => {
+                this.assinaturas
+                    .filter(a => a.tipo === tipo)
+                    .forEach(a => a.atualizar());
             });
-    }, 30000);
+        });
+    },
+    
+    // Visibility-aware adaptive polling: pauses in hidden tabs and backs off
+    // while the data does not change
+    iniciarPolling() {
+        if (this.polling) {
+            return;
+        }
+        this.polling = true;
+        
+        this.assinaturas.forEach(a => this.agendar(a, 0));
+        
+        document.addEventListener('visibilitychange', () => {
+            this.assinaturas.forEach(a => {
+                clearTimeout(a.timer);
+                if (document.visibilityState === 'visible') {
+                    a.intervalo = this.intervaloBase;
+                    this.agendar(a, 0);
+                }
+            });
+        });
+    },
+    
+    agendar(assinatura, atraso) {
+        clearTimeout(assinatura.timer);
+        assinatura.timer = setTimeout(() => {
+            if (document.visibilityState === 'hidden') {
+                return;
+            }
+            
+            Promise.resolve(assinatura.atualizar()).then(dados => {
+                const atual = JSON.stringify(dados);
+                if (atual === assinatura.ultimo) {
+                    assinatura.intervalo = Math.min(assinatura.intervalo * 2, this.intervaloMaximo);
+                } else {
+                    assinatura.intervalo = this.intervaloBase;
+                }
+                assinatura.ultimo = atual;
+            }).catch(() => {
+                assinatura.intervalo = Math.min(assinatura.intervalo * 2, this.intervaloMaximo);
+            }).then(() => this.agendar(assinatura, assinatura.intervalo));
+        }, atraso);
+    }
+};
+
+// Offline queue: writes that fail for lack of network are handed to the
+// service worker, which replays them through /api/v1/sync with one
+// idempotency key per operation
+const FilaOffline = {
+    mensagem: 'Sem conexão: a alteração foi guardada e será enviada quando a conexão voltar',
+    
+    // tipo: 'pendencia_status' or 'notificacao_lida' (OPERACOES_SINCRONIZACAO in api.py);
+    // resolves with the key once the service worker has stored the operation
+    enfileirar(tipo, dados) {
+        const controller = navigator.serviceWorker && navigator.serviceWorker.controller;
+        if (!controller) {
+            return Promise.reject(new Error('Service worker indisponível'));
+        }
+        
+        return new Promise((resolve) => {
+            const canal = new MessageChannel();
+            canal.port1.onmessage = (event) => resolve(event.data.chave);
+            controller.postMessage({
+                type: 'QUEUE_OPERATION',
+                operacao: { chave: crypto.randomUUID(), tipo, dados }
+            }, [canal.port2]);
+        });
+    },
+    
+    // Form POST that returns JSON; only a network failure (fetch rejected,
+    // not an error status) falls back to the queue, resolving {offline: true}
+    enviar(url, corpo, tipo, dados) {
+        return fetch(url, {
+            method: 'POST',
+            headers: {
+                'Content-Type': 'application/x-www-form-urlencoded',
+            },
+            body: corpo
+        }).then(
+            response => response.json(),
+            error => this.enfileirar(tipo, dados).then(
+                () => ({ success: false, offline: true, message: this.mensagem }),
+                () => { throw error; }
+            )
+        );
+    },
+    
+    ouvirResultados() {
+        if (!navigator.serviceWorker) {
+            return;
+        }
+        
+        navigator.serviceWorker.addEventListener('message', (event) => {
+            if (!event.data || event.data.type !== 'SYNC_RESULTS') {
+                return;
+            }
+            
+            const recusadas = event.data.resultados.filter(r => r.status >= 400);
+            if (recusadas.length > 0) {
+                showAlert(`${recusadas.length} alteração(ões) feita(s) sem conexão foram recusadas pelo servidor`, 'warning');
+            } else {
+                showAlert('Alterações feitas sem conexão sincronizadas', 'success');
+            }
+        });
+    }
+};
+
+// Status change of a pendência (queued offline when there is no network)
+function atualizarStatusPendencia(pendenciaId, status, motivoBloqueio) {
+    let corpo = `status=${status}`;
+    if (motivoBloqueio !== undefined) {
+        corpo += `&motivo_bloqueio=${encodeURIComponent(motivoBloqueio)}`;
+    }
+    
+    return FilaOffline.enviar(`/pendencias/${pendenciaId}/atualizar`, corpo, 'pendencia_status', {
+        id: pendenciaId,
+        status,
+        motivo_bloqueio: motivoBloqueio
+    });
+}
+
+// Fetch critical items and update the UI
+function updateCriticalItems() {
+    return fetch('/api/pendencias/criticas')
+        .then(response => response.json())
+        .then(data => {
+            updateCriticalCounters(data);
+            updateCriticalAlerts(data);
+            return data;
+        })
+        .catch(error => {
+            console.error('Erro ao atualizar dados críticos:', error);
+            throw error;
+        });
 }
 
 // Update critical counters
@@ -66,6 +66,11 @@ self.addEventListener('fetch', (event) => {
     const { request } = event;
     const url = new URL(request.url);
     
+    // Stream de eventos (SSE) nunca passa pelo cache
+    if (request.headers.get('Accept') === 'text/event-stream') {
+        return;
+    }
+    
     // Estratégia de cache para diferentes tipos de requisição
     if (request.method === 'GET') {
         // API calls - Network First
@@ -199,42 +204,78 @@ self.addEventListener('sync', (event) => {
     }
 });
 
+// Fila offline: operações enviadas em lote para /api/v1/sync
+const SYNC_URL = '/api/v1/sync';
+const SYNC_BATCH_SIZE = 50;
+
 // Função para sincronização em background
 async function performBackgroundSync() {
-    try {
-        // Sincronizar dados offline
-        const offlineData = await getOfflineData();
+    const itens = await getOfflineData();
+    
+    // Itens de versões antigas da fila, sem chave de idempotência, não podem
+    // ser reenviados com segurança: são descartados em vez de ficarem para sempre
+    for (const item of itens.filter((item) => !item.chave)) {
+        await removeOfflineData(item.id);
+    }
+    const queue = itens.filter((item) => item.chave);
+    
+    for (let i = 0; i < queue.length; i += SYNC_BATCH_SIZE) {
+        const batch = queue.slice(i, i + SYNC_BATCH_SIZE);
         
-        for (const data of offlineData) {
-            try {
-                await fetch(data.url, {
-                    method: data.method,
-                    headers: data.headers,
-                    body: data.body
-                });
-                
-                // Remover do cache offline após sucesso
-                await removeOfflineData(data.id);
-            } catch (error) {
-                console.error('Erro na sincronização:', error);
+        // A falha de rede rejeita a promise e o navegador reagenda o sync;
+        // as chaves de idempotência tornam o reenvio seguro
+        const response = await fetch(SYNC_URL, {
+            method: 'POST',
+            credentials: 'same-origin',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify({
+                operacoes: batch.map(({ chave, tipo, dados }) => ({ chave, tipo, dados }))
+            })
+        });
+        
+        if (!response.ok) {
+            throw new Error(`Sincronização falhou: ${response.status}`);
+        }
+        
+        const { resultados } = await response.json();
+        for (const [index, resultado] of resultados.entries()) {
+            // Erros 4xx são definitivos (e o servidor os repete para a mesma chave)
+            if (resultado.status < 500) {
+                await removeOfflineData(batch[index].id);
             }
         }
-    } catch (error) {
-        console.error('Erro na sincronização em background:', error);
+        
+        const clientList = await self.clients.matchAll();
+        clientList.forEach((client) => client.postMessage({ type: 'SYNC_RESULTS', resultados }));
     }
 }
 
-// Armazenar dados offline
-async function storeOfflineData(data) {
+function idbRequest(request) {
+    return new Promise((resolve, reject) => {
+        request.onsuccess = () => resolve(request.result);
+        request.onerror = () => reject(request.error);
+    });
+}
+
+// Armazenar operação offline (tipo: registro, pendencia_status, notificacao_lida)
+async function storeOfflineData(operacao) {
+    const chave = operacao.chave || self.crypto.randomUUID();
     const db = await openOfflineDB();
     const transaction = db.transaction(['offlineData'], 'readwrite');
     const store = transaction.objectStore('offlineData');
     
-    await store.add({
-        id: Date.now(),
-        timestamp: new Date(),
-        ...data
-    });
+    await idbRequest(store.put({
+        id: chave,
+        chave,
+        tipo: operacao.tipo,
+        dados: operacao.dados,
+        timestamp: new Date()
+    }));
+    
+    if (self.registration.sync) {
+        await self.registration.sync.register('background-sync');
+    }
+    return chave;
 }
 
 // Obter dados offline
@@ -243,7 +284,7 @@ async function getOfflineData() {
     const transaction = db.transaction(['offlineData'], 'readonly');
     const store = transaction.objectStore('offlineData');
     
-    return await store.getAll();
+    return idbRequest(store.index('timestamp').getAll());
 }
 
 // Remover dados offline
@@ -252,7 +293,7 @@ async function removeOfflineData(id) {
     const transaction = db.transaction(['offlineData'], 'readwrite');
     const store = transaction.objectStore('offlineData');
     
-    await store.delete(id);
+    await idbRequest(store.delete(id));
 }
 
 // Abrir banco de dados offline
@@ -330,4 +371,16 @@ self.addEventListener('message', (event) => {
     if (event.data && event.data.type === 'GET_VERSION') {
         event.ports[0].postMessage({ version: CACHE_NAME });
     }
+    
+    // Enviada por FilaOffline (static/js/app.js) quando uma escrita falha sem rede;
+    // a chave gravada volta pela porta, se o cliente mandou uma
+    if (event.data && event.data.type === 'QUEUE_OPERATION') {
+        event.waitUntil(
+            storeOfflineData(event.data.operacao).then((chave) => {
+                if (event.ports[0]) {
+                    event.ports[0].postMessage({ chave });
+                }
+            })
+        );
+    }
 }); 
\ No newline at end of file
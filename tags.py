@@ -0,0 +1,217 @@
+from sqlalchemy import event, select, func, inspect
+from sqlalchemy.dialects import postgresql
+from bisect import bisect_left
+from datetime import datetime
+import threading
+import time
+from app import db
+from busca import normalizar
+from cache import ResponseCache
+from models import Registro, Plantao, Tag, RegistroTag
+
+TAMANHO_TAG = 50
+
+def chave_tag(nome):
+    """Forma normalizada usada para unificar 'UTI', 'uti' e 'Úti'"""
+    return normalizar(nome.strip())[:TAMANHO_TAG]
+
+def _garantir_tags(connection, nomes):
+    """({chave: tag_id}, houve tag nova) para os nomes, criando as tags que faltam"""
+    por_chave = {}
+    for nome in nomes:
+        chave = chave_tag(nome)
+        if chave:
+            por_chave.setdefault(chave, nome.strip()[:TAMANHO_TAG])
+    if not por_chave:
+        return {}, False
+    
+    tabela = Tag.__table__
+    consulta = select(tabela.c.chave, tabela.c.id).where(tabela.c.chave.in_(por_chave))
+    ids = dict(connection.execute(consulta).all())
+    faltantes = [
+        {'chave': chave, 'nome': nome, 'criada_em': datetime.utcnow()}
+        for chave, nome in por_chave.items() if chave not in ids
+    ]
+    if faltantes:
+        # Outra transação pode criar a mesma tag ao mesmo tempo: a unique em
+        # `chave` descarta a duplicata e a leitura abaixo pega o id vencedor
+        if connection.dialect.name == 'postgresql':
+            insercao = postgresql.insert(tabela).on_conflict_do_nothing(index_elements=[tabela.c.chave])
+        else:
+            insercao = (
+                tabela.insert().prefix_with('IGNORE', dialect='mysql')
+                .prefix_with('OR IGNORE', dialect='sqlite')
+            )
+        # Leitura com trava (FOR SHARE): no REPEATABLE READ uma leitura comum
+        # ficaria no snapshot e não veria a tag confirmada pela outra transação.
+        # Se essa transação desfez a inserção, a tag ainda falta: insere de novo
+        for _ in range(2):
+            connection.execute(insercao, [linha for linha in faltantes if linha['chave'] not in ids])
+            ids = dict(connection.execute(consulta.with_for_update(read=True)).all())
+            if len(ids) == len(por_chave):
+                break
+        else:
+            raise RuntimeError(f'Tags não gravadas: {sorted(set(por_chave) - set(ids))}')
+    return ids, bool(faltantes)
+
+def indexar_tags(connection, registro_ids):
+    """Reescreve as associações registro-tag dos registros (na transação da conexão)
+    
+    Retorna True se alguma tag nova entrou no dicionário.
+    """
+    if not registro_ids:
+        return False
+    
+    tabela = RegistroTag.__table__
+    connection.execute(tabela.delete().where(tabela.c.registro_id.in_(registro_ids)))
+    
+    registros = Registro.__table__
+    linhas = connection.execute(
+        select(registros.c.id, registros.c.tags, registros.c.criado_em, Plantao.__table__.c.posto_id)
+        .join(Plantao.__table__, Plantao.__table__.c.id == registros.c.plantao_id)
+        .where(registros.c.id.in_(registro_ids))
+    ).all()
+    
+    ids, novas = _garantir_tags(connection, [tag for linha in linhas for tag in (linha.tags or [])])
+    associacoes = []
+    for linha in linhas:
+        tag_ids = {ids[chave] for chave in map(chave_tag, linha.tags or []) if chave in ids}
+        associacoes.extend({
+            'tag_id': tag_id,
+            'registro_id': linha.id,
+            'posto_id': linha.posto_id,
+            'criado_em': linha.criado_em
+        } for tag_id in tag_ids)
+    if associacoes:
+        connection.execute(tabela.insert(), associacoes)
+    return novas
+
+def registrar_indice_tags(session):
+    """Mantém registro_tags atualizada na mesma transação das gravações de registros
+    
+    Cobre novo_registro, editar_registro e a API (inclusive /registros/bulk),
+    já que todos gravam Registro pela sessão. Tags novas incrementam a
+    geração 'tags' após o commit, recarregando o autocompletar dos workers.
+    """
+    campos_monitorados = ('tags', 'plantao_id', 'criado_em')
+    info_key = 'tags_novas'
+    
+    @event.listens_for(session, 'after_flush')
+    def after_flush(session, flush_context):
+        alterados = [obj.id for obj in session.new if isinstance(obj, Registro)]
+        for obj in session.dirty:
+            if not isinstance(obj, Registro):
+                continue
+            estado = inspect(obj)
+            if any(estado.attrs[campo].history.has_changes() for campo in campos_monitorados):
+                alterados.append(obj.id)
+        
+        removidos = [obj.id for obj in session.deleted if isinstance(obj, Registro)]
+        
+        connection = session.connection()
+        if indexar_tags(connection, alterados):
+            session.info[info_key] = True
+        if removidos:
+            tabela = RegistroTag.__table__
+            connection.execute(tabela.delete().where(tabela.c.registro_id.in_(removidos)))
+    
+    @event.listens_for(session, 'after_commit')
+    def after_commit(session):
+        if session.info.pop(info_key, False):
+            ResponseCache.bump('tags')
+    
+    @event.listens_for(session, 'after_rollback')
+    def after_rollback(session):
+        session.info.pop(info_key, None)
+
+def registros_com_tag(nome):
+    """Condição SQL 'Registro possui a tag' resolvida pelo índice de registro_tags"""
+    return Registro.id.in_(
+        select(RegistroTag.registro_id)
+        .join(Tag, Tag.id == RegistroTag.tag_id)
+        .where(Tag.chave == chave_tag(nome))
+    )
+
+def facetas_tags(posto_id=None, de=None, ate=None, limite=20):
+    """[(nome, quantidade)] das tags mais usadas no período/posto"""
+    quantidade = func.count().label('quantidade')
+    consulta = select(RegistroTag.tag_id, quantidade).group_by(RegistroTag.tag_id)
+    if posto_id is not None:
+        consulta = consulta.where(RegistroTag.posto_id == posto_id)
+    if de:
+        consulta = consulta.where(RegistroTag.criado_em >= de)
+    if ate:
+        consulta = consulta.where(RegistroTag.criado_em < ate)
+    contagens = consulta.order_by(quantidade.desc()).limit(limite).subquery()
+    
+    return [tuple(linha) for linha in db.session.execute(
+        select(Tag.nome, contagens.c.quantidade)
+        .join(contagens, contagens.c.tag_id == Tag.id)
+        .order_by(contagens.c.quantidade.desc(), Tag.chave)
+    )]
+
+def reindexar_tags(lote=500):
+    """Reconstrói registro_tags em lotes a partir de Registro.tags"""
+    ultimo_id = 0
+    total = 0
+    while True:
+        ids = db.session.execute(
+            select(Registro.id).where(Registro.id > ultimo_id).order_by(Registro.id).limit(lote)
+        ).scalars().all()
+        if not ids:
+            break
+        indexar_tags(db.session.connection(), ids)
+        db.session.commit()
+        total += len(ids)
+        ultimo_id = ids[-1]
+    ResponseCache.bump('tags')
+    return total
+
+class AutocompleteTags:
+    """Lista ordenada de tags em memória (por worker) para autocompletar por prefixo
+    
+    A lista é recarregada quando a geração 'tags' do ResponseCache muda (uma
+    tag nova foi criada em qualquer worker) ou, sem Redis, após `TIMEOUT`.
+    """
+    
+    TIMEOUT = 300
+    
+    def __init__(self):
+        self._tags = ([], [])  # (chaves, nomes) trocadas juntas na recarga
+        self._versao = None
+        self._carregada_em = 0
+        self._lock = threading.Lock()
+    
+    def _atualizar(self):
+        versao = ResponseCache.generation('tags')
+        if versao == self._versao and time.monotonic() - self._carregada_em < self.TIMEOUT:
+            return
+        
+        with self._lock:
+            if versao == self._versao and time.monotonic() - self._carregada_em < self.TIMEOUT:
+                return
+            linhas = db.session.execute(select(Tag.chave, Tag.nome).order_by(Tag.chave)).all()
+            self._tags = ([chave for chave, _ in linhas], [nome for _, nome in linhas])
+            self._versao = versao
+            self._carregada_em = time.monotonic()
+    
+    def sugerir(self, prefixo, limite=10):
+        """Nomes das tags cuja chave começa com o prefixo (ordem alfabética)"""
+        prefixo = chave_tag(prefixo)
+        if not prefixo:
+            return []
+        
+        self._atualizar()
+        chaves, nomes = self._tags
+        sugestoes = []
+        indice = bisect_left(chaves, prefixo)
+        while indice < len(chaves) and len(sugestoes) < limite and chaves[indice].startswith(prefixo):
+            sugestoes.append(nomes[indice])
+            indice += 1
+        return sugestoes
+    
+    def clear(self):
+        with self._lock:
+            self._versao = None
+
+autocomplete_tags = AutocompleteTags()
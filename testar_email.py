@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+"""
+Mede o envio de emails do despachante contra um servidor SMTP local (sink)
+
+Uso: python testar_email.py [--mensagens 500] [--latencia 0.002]
+"""
+
+import argparse
+import asyncio
+import socketserver
+import threading
+import time
+from canais import CanalSMTP
+from envio import agrupar_resumos, _enviar_todas
+
+class SinkSMTP(socketserver.ThreadingTCPServer):
+    """Servidor SMTP mínimo que aceita e descarta as mensagens, contando-as"""
+    
+    daemon_threads = True
+    allow_reuse_address = True
+    
+    def __init__(self, endereco, latencia=0):
+        super().__init__(endereco, SessaoSMTP)
+        self.latencia = latencia  # Atraso simulado por comando, como um servidor remoto
+        self.mensagens = 0
+        self.conexoes = 0
+        self._lock = threading.Lock()
+
+class SessaoSMTP(socketserver.StreamRequestHandler):
+    def responder(self, linha):
+        time.sleep(self.server.latencia)
+        self.wfile.write(linha.encode() + b'\r\n')
+    
+    def handle(self):
+        with self.server._lock:
+            self.server.conexoes += 1
+        self.responder('220 sink ESMTP')
+        for linha in self.rfile:
+            comando = linha.decode(errors='replace').strip().upper()
+            if comando.startswith('EHLO'):
+                self.wfile.write(b'250-sink\r\n')
+                self.responder('250 PIPELINING')
+            elif comando == 'DATA':
+                self.responder('354 fim com <CRLF>.<CRLF>')
+                for corpo in self.rfile:
+                    if corpo in (b'.\r\n', b'.\n'):
+                        break
+                with self.server._lock:
+                    self.server.mensagens += 1
+                self.responder('250 OK')
+            elif comando == 'QUIT':
+                self.responder('221 tchau')
+                return
+            else:
+                self.responder('250 OK')
+
+def medir(canal, notificacoes, resumo=False):
+    envios = agrupar_resumos(notificacoes) if resumo else [{**n, 'notificacoes': [n]} for n in notificacoes]
+    inicio = time.monotonic()
+    resultados = asyncio.run(_enviar_todas(envios, {'email': canal}))
+    duracao = time.monotonic() - inicio
+    falhas = [erro for _, erro in resultados if erro is not None]
+    return len(envios), duracao, falhas
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--mensagens', type=int, default=500)
+    parser.add_argument('--destinatarios', type=int, default=20)
+    parser.add_argument('--latencia', type=float, default=0.002)
+    args = parser.parse_args()
+    
+    sink = SinkSMTP(('127.0.0.1', 0), latencia=args.latencia)
+    threading.Thread(target=sink.serve_forever, daemon=True).start()
+    porta = sink.server_address[1]
+    
+    notificacoes = [{
+        'id': i,
+        'tipo': 'email',
+        'destino': f'usuario{i % args.destinatarios}@exemplo.com',
+        'payload': {'assunto': f'Alerta {i}', 'mensagem': 'Pendência crítica vence em 10 minutos'},
+        'tentativas': 0
+    } for i in range(args.mensagens)]
+    
+    # Sem pool: uma conexão nova por mensagem, como na integração ingênua
+    class CanalSemPool(CanalSMTP):
+        def _devolver(self, conexao):
+            self._descartar(conexao)
+    
+    for nome, canal, resumo in (
+        ('conexão por mensagem', CanalSemPool('127.0.0.1', porta), False),
+        ('pool de conexões', CanalSMTP('127.0.0.1', porta), False),
+        ('pool + resumo', CanalSMTP('127.0.0.1', porta), True)
+    ):
+        sink.mensagens = sink.conexoes = 0
+        enviadas, duracao, falhas = medir(canal, notificacoes, resumo)
+        canal.encerrar()
+        print(f"✓ {nome}: {enviadas} mensagens em {duracao:.2f}s "
+              f"({enviadas / duracao:.0f} msg/s, {args.mensagens / duracao:.0f} notificações/s), "
+              f"{sink.conexoes} conexões, {len(falhas)} falhas")
+    
+    sink.shutdown()
+
+if __name__ == '__main__':
+    main()
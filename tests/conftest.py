@@ -0,0 +1,114 @@
+# Configuração compartilhada dos testes: SQLite em arquivo temporário e Redis simulado
+import os
+import tempfile
+from types import SimpleNamespace
+
+import pytest
+
+# Antes de importar app: o banco é escolhido na importação
+os.environ.setdefault('DATABASE_URL', 'sqlite:///' + os.path.join(tempfile.mkdtemp(prefix='passometro_testes_'), 'testes.db'))
+
+from datetime import datetime
+from app import app as aplicacao, db
+from cache import cache
+from models import Usuario, Unidade, PostoTrabalho, Plantao, Registro
+
+@pytest.fixture
+def app(tmp_path):
+    """Aplicação com banco recriado a cada teste e diretórios temporários"""
+    aplicacao.config.update(
+        TESTING=True,
+        WTF_CSRF_ENABLED=False,
+        AUDITORIA_ARQUIVO_DIR=str(tmp_path / 'arquivo_auditoria'),
+        BACKUP_DIR=str(tmp_path / 'backups')
+    )
+    
+    with aplicacao.app_context():
+        db.drop_all()
+        db.create_all()
+        yield aplicacao
+        db.session.remove()
+        db.drop_all()
+        # Conexões do pool podem guardar o esquema antigo (ver backups.py)
+        db.engine.dispose()
+
+@pytest.fixture
+def client(app):
+    """Cliente de teste"""
+    return app.test_client()
+
+@pytest.fixture(autouse=True)
+def redis_simulado(monkeypatch):
+    """Nunca usa um Redis real: fakeredis quando instalado, senão o modo sem Redis"""
+    try:
+        import fakeredis
+    except ImportError:
+        monkeypatch.setattr(cache, 'redis_client', None)
+        return None
+    
+    cliente = fakeredis.FakeRedis(decode_responses=True)
+    monkeypatch.setattr(cache, 'redis_client', cliente)
+    return cliente
+
+@pytest.fixture
+def redis(redis_simulado):
+    """Para testes que dependem do Redis (pulados sem fakeredis)"""
+    if redis_simulado is None:
+        pytest.skip('fakeredis não instalado')
+    return redis_simulado
+
+@pytest.fixture
+def celery_sincrono():
+    """Tarefas do Celery executadas na hora, sem broker"""
+    from celery_app import celery
+    
+    chaves = ('task_always_eager', 'task_eager_propagates', 'broker_url', 'result_backend')
+    anterior = {chave: celery.conf.get(chave) for chave in chaves}
+    celery.conf.update(
+        task_always_eager=True,
+        task_eager_propagates=True,
+        broker_url='memory://',
+        result_backend='cache+memory://'
+    )
+    yield celery
+    celery.conf.update(anterior)
+
+@pytest.fixture
+def dados(app):
+    """Gestor, médico, posto e um plantão aberto do gestor"""
+    gestor = Usuario(nome='Gestor Teste', email='gestor@exemplo.com', perfis=['gestor', 'supervisor'])
+    gestor.set_senha('123456')
+    medico = Usuario(nome='Médico Teste', email='medico@exemplo.com', perfis=['medico'])
+    medico.set_senha('123456')
+    unidade = Unidade(nome='UTI Teste', tipo='UTI')
+    db.session.add_all([gestor, medico, unidade])
+    db.session.commit()
+    
+    posto = PostoTrabalho(nome='Posto Teste', unidade_id=unidade.id, perfil_minimo='medico')
+    db.session.add(posto)
+    db.session.commit()
+    
+    plantao = Plantao(posto_id=posto.id, usuario_id=gestor.id, data_inicio=datetime.utcnow(), status='aberto')
+    db.session.add(plantao)
+    db.session.commit()
+    
+    return SimpleNamespace(gestor_id=gestor.id, medico_id=medico.id, posto_id=posto.id, plantao_id=plantao.id)
+
+@pytest.fixture
+def criar_registro(dados):
+    """Fábrica de registros no plantão de `dados`"""
+    def criar(**campos):
+        valores = dict(plantao_id=dados.plantao_id, tipo='evento', categoria='clinico', titulo='Registro',
+                       descricao_rica='Descrição', criado_por=dados.gestor_id)
+        valores.update(campos)
+        registro = Registro(**valores)
+        db.session.add(registro)
+        db.session.commit()
+        return registro
+    return criar
+
+@pytest.fixture
+def cliente_gestor(client, dados):
+    """Cliente com a sessão do gestor de `dados`"""
+    client.post('/login', data={'email': 'gestor@exemplo.com', 'senha': '123456'})
+    return client
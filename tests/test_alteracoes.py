@@ -0,0 +1,68 @@
+from datetime import datetime, timedelta
+from app import db
+from models import Usuario, Registro, LogAlteracao, Configuracao
+import alteracoes
+
+def entradas():
+    return [(entrada.entidade, entrada.operacao) for entrada in LogAlteracao.query.order_by(LogAlteracao.id)]
+
+def gravar_entradas(*sequencias, idade=0):
+    criado_em = datetime.utcnow() - timedelta(seconds=idade)
+    db.session.execute(LogAlteracao.__table__.insert(), [
+        {'id': seq, 'entidade': 'pendencia', 'entidade_id': seq, 'operacao': 'criar', 'criado_em': criado_em}
+        for seq in sequencias
+    ])
+    db.session.commit()
+
+class TestLogAlteracoes:
+    """Testes da gravação do log de alterações"""
+    
+    def test_grava_na_transacao_da_alteracao(self, criar_registro, dados):
+        """Testa que as entradas confirmam e desfazem junto com a alteração"""
+        registro = criar_registro()
+        assert ('registro', 'criar') in entradas()
+        
+        registro.titulo = 'Desfeito'
+        db.session.flush()
+        assert entradas()[-1] == ('registro', 'atualizar')
+        db.session.rollback()
+        
+        assert ('registro', 'atualizar') not in entradas()
+        assert Configuracao.query.filter_by(chave='log_alteracoes_trava').count() == 0
+    
+    def test_alteracao_em_massa_pede_recarga(self, criar_registro):
+        """Testa a entrada 'recarregar' das alterações em massa"""
+        criar_registro()
+        Registro.query.update({'titulo': 'Em massa'}, synchronize_session=False)
+        db.session.commit()
+        
+        assert entradas()[-1] == ('registro', 'recarregar')
+
+class TestMarcaDagua:
+    """Testes da leitura do log com sequências ainda não confirmadas"""
+    
+    def test_lacuna_recente_segura_a_entrega(self, dados):
+        """Testa que a entrega para antes de uma sequência ausente recente"""
+        gestor = db.session.get(Usuario, dados.gestor_id)
+        LogAlteracao.query.delete()
+        gravar_entradas(1, 2, 4, 5)
+        
+        assert alteracoes.marca_dagua(0) == 3
+        assert [entrada.id for entrada in alteracoes.buscar_alteracoes(gestor, None, 0)] == [1, 2]
+        assert alteracoes.marca_dagua(2) == 3
+        assert alteracoes.buscar_alteracoes(gestor, None, 2) == []
+        
+        # A transação confirmou: a lacuna fecha
+        gravar_entradas(3)
+        assert alteracoes.marca_dagua(2) is None
+        assert [entrada.id for entrada in alteracoes.buscar_alteracoes(gestor, None, 2)] == [3, 4, 5]
+    
+    def test_lacuna_antiga_nao_segura(self, dados):
+        """Testa que lacunas além da janela (rollback, compactação) não seguram a entrega"""
+        gestor = db.session.get(Usuario, dados.gestor_id)
+        LogAlteracao.query.delete()
+        gravar_entradas(1, 4, idade=alteracoes.JANELA_CONFIRMACAO + 5)
+        gravar_entradas(5)
+        
+        assert alteracoes.marca_dagua(0) is None
+        assert [entrada.id for entrada in alteracoes.buscar_alteracoes(gestor, None, 0)] == [1, 4, 5]
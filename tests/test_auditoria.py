@@ -0,0 +1,318 @@
+import gzip
+import os
+import pytest
+from datetime import datetime, timedelta
+from sqlalchemy.exc import IntegrityError
+from app import db
+from models import Usuario, Plantao, Registro, Auditoria, CheckpointAuditoria, ArquivoAuditoria
+import arquivamento
+import auditoria
+import integridade
+
+def linhas_auditoria(registro_id):
+    return Auditoria.query.filter_by(objeto='registro', objeto_id=registro_id).order_by(Auditoria.id).all()
+
+@pytest.fixture
+def bloco_pequeno(monkeypatch):
+    """Checkpoints a cada 8 linhas, para formar blocos com poucos registros"""
+    monkeypatch.setattr(integridade, 'BLOCO', 8)
+    return 8
+
+class TestAuditoria:
+    """Testes da gravação da auditoria"""
+    
+    def test_criacao_e_edicao_auditadas(self, criar_registro, dados):
+        """Testa snapshot na criação e delta na edição, com autor"""
+        registro = criar_registro(titulo='Original')
+        registro.titulo = 'Editado'
+        db.session.commit()
+        
+        criacao, edicao = linhas_auditoria(registro.id)
+        assert (criacao.acao, criacao.versao, criacao.snapshot) == ('criar', 1, True)
+        assert criacao.depois['titulo'] == 'Original'
+        assert (edicao.acao, edicao.versao, edicao.snapshot) == ('editar', 2, False)
+        assert edicao.depois['titulo'] == 'Editado'
+        assert {criacao.autor_id, edicao.autor_id} == {dados.gestor_id}
+    
+    def test_tarefa_celery_auditada_como_sistema(self, criar_registro, celery_sincrono):
+        """Testa que tarefas em background gravam em nome de Usuario.sistema()"""
+        registro_id = criar_registro().id
+        
+        @celery_sincrono.task
+        def editar_registro(registro_id):
+            db.session.get(Registro, registro_id).titulo = 'Pela tarefa'
+            db.session.commit()
+        
+        editar_registro.delay(registro_id)
+        
+        db.session.expire_all()
+        edicao = linhas_auditoria(registro_id)[-1]
+        assert edicao.depois['titulo'] == 'Pela tarefa'
+        assert edicao.autor_id == Usuario.sistema().id
+        assert not Usuario.sistema().ativo
+    
+    def test_alteracao_sem_autor_falha(self, criar_registro, monkeypatch):
+        """Testa que nenhuma alteração é gravada sem autor na auditoria"""
+        registro = criar_registro()
+        monkeypatch.setattr(auditoria, '_autor', lambda session, obj: None)
+        
+        registro.titulo = 'Sem autor'
+        with pytest.raises(RuntimeError):
+            db.session.commit()
+        db.session.rollback()
+        
+        assert db.session.get(Registro, registro.id).titulo == 'Registro'
+        assert len(linhas_auditoria(registro.id)) == 1
+    
+    def test_versao_unica_por_objeto(self, criar_registro, dados):
+        """Testa que a mesma versão não pode ser gravada duas vezes"""
+        registro = criar_registro()
+        db.session.add(Auditoria(objeto='registro', objeto_id=registro.id, acao='editar',
+                                 versao=1, autor_id=dados.gestor_id))
+        with pytest.raises(IntegrityError):
+            db.session.commit()
+        db.session.rollback()
+    
+    def test_contador_acompanha_versoes(self, criar_registro):
+        """Testa que o contador da linha acompanha as versões e fica fora dos snapshots"""
+        registro = criar_registro()
+        for versao in range(2, 4):
+            registro.titulo = f'v{versao}'
+            db.session.commit()
+        
+        db.session.expire_all()
+        assert registro.versao_auditoria == 3
+        assert [linha.versao for linha in linhas_auditoria(registro.id)] == [1, 2, 3]
+        assert 'versao_auditoria' not in linhas_auditoria(registro.id)[0].depois
+    
+    def test_linha_anterior_ao_contador_continua_sequencia(self, criar_registro):
+        """Testa que linhas com contador 0 e histórico seguem da última versão auditada"""
+        registro = criar_registro(titulo='v1')
+        registro.titulo = 'v2'
+        db.session.commit()
+        db.session.execute(Registro.__table__.update().values(versao_auditoria=0))
+        db.session.commit()
+        
+        registro.titulo = 'v3'
+        db.session.commit()
+        registro.titulo = 'v4'
+        db.session.commit()
+        
+        assert [linha.versao for linha in linhas_auditoria(registro.id)] == [1, 2, 3, 4]
+        assert auditoria.reconstruir_versao('registro', registro.id)['titulo'] == 'v4'
+    
+    def test_reconstruir_versoes(self, criar_registro, monkeypatch):
+        """Testa a reconstrução do estado a partir de snapshots e deltas"""
+        monkeypatch.setattr(auditoria, 'SNAPSHOT_INTERVALO', 3)
+        registro = criar_registro(titulo='v1', descricao_rica='Texto ' * 100)
+        for versao in range(2, 6):
+            registro.titulo = f'v{versao}'
+            registro.descricao_rica = 'Texto ' * 100 + f'fim {versao}'
+            db.session.commit()
+        
+        linhas = linhas_auditoria(registro.id)
+        assert [linha.snapshot for linha in linhas] == [True, False, True, False, False]
+        for versao, linha in enumerate(linhas, 1):
+            estado = auditoria.reconstruir_versao('registro', registro.id, ate_id=linha.id)
+            assert estado['titulo'] == f'v{versao}'
+        
+        estados = auditoria.reconstruir_linhas([linhas[1], linhas[3], linhas[4]])
+        assert estados[linhas[1].id]['titulo'] == 'v2'
+        assert estados[linhas[3].id]['titulo'] == 'v4'
+        assert estados[linhas[4].id]['descricao_rica'] == 'Texto ' * 100 + 'fim 5'
+    
+    def test_reconstruir_depois_de_excluir(self, criar_registro):
+        """Testa que a exclusão mantém o último estado do objeto"""
+        registro = criar_registro(titulo='Original')
+        registro.titulo = 'Editado'
+        db.session.commit()
+        registro_id = registro.id
+        db.session.delete(registro)
+        db.session.commit()
+        
+        criacao, edicao, exclusao = linhas_auditoria(registro_id)
+        assert exclusao.acao == 'deletar'
+        assert exclusao.depois is None
+        assert Auditoria.query.filter(Auditoria.id == exclusao.id, Auditoria.depois.is_(None)).count() == 1
+        assert auditoria.reconstruir_versao('registro', registro_id)['titulo'] == 'Editado'
+        
+        estados = auditoria.reconstruir_linhas([criacao, exclusao])
+        assert estados[criacao.id]['titulo'] == 'Original'
+        assert estados[exclusao.id]['titulo'] == 'Editado'
+
+class TestIntegridade:
+    """Testes da cadeia de hashes e das provas Merkle"""
+    
+    def test_cadeia_integra(self, criar_registro, bloco_pequeno):
+        """Testa selagem e verificação sem problemas"""
+        # 15 registros e o plantão de `dados`
+        for i in range(15):
+            criar_registro(titulo=f'Registro {i}')
+        
+        assert integridade.selar_auditoria() == (16, 2)
+        resultado = integridade.verificar_integridade(processos=1)
+        
+        assert resultado == {'linhas': 16, 'blocos': 2, 'problemas': []}
+        assert integridade.selar_auditoria() == (0, 0)
+    
+    def test_adulteracao_detectada(self, criar_registro, bloco_pequeno):
+        """Testa que alterar uma linha selada quebra a cadeia"""
+        registros = [criar_registro(titulo=f'Registro {i}') for i in range(10)]
+        integridade.selar_auditoria()
+        
+        linha = linhas_auditoria(registros[2].id)[0]
+        db.session.execute(
+            Auditoria.__table__.update().where(Auditoria.id == linha.id).values(depois={'titulo': 'Forjado'})
+        )
+        db.session.commit()
+        
+        problemas = integridade.verificar_integridade(processos=1)['problemas']
+        assert any(f'linha {linha.id}' in problema for problema in problemas)
+        assert any('raiz Merkle' in problema for problema in problemas)
+    
+    def test_linha_removida_detectada(self, criar_registro, bloco_pequeno):
+        """Testa que remover uma linha selada da cauda é detectado"""
+        registros = [criar_registro(titulo=f'Registro {i}') for i in range(10)]
+        integridade.selar_auditoria()
+        
+        Auditoria.query.filter_by(objeto='registro', objeto_id=registros[-2].id).delete()
+        db.session.commit()
+        
+        problemas = integridade.verificar_integridade(processos=1)['problemas']
+        assert any('ausente' in problema for problema in problemas)
+    
+    def test_prova_inclusao(self, criar_registro, bloco_pequeno):
+        """Testa a prova de inclusão de cada linha de um bloco"""
+        registros = [criar_registro(titulo=f'Registro {i}') for i in range(10)]
+        integridade.selar_auditoria()
+        
+        for linha in Auditoria.query.filter(Auditoria.posicao <= bloco_pequeno):
+            prova = integridade.prova_inclusao(linha.id)
+            assert integridade.verificar_prova(prova['folha'], prova['caminho'], prova['raiz_merkle'])
+            assert not integridade.verificar_prova('00' * 32, prova['caminho'], prova['raiz_merkle'])
+        
+        # Cauda ainda sem checkpoint
+        assert integridade.prova_inclusao(linhas_auditoria(registros[-1].id)[0].id) is None
+    
+    def test_selagem_renova_trava(self, criar_registro, bloco_pequeno):
+        """Testa que a selagem chama `renovar` a cada lote e checkpoint confirmado"""
+        for i in range(15):
+            criar_registro(titulo=f'Registro {i}')
+        renovacoes = []
+        
+        assert integridade.selar_auditoria(renovar=lambda: renovacoes.append(True)) == (16, 2)
+        assert len(renovacoes) == 3
+    
+    def test_hash_resumo_ancorado_em_checkpoint(self, criar_registro, dados, bloco_pequeno):
+        """Testa que o hash do resumo continua verificável depois de novas selagens"""
+        registros = [criar_registro(titulo=f'Registro {i}') for i in range(7)]
+        integridade.selar_auditoria()
+        plantao = db.session.get(Plantao, dados.plantao_id)
+        plantao.status = 'encerrado'
+        plantao.data_fim = datetime.utcnow()
+        plantao.hash_resumo = integridade.hash_resumo_plantao(plantao)
+        db.session.commit()
+        
+        # A cadeia continua depois do encerramento
+        outro = Plantao(posto_id=dados.posto_id, usuario_id=dados.medico_id, data_inicio=datetime.utcnow())
+        db.session.add(outro)
+        db.session.commit()
+        for i in range(8):
+            criar_registro(plantao_id=outro.id, titulo=f'Outro {i}')
+        integridade.selar_auditoria()
+        
+        assert CheckpointAuditoria.query.count() == 2
+        assert integridade.verificar_resumo_plantao(plantao)
+        
+        registros[0].titulo = 'Alterado depois do encerramento'
+        db.session.commit()
+        assert not integridade.verificar_resumo_plantao(plantao)
+
+class TestArquivamento:
+    """Testes do arquivamento da auditoria antiga"""
+    
+    def criar_auditoria_antiga(self, criar_registro, quantidade):
+        registros = [criar_registro(titulo=f'Registro {i}') for i in range(quantidade)]
+        db.session.execute(
+            Auditoria.__table__.update().values(timestamp=datetime.utcnow() - timedelta(days=120))
+        )
+        db.session.commit()
+        integridade.selar_auditoria()
+        return registros
+    
+    def test_arquivar_e_verificar(self, app, criar_registro, bloco_pequeno):
+        """Testa que blocos arquivados saem do banco e continuam verificáveis"""
+        registros = self.criar_auditoria_antiga(criar_registro, 19)
+        
+        assert arquivamento.arquivar_auditoria(dias=90, pausa=0) == (2, 16)
+        assert Auditoria.query.count() == 4
+        
+        for arquivo in ArquivoAuditoria.query:
+            assert arquivamento.verificar_arquivo(arquivo, db.session.get(CheckpointAuditoria, arquivo.checkpoint_id))
+        assert integridade.verificar_integridade(processos=1) == {'linhas': 20, 'blocos': 2, 'problemas': []}
+        
+        # Prova de inclusão e reconstrução a partir do arquivo
+        arquivada = arquivamento.consultar_auditoria('registro', registros[0].id)
+        assert len(arquivada) == 1
+        prova = integridade.prova_inclusao(arquivada[0].id)
+        assert integridade.verificar_prova(prova['folha'], prova['caminho'], prova['raiz_merkle'])
+        assert auditoria.reconstruir_versao('registro', registros[0].id)['titulo'] == 'Registro 0'
+    
+    def test_consulta_le_so_arquivos_do_objeto(self, app, criar_registro, bloco_pequeno, monkeypatch):
+        """Testa que a consulta por objeto só abre os arquivos que o contêm"""
+        registros = self.criar_auditoria_antiga(criar_registro, 19)
+        arquivamento.arquivar_auditoria(dias=90, pausa=0)
+        
+        lidos = []
+        linhas_arquivo = arquivamento.linhas_arquivo
+        monkeypatch.setattr(arquivamento, 'linhas_arquivo', lambda caminho: lidos.append(caminho) or linhas_arquivo(caminho))
+        
+        assert [linha.objeto_id for linha in arquivamento.consultar_auditoria('registro', registros[0].id)] == [registros[0].id]
+        assert len(lidos) == 1
+        assert arquivamento.consultar_auditoria('registro', registros[-1].id)[0].acao == 'criar'
+    
+    def test_consulta_ordena_banco_e_arquivo_por_id(self, app, criar_registro, bloco_pequeno):
+        """Testa a ordem por id quando o arquivo tem ids maiores que linhas no banco"""
+        for i in range(16):
+            criar_registro(titulo=f'Registro {i}')
+        # A linha 2 só aparece depois dos dois blocos selados, como num commit tardio
+        tabela = Auditoria.__table__
+        tardia = db.session.execute(tabela.select().where(tabela.c.id == 2)).mappings().one()
+        db.session.execute(tabela.delete().where(tabela.c.id == 2))
+        db.session.execute(tabela.update().values(timestamp=datetime.utcnow() - timedelta(days=120)))
+        db.session.commit()
+        integridade.selar_auditoria()
+        db.session.execute(tabela.insert().values(**tardia))
+        db.session.commit()
+        for i in range(3):
+            criar_registro(titulo=f'Recente {i}')
+        integridade.selar_auditoria()
+        
+        assert arquivamento.arquivar_auditoria(dias=90, pausa=0) == (2, 16)
+        assert [linha.id for linha in arquivamento.consultar_auditoria(limite=4)] == [20, 19, 18, 17]
+        assert [linha.id for linha in arquivamento.consultar_auditoria(limite=None)] == list(range(20, 0, -1))
+    
+    def test_arquivo_corrompido_detectado(self, app, criar_registro, bloco_pequeno):
+        """Testa que um arquivo adulterado não passa na verificação"""
+        self.criar_auditoria_antiga(criar_registro, 7)
+        arquivamento.arquivar_auditoria(dias=90, pausa=0)
+        arquivo = ArquivoAuditoria.query.one()
+        caminho = os.path.join(app.config['AUDITORIA_ARQUIVO_DIR'], arquivo.caminho)
+        
+        with gzip.open(caminho, 'rt', encoding='utf-8') as origem:
+            conteudo = origem.read()
+        with gzip.open(caminho, 'wt', encoding='utf-8') as destino:
+            destino.write(conteudo.replace('Registro 3', 'Registro X'))
+        
+        assert not arquivamento.verificar_arquivo(arquivo, db.session.get(CheckpointAuditoria, arquivo.checkpoint_id))
+        problemas = integridade.verificar_integridade(processos=1)['problemas']
+        assert any('raiz Merkle' in problema for problema in problemas)
+    
+    def test_auditoria_recente_nao_arquivada(self, app, criar_registro, bloco_pequeno):
+        """Testa que blocos com linhas recentes ficam no banco"""
+        for i in range(7):
+            criar_registro(titulo=f'Registro {i}')
+        integridade.selar_auditoria()
+        
+        assert arquivamento.arquivar_auditoria(dias=90, pausa=0) == (0, 0)
+        assert Auditoria.query.count() == 8
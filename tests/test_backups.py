@@ -0,0 +1,156 @@
+import io
+import os
+import tarfile
+import pytest
+from datetime import datetime, timedelta
+from sqlalchemy import select
+from app import db
+from models import Backup, Restauracao, Configuracao, Registro
+import backups
+import manutencao
+import retencao
+
+def conteudo_tabelas():
+    """{tabela: linhas ordenadas} das tabelas que entram no backup
+    
+    O modo manutenção não vem do backup (a restauração mantém o atual).
+    """
+    return {
+        tabela.name: [
+            linha for linha in db.session.execute(select(tabela).order_by(*tabela.primary_key.columns))
+            if tabela is not Configuracao.__table__ or linha.chave != manutencao.CHAVE
+        ]
+        for tabela in backups.tabelas_backup()
+    }
+
+def gerar_backup(**campos):
+    backup = Backup(**campos)
+    db.session.add(backup)
+    db.session.commit()
+    return backups.executar_backup(backup.id, lote=3)
+
+class TestBackup:
+    """Testes do backup lógico"""
+    
+    def test_gerar_e_verificar(self, criar_registro):
+        """Testa o backup concluído, com manifesto e blocos conferidos"""
+        for i in range(7):
+            criar_registro(titulo=f'Registro {i}')
+        
+        backup = gerar_backup(automatico=True)
+        caminho = backups.caminho_backup(backup)
+        
+        assert backup.status == 'concluido'
+        assert os.path.basename(backup.arquivo).startswith('backup_auto_')
+        assert os.path.exists(caminho + '.sha256')
+        manifesto = backups.verificar_backup(caminho)
+        registros = next(esquema for esquema in manifesto['tabelas'] if esquema['nome'] == 'registros')
+        assert registros['linhas'] == 7
+        assert len(registros['blocos']) == 3
+        assert 'backups' not in {esquema['nome'] for esquema in manifesto['tabelas']}
+    
+    def test_bloco_corrompido_detectado(self, app, criar_registro, tmp_path):
+        """Testa que um bloco alterado invalida o backup"""
+        criar_registro()
+        caminho = backups.caminho_backup(gerar_backup())
+        
+        adulterado = tmp_path / 'adulterado.tar'
+        with tarfile.open(caminho) as origem, tarfile.open(adulterado, 'w') as destino:
+            for membro in origem:
+                dados = origem.extractfile(membro).read()
+                if membro.name.startswith('tabelas/registros/'):
+                    dados = dados[:-1] + bytes([dados[-1] ^ 1])
+                destino.addfile(membro, io.BytesIO(dados))
+        
+        with pytest.raises(ValueError, match='corrompido'):
+            backups.verificar_backup(str(adulterado))
+
+class TestRestauracao:
+    """Testes da restauração de backups"""
+    
+    def test_restaurar_volta_ao_estado_do_backup(self, criar_registro):
+        """Testa a ida e volta backup -> alterações -> restauração"""
+        registros = [criar_registro(titulo=f'Registro {i}') for i in range(7)]
+        Configuracao.set_valor('politica_retencao', {'temp': None}, 'json')
+        antes = conteudo_tabelas()
+        caminho = backups.caminho_backup(gerar_backup())
+        
+        registros[0].titulo = 'Alterado depois do backup'
+        db.session.delete(registros[1])
+        criar_registro(titulo='Criado depois do backup')
+        
+        resultado = backups.restaurar_dados(caminho, processos=1)
+        
+        assert resultado['tabelas'] == len(antes)
+        assert conteudo_tabelas() == antes
+        assert Configuracao.get_valor('politica_retencao') == {'temp': None}
+        # Sequências continuam depois dos ids restaurados
+        novo = criar_registro(titulo='Após restaurar')
+        assert novo.id > max(registro.id for registro in Registro.query.filter(Registro.id != novo.id))
+    
+    def test_backup_invalido_nao_altera_dados(self, criar_registro, tmp_path):
+        """Testa que um backup corrompido é recusado antes de tocar no banco"""
+        criar_registro()
+        antes = conteudo_tabelas()
+        invalido = tmp_path / 'invalido.tar'
+        invalido.write_bytes(b'nao e um tar')
+        
+        with pytest.raises(tarfile.TarError):
+            backups.restaurar_dados(str(invalido), processos=1)
+        
+        assert conteudo_tabelas() == antes
+    
+    def test_restaurar_pela_interface(self, app, cliente_gestor, criar_registro, celery_sincrono):
+        """Testa a rota de restauração com a tarefa do Celery"""
+        registro = criar_registro(titulo='Original')
+        registro_id = registro.id
+        caminho = backups.caminho_backup(gerar_backup())
+        registro.titulo = 'Alterado'
+        db.session.commit()
+        
+        with open(caminho, 'rb') as arquivo:
+            resposta = cliente_gestor.post('/backup/restaurar', data={
+                'backup_file': (io.BytesIO(arquivo.read()), 'backup.tar')
+            }, content_type='multipart/form-data')
+        
+        assert resposta.status_code == 202
+        db.session.remove()
+        restauracao = Restauracao.query.one()
+        assert restauracao.status == 'concluido'
+        assert db.session.get(Registro, registro_id).titulo == 'Original'
+        assert not os.path.exists(os.path.join(backups.diretorio_backups(), restauracao.arquivo))
+
+class TestRetencao:
+    """Testes da retenção de backups"""
+    
+    def test_remove_backups_excedentes_e_antigos(self, app, criar_registro):
+        """Testa a política de retenção aplicada aos backups"""
+        criar_registro()
+        antigo, intermediario, recente = gerar_backup(), gerar_backup(), gerar_backup()
+        falha = Backup(status='falha', criado_em=datetime.utcnow() - timedelta(days=200))
+        db.session.add(falha)
+        db.session.commit()
+        arquivos = {backup.id: backups.caminho_backup(backup) for backup in (antigo, intermediario, recente)}
+        # Diretórios de trabalho fora do teste
+        Configuracao.set_valor(retencao.CHAVE_CONFIGURACAO, {
+            'backups': {'dias': 90, 'max_arquivos': 2},
+            'relatorios_gerados': None,
+            'temp': None
+        }, 'json')
+        
+        resultado = retencao.aplicar_retencao(pausa=0)
+        
+        assert resultado['backups']['arquivos'] == 2
+        assert [backup.id for backup in Backup.query.order_by(Backup.id)] == [intermediario.id, recente.id]
+        assert not os.path.exists(arquivos[antigo.id])
+        assert not os.path.exists(arquivos[antigo.id] + '.sha256')
+        assert os.path.exists(arquivos[recente.id])
+    
+    def test_manter_ultimos_automaticos(self, app, criar_registro):
+        """Testa que só os backups automáticos mais recentes ficam"""
+        criar_registro()
+        automaticos = [gerar_backup(automatico=True) for _ in range(3)]
+        manual = gerar_backup()
+        
+        assert backups.manter_ultimos_automaticos(2) == 1
+        assert {backup.id for backup in Backup.query} == {automaticos[1].id, automaticos[2].id, manual.id}
@@ -0,0 +1,60 @@
+import pytest
+from app import db
+from models import Registro
+import manutencao
+
+NOVO_REGISTRO = {'tipo': 'evento', 'categoria': 'clinico', 'titulo': 'Pelo batch', 'descricao_rica': 'Descrição'}
+
+@pytest.fixture
+def token(client, dados):
+    resposta = client.post('/api/v1/auth/login', json={'email': 'gestor@exemplo.com', 'senha': '123456'})
+    return resposta.get_json()['token']
+
+def batch(client, token, *itens, **cabecalhos):
+    resposta = client.post('/api/v1/batch', json={'requests': list(itens)},
+                           headers={'Authorization': f'Bearer {token}', **cabecalhos})
+    assert resposta.status_code == 200
+    return resposta.get_json()['responses']
+
+class TestBatch:
+    """Testes das sub-requisições do /batch"""
+    
+    def test_manutencao_recusa_so_escritas(self, client, token):
+        """Testa que o modo manutenção vale para cada sub-requisição"""
+        manutencao.definir_manutencao(True)
+        
+        leitura, escrita = batch(client, token,
+                                 {'method': 'GET', 'path': '/notificacoes'},
+                                 {'method': 'POST', 'path': '/registros', 'body': NOVO_REGISTRO})
+        
+        assert leitura['status'] == 200
+        assert escrita['status'] == 503
+        assert escrita['headers']['Retry-After'] == '60'
+        assert Registro.query.count() == 0
+    
+    def test_idempotency_key_da_sub_requisicao(self, client, token):
+        """Testa que a repetição de um item com a mesma chave não cria de novo"""
+        item = {'method': 'POST', 'path': '/registros', 'body': NOVO_REGISTRO,
+                'headers': {'Idempotency-Key': 'item-1'}}
+        
+        primeira, = batch(client, token, item)
+        repetida, = batch(client, token, item)
+        
+        assert primeira['status'] == repetida['status'] == 201
+        assert repetida['headers']['Idempotent-Replayed'] == 'true'
+        assert repetida['body']['id'] == primeira['body']['id']
+        assert Registro.query.count() == 1
+    
+    def test_chave_externa_preservada(self, client, token):
+        """Testa que a chave do próprio /batch continua valendo com itens que têm chave"""
+        item = {'method': 'POST', 'path': '/registros', 'body': NOVO_REGISTRO,
+                'headers': {'Idempotency-Key': 'item-1'}}
+        
+        primeira = batch(client, token, item, **{'Idempotency-Key': 'lote-1'})
+        resposta = client.post('/api/v1/batch', json={'requests': [item]},
+                               headers={'Authorization': f'Bearer {token}', 'Idempotency-Key': 'lote-1'})
+        
+        assert resposta.headers['Idempotent-Replayed'] == 'true'
+        assert resposta.get_json()['responses'] == primeira
+        db.session.expire_all()
+        assert Registro.query.count() == 1
@@ -0,0 +1,40 @@
+from datetime import datetime, timedelta
+from app import db
+from models import Pendencia
+from cache import micro_cache_store
+
+class TestDashboardApi:
+    """Testes do cache do dashboard da API"""
+    
+    def test_etag_e_micro_cache_sem_cache_no_redis(self, client, dados, redis):
+        """Testa o 304 pelo ETag e que a resposta não é guardada no Redis"""
+        micro_cache_store.clear()
+        token = client.post('/api/v1/auth/login', json={'email': 'gestor@exemplo.com', 'senha': '123456'}).get_json()['token']
+        cabecalhos = {'Authorization': f'Bearer {token}'}
+        
+        resposta = client.get('/api/v1/dashboard', headers=cabecalhos)
+        assert resposta.status_code == 200
+        assert resposta.headers['ETag']
+        
+        repetida = client.get('/api/v1/dashboard', headers={**cabecalhos, 'If-None-Match': resposta.headers['ETag']})
+        assert repetida.status_code == 304
+        assert not redis.keys('api_response:dashboard:*')
+
+class TestPendenciasCriticas:
+    """Testes do endpoint de pendências críticas do painel"""
+    
+    def test_filtra_pelo_valor_gravado(self, cliente_gestor, criar_registro, dados):
+        """Testa que o filtro usa 'critica', o valor gravado pelos formulários e pela API"""
+        micro_cache_store.clear()
+        registro = criar_registro()
+        prazo = datetime.utcnow() + timedelta(hours=1)
+        critica = Pendencia(registro_id=registro.id, descricao='Crítica', responsavel_id=dados.medico_id,
+                            prazo=prazo, prioridade='critica')
+        alta = Pendencia(registro_id=registro.id, descricao='Alta', responsavel_id=dados.medico_id,
+                         prazo=prazo, prioridade='alta')
+        db.session.add_all([critica, alta])
+        db.session.commit()
+        
+        resposta = cliente_gestor.get('/api/pendencias/criticas')
+        
+        assert [p['id'] for p in resposta.get_json()] == [critica.id]
@@ -0,0 +1,191 @@
+from datetime import datetime, timedelta
+from app import db
+from models import Notificacao
+from canais import CanalSimulado, ErroPermanente
+import envio
+
+def criar_notificacoes(*destinos, tipo='email', **campos):
+    notificacoes = [Notificacao(tipo=tipo, destino=destino, payload={'titulo': destino}, **campos) for destino in destinos]
+    db.session.add_all(notificacoes)
+    db.session.commit()
+    return [notificacao.id for notificacao in notificacoes]
+
+def buscar(notificacao_id):
+    db.session.expire_all()
+    return db.session.get(Notificacao, notificacao_id)
+
+class TestReserva:
+    """Testes da reserva de notificações (leases)"""
+    
+    def test_workers_reservam_lotes_disjuntos(self, app):
+        """Testa que dois workers nunca pegam a mesma notificação"""
+        ids = criar_notificacoes(*(f'u{i}@exemplo.com' for i in range(8)))
+        
+        primeiro = {n['id'] for n in envio.reservar_notificacoes('A', 5)}
+        segundo = {n['id'] for n in envio.reservar_notificacoes('B', 5)}
+        
+        assert len(primeiro) == 5
+        assert len(segundo) == 3
+        assert not primeiro & segundo
+        assert primeiro | segundo == set(ids)
+        assert buscar(ids[0]).reservada_por == 'A'
+        assert envio.reservar_notificacoes('C', 5) == []
+    
+    def test_reserva_expirada_volta_para_a_fila(self, app):
+        """Testa que a reserva de um worker que morreu expira sozinha"""
+        notificacao_id, = criar_notificacoes('a@exemplo.com')
+        envio.reservar_notificacoes('A', 5)
+        
+        depois_da_reserva = datetime.utcnow() + timedelta(seconds=envio.RESERVA_SEGUNDOS + 1)
+        assert envio.reservar_notificacoes('B', 5) == []
+        reservadas = envio.reservar_notificacoes('B', 5, agora=depois_da_reserva)
+        
+        assert [n['id'] for n in reservadas] == [notificacao_id]
+        assert buscar(notificacao_id).reservada_por == 'B'
+    
+    def test_respeita_proxima_tentativa(self, app):
+        """Testa que notificações em backoff só são reservadas depois do prazo"""
+        futura = datetime.utcnow() + timedelta(minutes=5)
+        criar_notificacoes('a@exemplo.com', proxima_tentativa=futura)
+        
+        assert envio.reservar_notificacoes('A', 5) == []
+        assert len(envio.reservar_notificacoes('A', 5, agora=futura + timedelta(seconds=1))) == 1
+    
+    def test_resultado_so_grava_linhas_do_dono(self, app):
+        """Testa que um worker com reserva vencida não sobrescreve o envio de outro"""
+        notificacao_id, = criar_notificacoes('a@exemplo.com')
+        reservada, = envio.reservar_notificacoes('A', 5)
+        depois_da_reserva = datetime.utcnow() + timedelta(seconds=envio.RESERVA_SEGUNDOS + 1)
+        envio.reservar_notificacoes('B', 5, agora=depois_da_reserva)
+        
+        assert envio._gravar_resultados('A', [(reservada, None)], [], datetime.utcnow()) == (1, 0)
+        notificacao = buscar(notificacao_id)
+        assert notificacao.status == 'pendente'
+        assert notificacao.reservada_por == 'B'
+        
+        envio._gravar_resultados('B', [(reservada, None)], [], datetime.utcnow())
+        notificacao = buscar(notificacao_id)
+        assert notificacao.status == 'enviado'
+        assert notificacao.reservada_por is None
+    
+    def test_janela_resumo_segura_emails_recentes(self, app):
+        """Testa que emails só saem depois da janela de resumo"""
+        criar_notificacoes('a@exemplo.com')
+        criar_notificacoes('5511999999999', tipo='sms')
+        
+        reservadas = envio.reservar_notificacoes('A', 5, janela_resumo=60)
+        
+        assert [n['tipo'] for n in reservadas] == ['sms']
+
+class TestEnvio:
+    """Testes do envio pelos canais e do tratamento de falhas"""
+    
+    def test_envia_e_classifica_falhas(self, app):
+        """Testa envio, falha transitória, falha permanente e canal desconhecido"""
+        ok, = criar_notificacoes('ok@exemplo.com')
+        transitoria, = criar_notificacoes('ruim', tipo='sms')
+        permanente, = criar_notificacoes('perm', tipo='push')
+        desconhecido, = criar_notificacoes('0800', tipo='fax')
+        canais = {
+            'email': CanalSimulado(),
+            'sms': CanalSimulado(falhas={'ruim': RuntimeError('fora do ar')}),
+            'push': CanalSimulado(falhas={'perm': ErroPermanente('token inválido')})
+        }
+        
+        assert envio.enviar_notificacoes(canais=canais) == (1, 3)
+        
+        assert canais['email'].enviadas == [('ok@exemplo.com', {'titulo': 'ok@exemplo.com'})]
+        assert buscar(ok).status == 'enviado'
+        
+        notificacao = buscar(transitoria)
+        assert notificacao.status == 'pendente'
+        assert notificacao.tentativas == 1
+        assert notificacao.proxima_tentativa is not None
+        assert notificacao.ultimo_erro == 'fora do ar'
+        assert notificacao.reservada_por is None
+        
+        notificacao = buscar(permanente)
+        assert notificacao.status == 'falha'
+        assert notificacao.proxima_tentativa is None
+        
+        notificacao = buscar(desconhecido)
+        assert notificacao.status == 'falha'
+        assert 'fax' in notificacao.ultimo_erro
+    
+    def test_falha_encerra_apos_max_tentativas(self, app):
+        """Testa que a última tentativa permitida encerra a notificação"""
+        notificacao_id, = criar_notificacoes('ruim', tipo='sms', tentativas=envio.MAX_TENTATIVAS - 1)
+        canais = {'sms': CanalSimulado(falhas={'ruim': RuntimeError('fora do ar')})}
+        
+        envio.enviar_notificacoes(canais=canais)
+        
+        notificacao = buscar(notificacao_id)
+        assert notificacao.status == 'falha'
+        assert notificacao.tentativas == envio.MAX_TENTATIVAS
+    
+    def test_canais_configurados_pela_aplicacao(self, app, monkeypatch):
+        """Testa que NOTIFICACAO_CANAIS substitui os canais padrão"""
+        canal = CanalSimulado()
+        monkeypatch.setitem(app.config, 'NOTIFICACAO_CANAIS', {'webhook': canal})
+        notificacao_id, = criar_notificacoes('https://exemplo.com/gancho', tipo='webhook')
+        
+        assert envio.enviar_notificacoes() == (1, 0)
+        assert canal.enviadas == [('https://exemplo.com/gancho', {'titulo': 'https://exemplo.com/gancho'})]
+        assert buscar(notificacao_id).status == 'enviado'
+    
+    def test_resumo_agrupa_emails_do_destinatario(self, app):
+        """Testa que os emails de um destinatário na janela saem numa só mensagem"""
+        antigo = datetime.utcnow() - timedelta(minutes=5)
+        ids = criar_notificacoes('a@exemplo.com', 'a@exemplo.com', 'b@exemplo.com', enviado_em=antigo)
+        canal = CanalSimulado()
+        
+        assert envio.enviar_notificacoes(canais={'email': canal}, janela_resumo=60) == (3, 0)
+        
+        assert sorted(destino for destino, _ in canal.enviadas) == ['a@exemplo.com', 'b@exemplo.com']
+        assert all(buscar(notificacao_id).status == 'enviado' for notificacao_id in ids)
+
+class TestBackoff:
+    """Testes do backoff exponencial por destino"""
+    
+    def test_atraso_com_jitter_limitado(self, monkeypatch):
+        """Testa os limites do atraso sorteado"""
+        monkeypatch.setattr(envio.random, 'uniform', lambda inicio, fim: fim)
+        
+        assert envio._atraso(1) == envio.BACKOFF_BASE
+        assert envio._atraso(3) == envio.BACKOFF_BASE * 4
+        assert envio._atraso(30) == envio.BACKOFF_MAXIMO
+    
+    def test_atraso_sem_redis_usa_tentativas(self, app, monkeypatch):
+        """Testa o backoff pelas tentativas da própria notificação sem Redis"""
+        monkeypatch.setattr(envio.cache, 'redis_client', None)
+        monkeypatch.setattr(envio.random, 'uniform', lambda inicio, fim: fim)
+        
+        assert envio._adiar_destino('sms', 'ruim', 2) == envio.BACKOFF_BASE * 2
+    
+    def test_destino_com_falha_fica_adiado(self, app, redis):
+        """Testa que uma falha adia as outras notificações do mesmo destino"""
+        primeira, = criar_notificacoes('ruim', tipo='sms')
+        canais = {'sms': CanalSimulado(falhas={'ruim': RuntimeError('fora do ar')})}
+        envio.enviar_notificacoes(canais=canais)
+        
+        assert redis.get('envio:falhas:sms:ruim') == '1'
+        assert redis.pttl('envio:adiado:sms:ruim') > 0
+        
+        # Nova notificação para o destino adiado volta à fila sem gastar tentativa
+        segunda, = criar_notificacoes('ruim', tipo='sms')
+        canais['sms'].falhas = {}
+        assert envio.enviar_notificacoes(canais=canais) == (0, 0)
+        notificacao = buscar(segunda)
+        assert notificacao.tentativas == 0
+        assert notificacao.proxima_tentativa is not None
+        assert canais['sms'].enviadas == []
+        assert buscar(primeira).tentativas == 1
+    
+    def test_sucesso_limpa_falhas_do_destino(self, app, redis):
+        """Testa que um envio bem-sucedido zera o backoff do destino"""
+        redis.set('envio:falhas:sms:bom', 2)
+        criar_notificacoes('bom', tipo='sms')
+        
+        envio.enviar_notificacoes(canais={'sms': CanalSimulado()})
+        
+        assert redis.get('envio:falhas:sms:bom') is None
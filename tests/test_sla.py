@@ -0,0 +1,125 @@
+import pytest
+from datetime import datetime, timedelta
+from app import db
+from models import Usuario, Pendencia, NotificacaoSistema, LogAlteracao, Auditoria
+from notificacoes import caixa_entrada
+import sla
+
+@pytest.fixture
+def criar_pendencia(criar_registro, dados):
+    """Fábrica de pendências de um registro do plantão de `dados`"""
+    registro_id = criar_registro().id
+    def criar(minutos=10, **campos):
+        valores = dict(registro_id=registro_id, descricao='Pendência de teste', responsavel_id=dados.medico_id,
+                       prazo=datetime.utcnow() + timedelta(minutes=minutos))
+        valores.update(campos)
+        pendencia = Pendencia(**valores)
+        db.session.add(pendencia)
+        db.session.commit()
+        return pendencia
+    return criar
+
+def alertas(tipo='sla_vencendo'):
+    return NotificacaoSistema.query.filter_by(tipo=tipo).all()
+
+class TestVerificarSla:
+    """Testes da varredura de SLA"""
+    
+    def test_alerta_uma_vez_por_prazo(self, criar_pendencia, dados):
+        """Testa que cada prazo é alertado uma única vez e que mudar o prazo rearma"""
+        pendencia = criar_pendencia(minutos=10)
+        criar_pendencia(minutos=120)
+        
+        assert sla.verificar_sla() == 1
+        assert sla.verificar_sla() == 0
+        alerta, = alertas()
+        assert alerta.usuario_id == dados.medico_id
+        assert alerta.link == f'/pendencias/{pendencia.id}'
+        
+        pendencia.prazo = datetime.utcnow() + timedelta(minutes=15)
+        db.session.commit()
+        assert sla.verificar_sla() == 1
+    
+    def test_critica_alerta_gestores(self, criar_pendencia, dados):
+        """Testa que pendências críticas também alertam os gestores"""
+        criar_pendencia(minutos=10, prioridade='critica')
+        
+        sla.verificar_sla()
+        
+        assert [alerta.usuario_id for alerta in alertas('sla_critico_vencendo')] == [dados.gestor_id]
+    
+    def test_ignora_concluidas_e_vencidas(self, criar_pendencia):
+        """Testa que só pendências ativas com prazo futuro são alertadas"""
+        criar_pendencia(minutos=10, status='concluida')
+        criar_pendencia(minutos=-10)
+        
+        assert sla.verificar_sla() == 0
+    
+    def test_alerta_passa_pela_sessao(self, criar_pendencia, dados, redis):
+        """Testa log de alterações, auditoria e caixa de entrada dos alertas"""
+        pendencia = criar_pendencia(minutos=10)
+        atualizado_em = pendencia.atualizado_em
+        
+        sla.verificar_sla()
+        
+        alerta, = alertas()
+        assert LogAlteracao.query.filter_by(entidade='notificacao', entidade_id=alerta.id, operacao='criar').count() == 1
+        marcacao = Auditoria.query.filter_by(objeto='pendencia', objeto_id=pendencia.id).order_by(Auditoria.id.desc()).first()
+        assert 'sla_alerta_prazo' in marcacao.depois
+        assert db.session.get(Pendencia, pendencia.id).atualizado_em == atualizado_em
+        total, ultimas = caixa_entrada(dados.medico_id)
+        assert total == 1
+        assert ultimas[0]['id'] == alerta.id
+    
+    def test_ids_gestores(self, dados):
+        """Testa que só gestores ativos são alertados"""
+        inativo = Usuario(nome='Gestor Inativo', email='inativo@exemplo.com', perfis=['gestor'], ativo=False)
+        inativo.set_senha('123456')
+        db.session.add(inativo)
+        db.session.commit()
+        
+        assert sla.ids_gestores() == [dados.gestor_id]
+
+class TestAgendaSla:
+    """Testes da agenda de prazos no Redis"""
+    
+    def test_agenda_acompanha_pendencia(self, criar_pendencia, redis):
+        """Testa que a criação agenda a pendência e a conclusão a retira"""
+        pendencia = criar_pendencia(minutos=10)
+        
+        assert redis.zscore(sla.CHAVE_AGENDA, pendencia.id) == sla._score(pendencia.prazo)
+        
+        pendencia.status = 'concluida'
+        db.session.commit()
+        assert redis.zscore(sla.CHAVE_AGENDA, pendencia.id) is None
+    
+    def test_despachar_alertas(self, criar_pendencia, redis):
+        """Testa que o despachante alerta só o que venceu e esvazia a agenda"""
+        proxima = criar_pendencia(minutos=10)
+        distante = criar_pendencia(minutos=120)
+        
+        assert sla.despachar_alertas_sla() == 1
+        assert sla.despachar_alertas_sla() == 0
+        
+        assert [alerta.link for alerta in alertas()] == [f'/pendencias/{proxima.id}']
+        assert redis.zscore(sla.CHAVE_AGENDA, proxima.id) is None
+        assert redis.zscore(sla.CHAVE_AGENDA, distante.id) is not None
+    
+    def test_despachar_descarta_entrada_obsoleta(self, criar_pendencia, redis):
+        """Testa que entradas de pendências já alertadas saem sem novo alerta"""
+        pendencia = criar_pendencia(minutos=10)
+        sla.verificar_sla()
+        redis.zadd(sla.CHAVE_AGENDA, {pendencia.id: sla._score(pendencia.prazo)})
+        
+        assert sla.despachar_alertas_sla() == 0
+        assert len(alertas()) == 1
+        assert redis.zcard(sla.CHAVE_AGENDA) == 0
+    
+    def test_reconciliar_reconstroi_agenda(self, criar_pendencia, redis):
+        """Testa que a reconciliação repõe as pendências ativas não alertadas"""
+        ativas = [criar_pendencia(minutos=10), criar_pendencia(minutos=120)]
+        criar_pendencia(minutos=10, status='concluida')
+        redis.delete(sla.CHAVE_AGENDA)
+        
+        assert sla.reconciliar_agenda_sla() == 2
+        assert {int(membro) for membro in redis.zrange(sla.CHAVE_AGENDA, 0, -1)} == {p.id for p in ativas}
@@ -0,0 +1,46 @@
+import pytest
+from app import db
+from models import Tag
+import tags
+
+class ConexaoPerdeInsercoes:
+    """Conexão que descarta as primeiras inserções, como a de uma transação concorrente desfeita"""
+    
+    def __init__(self, connection, perdas):
+        self.connection = connection
+        self.perdas = perdas
+    
+    def execute(self, instrucao, *args):
+        if instrucao.is_insert and self.perdas:
+            self.perdas -= 1
+            return None
+        return self.connection.execute(instrucao, *args)
+    
+    def __getattr__(self, nome):
+        return getattr(self.connection, nome)
+
+class TestGarantirTags:
+    """Testes da criação das tags do dicionário"""
+    
+    def test_cria_e_unifica_tags(self, app):
+        """Testa que variações do mesmo nome viram uma única tag"""
+        ids, novas = tags._garantir_tags(db.session.connection(), ['UTI', 'uti', 'Úti', 'Farmácia'])
+        
+        assert novas
+        assert set(ids) == {'uti', 'farmacia'}
+        assert tags._garantir_tags(db.session.connection(), ['uti']) == ({'uti': ids['uti']}, False)
+    
+    def test_tag_ausente_depois_da_insercao_insere_de_novo(self, app):
+        """Testa a nova tentativa quando a inserção concorrente foi desfeita"""
+        conexao = ConexaoPerdeInsercoes(db.session.connection(), perdas=1)
+        
+        ids, _ = tags._garantir_tags(conexao, ['UTI'])
+        
+        assert ids == {'uti': Tag.query.filter_by(chave='uti').one().id}
+    
+    def test_tag_que_nunca_aparece_falha(self, app):
+        """Testa que a função não devolve ids incompletos"""
+        conexao = ConexaoPerdeInsercoes(db.session.connection(), perdas=2)
+        
+        with pytest.raises(RuntimeError, match='uti'):
+            tags._garantir_tags(conexao, ['UTI'])
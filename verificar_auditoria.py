@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+"""
+Script para verificar a integridade da trilha de auditoria
+
+Uso:
+    python verificar_auditoria.py [--processos N]   # verifica todos os blocos
+    python verificar_auditoria.py --prova ID        # prova de inclusão de uma linha
+"""
+
+import argparse
+import json
+import sys
+from app import app
+from integridade import verificar_integridade, prova_inclusao, verificar_prova
+
+def verificar_auditoria(processos):
+    """Confere cadeia e raízes Merkle sem alterar o banco (a selagem é da tarefa selar_auditoria)"""
+    with app.app_context():
+        resultado = verificar_integridade(processos=processos)
+        print(f"🔎 {resultado['linhas']} linhas verificadas em {resultado['blocos']} blocos")
+        if resultado['problemas']:
+            print("❌ Problemas encontrados:")
+            for problema in resultado['problemas']:
+                print(f"  - {problema}")
+            return False
+        
+        print("✅ Trilha de auditoria íntegra")
+        return True
+
+def gerar_prova(auditoria_id):
+    """Imprime a prova de inclusão (JSON) de uma linha da auditoria"""
+    with app.app_context():
+        prova = prova_inclusao(auditoria_id)
+        if not prova:
+            print(f"Linha {auditoria_id} ainda não pertence a um bloco com checkpoint")
+            return False
+        
+        print(json.dumps(prova, indent=2))
+        return verificar_prova(prova['folha'], prova['caminho'], prova['raiz_merkle'])
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Verifica a integridade da auditoria')
+    parser.add_argument('--processos', type=int, default=4, help='processos paralelos na verificação')
+    parser.add_argument('--prova', type=int, metavar='ID', help='gera a prova de inclusão da linha ID')
+    args = parser.parse_args()
+    
+    if args.prova:
+        ok = gerar_prova(args.prova)
+    else:
+        ok = verificar_auditoria(args.processos)
+    sys.exit(0 if ok else 1)